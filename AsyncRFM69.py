@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# asyncio interface to an RFM69 instance
+# The DIO0 interrupt hands completions to the event loop with call_soon_threadsafe, so waiting for packets
+# and PACKETSENT doesn't block the loop. Reliable sends run on the radio's retry thread, long frames are
+# streamed from an executor and the radio lock is polled for while another thread holds it.
+# Create it from inside the running event loop:
+#
+#   radio = AsyncRFM69(RFM69.RFM69(RF69_433MHZ, 1, 1, True))
+#   await radio.sendWithRetry(2, "hello")
+#   async for packet in radio:
+#       print(packet.sender, packet.data)
+
+from RFM69registers import *
+import asyncio
+import time
+
+class AsyncRFM69(object):
+    def __init__(self, radio, loop = None):
+        self.radio = radio
+        self.loop = loop or asyncio.get_running_loop()
+        self.rxEvent = asyncio.Event()
+        self.txLock = asyncio.Lock()
+        self.txFuture = None
+        radio.receiveHooks.append(self.onReceive)
+        radio.txHooks.append(self.onTxDone)
+
+    # interrupt thread side
+    def onReceive(self, packet):
+        self.loop.call_soon_threadsafe(self.rxEvent.set)
+
+    def onTxDone(self):
+        future = self.txFuture
+        if future is not None:
+            self.loop.call_soon_threadsafe(self.complete, future)
+
+    def complete(self, future):
+        if not future.done():
+            future.set_result(True)
+
+    # event loop side
+    async def recv(self, timeout = None):
+        radio = self.radio
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # clear before checking, a packet queued after the check sets the event again
+            self.rxEvent.clear()
+            await self.receiveBegin()
+            with radio.rxReady:
+                packet = radio.rxBuffer.popleft() if radio.rxBuffer else None
+            if packet is not None:
+                return packet
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(self.rxEvent.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.recv()
+
+    async def send(self, toAddress, buff = "", requestACK = False):
+        async with self.txLock:
+            await self.waitCanSend(RF69_CSMA_LIMIT_S, False)
+            await self.sendFrame(toAddress, buff, requestACK, False)
+
+    # echoes the sequence number of the last frame received like RFM69.sendACK, pass packet.sequence (and
+    # packet.rssi for reportRssi) to acknowledge a particular packet
+    async def sendACK(self, toAddress, buff = "", sequence = None, rssi = None):
+        sequence = self.radio.SEQUENCE if sequence is None else sequence
+        buff, flags = self.radio.ackPayload(buff, rssi)
+        async with self.txLock:
+            await self.waitCanSend(RF69_CSMA_LIMIT_S, True)
+            await self.sendFrame(toAddress, buff, False, True, sequence, flags)
+
+    # the radio's retry thread does the transmissions and ACK matching, sends to different peers overlap
+    async def sendWithRetry(self, toAddress, buff = "", retries = 3, retryWaitTime = 10):
+        return await asyncio.wrap_future(self.radio.sendReliable(toAddress, buff, retries, retryWaitTime))
+
+    # the radio lock may be held by the retry thread for a whole frame, don't block the loop on it.
+    # It's a threading lock the owning thread has to release, so it's polled for rather than taken in an executor
+    async def acquire(self):
+        while not self.radio.lock.acquire(blocking=False):
+            await asyncio.sleep(0.001)
+
+    # RFM69.recv starts the receiver like this, but would wait for the lock on the loop.
+    # With the lock held the interrupt handler isn't reading a frame, so receiveBegin doesn't sleep on intLock
+    async def receiveBegin(self):
+        radio = self.radio
+        if radio.mode in (RF69_MODE_RX, RF69_MODE_TX, RF69_MODE_LISTEN):
+            return
+        await self.acquire()
+        try:
+            if radio.mode not in (RF69_MODE_RX, RF69_MODE_TX, RF69_MODE_LISTEN):
+                radio.receiveBegin()
+        finally:
+            radio.lock.release()
+
+    # like RFM69.csmaSend, restarts reception before the first assessment unless it's for an ACK
+    async def waitCanSend(self, limit, sendACK):
+        radio = self.radio
+        now = time.time()
+        attempt = 0
+        while True:
+            await self.acquire()
+            try:
+                if attempt == 0 and not sendACK:
+                    radio.writeReg(REG_PACKETCONFIG2, (radio.getReg(REG_PACKETCONFIG2) & 0xFB) | RF_PACKET2_RXRESTART)
+                if radio.canSend():
+                    return
+            finally:
+                radio.lock.release()
+            if time.time() - now >= limit:
+                return
+            attempt += 1
+            await asyncio.sleep(radio.csmaBackoffTime(attempt))
+
+    async def sendFrame(self, toAddress, buff, requestACK, sendACK, sequence = 0, flags = 0):
+        radio = self.radio
+        # keep the retry thread off the SPI bus until the frame is out
+        await self.acquire()
+        try:
+            self.txFuture = self.loop.create_future()
+            timeout = radio.startFrame(toAddress, buff, requestACK, sendACK, sequence, flags)
+            if radio.txStream:
+                await self.loop.run_in_executor(None, radio.streamFrame, time.monotonic() + timeout)
+            try:
+                await asyncio.wait_for(asyncio.shield(self.txFuture), timeout)
+            except asyncio.TimeoutError:
+                # the interrupt went missing, poll for the end of the frame like the sync path, but not forever
+                deadline = time.monotonic() + timeout
+                while not radio.frameSent():
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"the frame to {toAddress} wasn't sent within {2 * timeout:.3f}s")
+                    await asyncio.sleep(0.001)
+        finally:
+            self.txFuture = None
+            radio.finishFrame()
+            radio.lock.release()
@@ -1,18 +1,201 @@
 #!/usr/bin/env python3
 
-# Preconfigured for Raspberry Pi
-# For Orange Pi, change:
-# - import OPi.GPIO (pip install OrangePi.GPIO)
-# - spiBus = 1
-# - uncomment GPIO.setboard() call and set correct board type
+# Preconfigured for Raspberry Pi, see RFM69transport.py for Orange Pi
 
 from RFM69registers import *
-import spidev
-import RPi.GPIO as GPIO
+from RFM69modem import PROFILES as MODEM_PROFILES
+from RFM69transport import SpiDevTransport
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future
+import heapq
+import random
+import threading
 import time
+import zlib
+
+# trigger bits always read back as 0, keep them out of the shadow so read-modify-writes don't fire them again
+SHADOW_MASK = bytearray([0xFF] * 0x80)
+SHADOW_MASK[REG_OPMODE] &= ~RF_OPMODE_LISTENABORT & 0xFF
+SHADOW_MASK[REG_OSC1] &= ~RF_OSC1_RCCAL_START & 0xFF
+SHADOW_MASK[REG_PACKETCONFIG2] &= ~RF_PACKET2_RXRESTART & 0xFF
+
+# listen mode timer resolutions in microseconds with their idle and RX bits in REG_LISTEN1
+LISTEN_RESOLUTIONS = ((64, RF_LISTEN1_RESOL_IDLE_64, RF_LISTEN1_RESOL_RX_64),
+                      (4100, RF_LISTEN1_RESOL_IDLE_4100, RF_LISTEN1_RESOL_RX_4100),
+                      (262000, RF_LISTEN1_RESOL_IDLE_262000, RF_LISTEN1_RESOL_RX_262000))
+
+# finest resolution that fits the 8 bit coefficient, returns its LISTEN_RESOLUTIONS entry and the coefficient
+def listenCoefficient(us):
+    for resolution in LISTEN_RESOLUTIONS:
+        coef = int(round(us / resolution[0]))
+        if coef <= 255:
+            return resolution, max(coef, 1)
+    raise ValueError(f"listen period of {us}us is longer than the chip's maximum of {255 * 262000}us")
+
+# REG_PALEVEL, REG_OCP and whether the TESTPA high power settings are needed in TX, for an output power in dBm.
+# RFM69W modules have PA0 on their antenna pin, RFM69HW modules PA1 and PA2 on PA_BOOST: PA1 alone up to +13dBm,
+# both up to +17dBm and above that with the high power settings and OCP off
+def paSettings(dbm, highPower):
+    if not highPower:
+        return RF_PALEVEL_PA0_ON | (dbm + 18), RF_OCP_ON, False
+    if dbm <= 13:
+        return RF_PALEVEL_PA1_ON | (dbm + 18), RF_OCP_ON, False
+    if dbm <= 17:
+        return RF_PALEVEL_PA1_ON | RF_PALEVEL_PA2_ON | (dbm + 14), RF_OCP_ON, False
+    return RF_PALEVEL_PA1_ON | RF_PALEVEL_PA2_ON | (dbm + 11), RF_OCP_OFF, True
+
+# output power of a REG_PALEVEL value in dBm
+def paDbm(paLevel, boost):
+    if paLevel & RF_PALEVEL_PA2_ON:
+        return (paLevel & 0x1F) - (11 if boost else 14)
+    return (paLevel & 0x1F) - 18
+
+# output power range in dBm by isRFM69HW, and the register values for every step in it
+POWER_RANGE = {False: (-18, 13), True: (-2, 20)}
+PA_SETTINGS = {highPower: {dbm: paSettings(dbm, highPower) for dbm in range(low, high + 1)}
+               for highPower, (low, high) in POWER_RANGE.items()}
+
+# a received frame, ctl is the raw control byte and timestamp is time.monotonic() at reception
+class Packet(namedtuple("Packet", "data sender target ctl rssi timestamp")):
+    __slots__ = ()
+
+    @property
+    def ackReceived(self):
+        return bool(self.ctl & RF69_CTL_SENDACK)
+
+    @property
+    def ackRequested(self):
+        return bool(self.ctl & RF69_CTL_REQACK) and self.target != RF69_BROADCAST_ADDR
+
+    @property
+    def sequence(self):
+        return self.ctl & RF69_CTL_SEQUENCE
+
+# a reliable send waiting for its ACK, see RFM69.sendReliable
+class ReliableSend(object):
+    __slots__ = ("toAddress", "buff", "sequence", "attempts", "retryWaitTime", "future", "tries", "flags")
+
+    def __init__(self, toAddress, buff, attempts, retryWaitTime, flags = 0):
+        self.toAddress = toAddress
+        self.buff = buff
+        self.flags = flags
+        self.sequence = 0
+        self.attempts = attempts
+        self.retryWaitTime = retryWaitTime
+        self.future = Future()
+        self.tries = 0
+
+# recently received (sequence number, payload checksum) pairs of each sender, so a frame that was sent again
+# because its ACK got lost isn't delivered twice. Only frames with a sequence number are checked (see
+# RFM69.sequenceNumbers), window is how many of a sender's recent frames are remembered and for how many
+# seconds. Once maxSenders are known, the one not heard from the longest is forgotten.
+class DedupCache(object):
+    def __init__(self, maxSenders = 64, window = 8, lifetime = 30.0):
+        if not 1 <= window <= RF69_CTL_SEQUENCE:
+            raise ValueError(f"window must be between 1 and {RF69_CTL_SEQUENCE} frames")
+        self.maxSenders = maxSenders
+        self.window = window
+        self.lifetime = lifetime
+        self.lock = threading.Lock()
+        # sender -> deque of (sequence, checksum, time), least recently heard first
+        self.senders = OrderedDict()
+        self.checked = 0
+        self.duplicates = 0
+        self.evictions = 0
+
+    # True if the packet was already seen, otherwise it's remembered
+    def seen(self, packet):
+        key = (packet.sequence, zlib.crc32(packet.data))
+        now = time.monotonic()
+        with self.lock:
+            self.checked += 1
+            recent = self.senders.get(packet.sender)
+            if recent is None:
+                if len(self.senders) >= self.maxSenders:
+                    self.senders.popitem(last=False)
+                    self.evictions += 1
+                recent = self.senders[packet.sender] = deque(maxlen=self.window)
+            else:
+                self.senders.move_to_end(packet.sender)
+            for sequence, checksum, when in recent:
+                if (sequence, checksum) == key and now - when < self.lifetime:
+                    self.duplicates += 1
+                    return True
+            recent.append(key + (now,))
+            return False
+
+    def stats(self):
+        with self.lock:
+            return {"dedupChecked": self.checked, "dedupDuplicates": self.duplicates,
+                    "dedupSenders": len(self.senders), "dedupEvictions": self.evictions}
+
+# closed loop transmit power for each peer, the power towards a peer is adjusted until the RSSI our frames arrive
+# with is within hysteresis dB of targetRssi. Peers with reportRssi on put that RSSI into their ACKs, for the others
+# it's estimated from the RSSI of their ACKs, on the assumption they send at peerDbm (our own power if None).
+# Power goes down at most maxStepDown dB per ACK and up right away, every retry goes out missStep dB louder
+# and a peer not heard from for lifetime seconds starts again at full power.
+class PowerControl(object):
+    def __init__(self, targetRssi = -80, hysteresis = 3, maxStepDown = 3, missStep = 6, peerDbm = None, lifetime = 600.0):
+        self.targetRssi = targetRssi
+        self.hysteresis = hysteresis
+        self.maxStepDown = maxStepDown
+        self.missStep = missStep
+        self.peerDbm = peerDbm
+        self.lifetime = lifetime
+        self.lock = threading.Lock()
+        # peer -> (dBm, time.monotonic() of the last update)
+        self.peers = {}
+        self.reports = 0
+        self.estimates = 0
+        self.misses = 0
+        self.adjustments = 0
+
+    # power for frames to peer, default for broadcasts and peers without a recent update
+    def powerFor(self, peer, default):
+        if peer == RF69_BROADCAST_ADDR:
+            return default
+        with self.lock:
+            entry = self.peers.get(peer)
+        if entry is None or time.monotonic() - entry[1] > self.lifetime:
+            return default
+        return entry[0]
+
+    # rssi is what the peer received our frame with, sent at current dBm, low and high the module's range
+    def update(self, peer, rssi, current, low, high, estimated = False):
+        error = rssi - self.targetRssi
+        if abs(error) <= self.hysteresis:
+            power = current
+        elif error > 0:
+            power = current - min(error, self.maxStepDown)
+        else:
+            power = current - error
+        self.set(peer, max(low, min(high, int(round(power)))), current)
+        with self.lock:
+            if estimated:
+                self.estimates += 1
+            else:
+                self.reports += 1
+
+    # a reliable send to peer went unanswered
+    def missed(self, peer, current, low, high):
+        with self.lock:
+            self.misses += 1
+        self.set(peer, min(high, max(low, current + self.missStep)), current)
+
+    def set(self, peer, power, current):
+        with self.lock:
+            if power != current:
+                self.adjustments += 1
+            self.peers[peer] = (power, time.monotonic())
+
+    def stats(self):
+        with self.lock:
+            return {"powerPeers": {peer: entry[0] for peer, entry in self.peers.items()}, "powerReports": self.reports,
+                    "powerEstimates": self.estimates, "powerMisses": self.misses, "powerAdjustments": self.adjustments}
 
 class RFM69(object):
-    def __init__(self, freqBand, nodeID, networkID, isRFM69HW = False, intPin = 18, rstPin = 22, spiBus = 0, spiDevice = 0):
+    def __init__(self, freqBand, nodeID, networkID, isRFM69HW = False, intPin = 18, rstPin = 22, spiBus = 0, spiDevice = 0, fastSync = False,
+                 rxBufferSize = 16, dropOldest = True, encoding = "latin-1", transport = None, dio1Pin = None):
 
         self.freqBand = freqBand
         self.address = nodeID
@@ -32,14 +215,112 @@ class RFM69(object):
         self.PAYLOADLEN = 0
         self.ACK_REQUESTED = 0
         self.ACK_RECEIVED = 0
+        self.SEQUENCE = 0
         self.RSSI = 0
-        self.DATA = []
+        self.DATA = b""
         self.sendSleepTime = 0.05
+        self.fifoRequest = [REG_FIFO & 0x7F] + [0] * 66
+        # reused for every transmitted frame: FIFO address, length, target, sender, control byte, payload
+        self.txBuffer = bytearray(5 + RF69_MAX_LONG_DATA_LEN)
+        self.txBuffer[0] = REG_FIFO | 0x80
+        # long frame mode (setLongFrames), frames bigger than the FIFO are streamed through it on the FifoLevel interrupt
+        self.longFrames = False
+        self.maxDataLen = RF69_MAX_DATA_LEN
+        self.fifoThreshold = RF_FIFOTHRESH_VALUE
+        # (next offset, end) in txBuffer of the frame being streamed out
+        self.txStream = None
+        self.fifoLevelLow = threading.Event()
+        # the start of the long frame being received, drained by fifoLevelHandler
+        self.rxStream = bytearray()
+        self.rxStreamTime = 0
+        self.encoding = encoding
+        # let the chip's AutoModes sequencer enter and leave TX instead of switching modes over SPI
+        self.autoModeTx = False
+        # serializes SPI access between the application, the interrupt handler and the retry thread
+        self.lock = threading.RLock()
+        self.spiTransactions = 0
+        self.initStats = {}
+        # in memory copy of the configuration registers, kept current by every write
+        self.shadow = bytearray(0x80)
+        self.shadowCheck = False
+        self.shadowMismatches = 0
+        self.lastShadowMismatch = None
+        self.txDone = threading.Event()
+        # received packets waiting for recv(), when full either the oldest or the newest packet is dropped
+        self.rxBuffer = deque()
+        self.rxBufferSize = rxBufferSize
+        self.dropOldest = dropOldest
+        self.rxReady = threading.Condition()
+        self.rxReceived = 0
+        self.rxDropped = 0
+        # callbacks run on the interrupt thread, receiveHooks get each queued Packet, txHooks are called on PACKETSENT,
+        # ackHooks get each ACK before it's matched to its reliable send
+        # packetHandlers see each Packet before it's queued, one returning True takes the packet out of the receive buffer
+        self.packetHandlers = []
+        self.receiveHooks = []
+        self.txHooks = []
+        self.ackHooks = []
+        # reliable sends waiting for an ACK, keyed by (peer, sequence)
+        # sequence numbers only go out when sequenceNumbers is on, without them one send per peer can be in flight
+        self.sequenceNumbers = False
+        self.maxInFlight = 1
+        self.pending = {}
+        self.inFlight = {}
+        self.waiting = {}
+        self.nextSequence = {}
+        self.retryQueue = []
+        self.retryCount = 0
+        self.retryReady = threading.Condition()
+        self.retryThread = None
+        # a DedupCache drops repeated frames before they're queued, their ACKs are sent again from ackThread
+        self.dedup = None
+        # an RFM69capture.CaptureFile logs every frame read from the FIFO
+        self.capture = None
+        # transmit power, paBoost is whether TX needs the TESTPA high power settings (see setPowerDbm)
+        self.powerLevel = powerLevel
+        self.paBoost = isRFM69HW
+        self.powerDbm = POWER_RANGE[bool(isRFM69HW)][1]
+        # a PowerControl picks the power for each peer, reportRssi adds the RSSI of the acknowledged frame to our ACKs
+        self.powerControl = None
+        self.reportRssi = False
+        self.ackQueue = deque()
+        self.ackReady = threading.Condition()
+        self.ackThread = None
+        self.ackFailures = 0
+        # listen mode, the chip wakes up every listenTiming["period"] seconds and goes back to sleep unless it hears something
+        self.listening = False
+        self.listenResume = True
+        self.listenTiming = None
+        # the RFM69modem.ModemProfile last applied with setModemProfile, None while CONFIG's 4.8kbps settings are in use
+        self.modemProfile = None
+        # CSMA: csmaSamples forced RSSI readings must all be below the threshold (csmaThreshold, or with csmaAdaptive
+        # csmaMargin above the tracked noise floor), a busy channel is retried after a random number of csmaSlot
+        # long slots from a window that doubles from csmaMinWindow up to csmaMaxWindow
+        self.csmaThreshold = CSMA_LIMIT
+        self.csmaAdaptive = False
+        self.csmaMargin = 10
+        self.csmaSamples = 3
+        self.csmaSlot = 0.002
+        self.csmaMinWindow = 4
+        self.csmaMaxWindow = 256
+        self.noiseFloor = None
+        self.random = random.Random()
+        # defers and backoff time of the last send, and totals over all sends
+        self.lastCsma = None
+        self.csmaSends = 0
+        self.csmaDefers = 0
+        self.csmaBackoff = 0.0
+        self.csmaForced = 0
+        # forced RSSI readings that never finished, counted as a busy channel
+        self.rssiTimeouts = 0
+        # RFM69channels.ChannelPlan and the channel tuned with setChannel, None after setFrequency
+        self.channelPlan = None
+        self.channel = None
+        # RFM69stats.RadioStats while instrumented, see RFM69stats.instrument
+        self.metrics = None
 
-        #GPIO.setboard(GPIO.ZERO)   # for Orange Pi, see https://pypi.org/project/OrangePi.GPIO/
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(self.intPin, GPIO.IN)
-        GPIO.setup(self.rstPin, GPIO.OUT)
+        # SPI and GPIO access, spidev and RPi.GPIO unless something else (like RFM69emulator) is passed in
+        self.transport = transport if transport is not None else SpiDevTransport(intPin, rstPin, spiBus, spiDevice, dio1Pin=dio1Pin)
 
         frfMSB = {RF69_315MHZ: RF_FRFMSB_315, RF69_433MHZ: RF_FRFMSB_433,
                   RF69_868MHZ: RF_FRFMSB_868, RF69_915MHZ: RF_FRFMSB_915}
@@ -102,74 +383,143 @@ class RFM69(object):
           0x00: [255, 0]
         }
 
-        #initialize SPI
-        self.spi = spidev.SpiDev()
-        self.spi.open(self.spiBus, self.spiDevice)
-        self.spi.max_speed_hz = 4000000
-
+        initStart = time.time()
         # Hard reset the RFM module
-        GPIO.output(self.rstPin, GPIO.HIGH);
-        time.sleep(0.1)
-        GPIO.output(self.rstPin, GPIO.LOW);
-        time.sleep(0.1)
+        self.transport.reset()
 
         #verify chip is syncing?
-        while self.readReg(REG_SYNCVALUE1) != 0xAA:
+        synced = False
+        if fastSync:
+            # a single write/read round trip is enough if the chip answers right away
             self.writeReg(REG_SYNCVALUE1, 0xAA)
+            synced = self.readReg(REG_SYNCVALUE1) == 0xAA
 
-        while self.readReg(REG_SYNCVALUE1) != 0x55:
-            self.writeReg(REG_SYNCVALUE1, 0x55)
+        if not synced:
+            while self.readReg(REG_SYNCVALUE1) != 0xAA:
+                self.writeReg(REG_SYNCVALUE1, 0xAA)
 
-        #write config
-        for value in self.CONFIG.values():
-            self.writeReg(value[0], value[1])
+            while self.readReg(REG_SYNCVALUE1) != 0x55:
+                self.writeReg(REG_SYNCVALUE1, 0x55)
+
+        self.writeConfig()
 
         self.encrypt(0)
         self.setHighPower(self.isRFM69HW)
         # Wait for ModeReady
-        while (self.readReg(REG_IRQFLAGS1) & RF_IRQFLAGS1_MODEREADY) == 0x00:
-            pass
+        self.waitReg("modeReady", REG_IRQFLAGS1, RF_IRQFLAGS1_MODEREADY)
+
+        self.transport.attachInterrupt(self.interruptHandler)
+        self.initStats = {"spiTransactions": self.spiTransactions, "seconds": time.time() - initStart}
 
-        GPIO.remove_event_detect(self.intPin)
-        GPIO.add_event_detect(self.intPin, GPIO.RISING, callback=self.interruptHandler)
+    def writeConfig(self):
+        # group CONFIG into runs of contiguous registers so each run is a single burst write
+        regs = sorted(value for value in self.CONFIG.values() if value[0] != 255)
+        runs = []
+        for addr, value in regs:
+            if runs and runs[-1][0] + len(runs[-1][1]) == addr:
+                runs[-1][1].append(value)
+            else:
+                runs.append([addr, [value]])
+        for addr, values in runs:
+            self.writeBurst(addr, values)
+
+        # verify with one burst read, this also seeds the register shadow
+        self.resync()
+        for addr, value in regs:
+            if self.shadow[addr] != value:
+                self.writeReg(addr, value)
+
+    def resync(self):
+        # reload the shadow from the chip, 0x01 to REG_TESTDAGC in one burst, without the bits that clear themselves
+        values = self.readBurst(1, REG_TESTDAGC)
+        self.shadow[1:REG_TESTDAGC + 1] = bytes(value & SHADOW_MASK[addr] for addr, value in enumerate(values, 1))
 
     def setFrequency(self, freqHz):
         step = 61.03515625
         freq = int(round(freqHz / step))
-        self.writeReg(REG_FRFMSB, freq >> 16)
-        self.writeReg(REG_FRFMID, freq >> 8)
-        self.writeReg(REG_FRFLSB, freq)
+        # the chip retunes once FRFLSB is written, all three go out in one burst
+        self.writeBurst(REG_FRFMSB, [(freq >> 16) & 0xFF, (freq >> 8) & 0xFF, freq & 0xFF])
+        self.channel = None
+
+    # an RFM69channels.ChannelPlan for setChannel
+    def setChannelPlan(self, plan):
+        self.channelPlan = plan
+        self.channel = None
+
+    # tunes to channel n of the plan with the precomputed FRF values, a receiver passes through SYNTH
+    # so the PLL stays on and RX picks up on the new frequency without going through standby
+    def setChannel(self, channel):
+        frf = self.channelPlan.frf[channel]
+        with self.lock:
+            if self.mode == RF69_MODE_LISTEN:
+                raise ValueError("can't change channels in listen mode")
+            receiving = self.mode == RF69_MODE_RX
+            if receiving:
+                self.setMode(RF69_MODE_SYNTH)
+            self.writeBurst(REG_FRFMSB, frf)
+            self.channel = channel
+            if receiving:
+                self.setMode(RF69_MODE_RX)
 
     def getFrequency(self):
         step = 61.03515625
-        freq = (self.readReg(REG_FRFMSB) << 16) + (self.readReg(REG_FRFMID) << 8) + self.readReg(REG_FRFLSB)
+        freq = (self.getReg(REG_FRFMSB) << 16) + (self.getReg(REG_FRFMID) << 8) + self.getReg(REG_FRFLSB)
         return int(round(freq * step))
 
+    # applies an RFM69modem.ModemProfile, or the name of one in RFM69modem.PROFILES
+    # everything from REG_DATAMODUL to REG_AFCBW goes out in one burst (the rest of the range from the shadow)
+    def setModemProfile(self, profile):
+        if isinstance(profile, str):
+            profile = MODEM_PROFILES[profile]
+        registers = profile.registers()
+        with self.lock:
+            receiving = self.mode == RF69_MODE_RX or self.mode == RF69_MODE_LISTEN
+            self.setMode(RF69_MODE_STANDBY)
+            self.waitReg("modeReady", REG_IRQFLAGS1, RF_IRQFLAGS1_MODEREADY)
+            values = list(self.shadow[REG_DATAMODUL:REG_AFCBW + 1])
+            for addr, value in registers.items():
+                if REG_DATAMODUL <= addr <= REG_AFCBW:
+                    values[addr - REG_DATAMODUL] = value
+            self.writeBurst(REG_DATAMODUL, values)
+            packet2 = (self.getReg(REG_PACKETCONFIG2) & 0x0F) | profile.restartDelayValue
+            if packet2 != self.shadow[REG_PACKETCONFIG2]:
+                self.writeReg(REG_PACKETCONFIG2, packet2)
+            if registers[REG_TESTDAGC] != self.shadow[REG_TESTDAGC]:
+                self.writeReg(REG_TESTDAGC, registers[REG_TESTDAGC])
+            self.modemProfile = profile
+            if receiving:
+                self.receiveBegin()
+
     def setMode(self, newMode):
         if newMode == self.mode:
             return
+        if self.mode == RF69_MODE_LISTEN:
+            self.listenModeAbort()
+            if newMode == RF69_MODE_STANDBY:
+                return
 
         if newMode == RF69_MODE_TX:
-            self.writeReg(REG_OPMODE, (self.readReg(REG_OPMODE) & 0xE3) | RF_OPMODE_TRANSMITTER)
+            # the high power settings have to be in place before the PA ramps up
             if self.isRFM69HW:
-                self.setHighPowerRegs(True)
+                self.setHighPowerRegs(self.paBoost)
+            self.writeReg(REG_OPMODE, (self.getReg(REG_OPMODE) & 0xE3) | RF_OPMODE_TRANSMITTER)
         elif newMode == RF69_MODE_RX:
-            self.writeReg(REG_OPMODE, (self.readReg(REG_OPMODE) & 0xE3) | RF_OPMODE_RECEIVER)
+            self.writeReg(REG_OPMODE, (self.getReg(REG_OPMODE) & 0xE3) | RF_OPMODE_RECEIVER)
             if self.isRFM69HW:
                 self.setHighPowerRegs(False)
         elif newMode == RF69_MODE_SYNTH:
-            self.writeReg(REG_OPMODE, (self.readReg(REG_OPMODE) & 0xE3) | RF_OPMODE_SYNTHESIZER)
+            self.writeReg(REG_OPMODE, (self.getReg(REG_OPMODE) & 0xE3) | RF_OPMODE_SYNTHESIZER)
         elif newMode == RF69_MODE_STANDBY:
-            self.writeReg(REG_OPMODE, (self.readReg(REG_OPMODE) & 0xE3) | RF_OPMODE_STANDBY)
+            self.writeReg(REG_OPMODE, (self.getReg(REG_OPMODE) & 0xE3) | RF_OPMODE_STANDBY)
         elif newMode == RF69_MODE_SLEEP:
-            self.writeReg(REG_OPMODE, (self.readReg(REG_OPMODE) & 0xE3) | RF_OPMODE_SLEEP)
+            self.writeReg(REG_OPMODE, (self.getReg(REG_OPMODE) & 0xE3) | RF_OPMODE_SLEEP)
         else:
             return
 
         # we are using packet mode, so this check is not really needed
         # but waiting for mode ready is necessary when going from sleep because the FIFO may not be immediately available from previous mode
-        while self.mode == RF69_MODE_SLEEP and self.readReg(REG_IRQFLAGS1) & RF_IRQFLAGS1_MODEREADY == 0x00:
-            pass
+        if self.mode == RF69_MODE_SLEEP:
+            self.waitReg("modeReady", REG_IRQFLAGS1, RF_IRQFLAGS1_MODEREADY)
 
         self.mode = newMode;
 
@@ -188,24 +538,115 @@ class RFM69(object):
         if powerLevel > 31:
             powerLevel = 31
         self.powerLevel = powerLevel
-        self.writeReg(REG_PALEVEL, (self.readReg(REG_PALEVEL) & 0xE0) | self.powerLevel)
+        self.writeReg(REG_PALEVEL, (self.getReg(REG_PALEVEL) & 0xE0) | self.powerLevel)
+        self.powerDbm = paDbm(self.shadow[REG_PALEVEL], self.paBoost)
+
+    # output power in dBm, limited to -18 to +13dBm (RFM69HW -2 to +20dBm), returns the power that was set
+    def setPowerDbm(self, dbm):
+        low, high = POWER_RANGE[bool(self.isRFM69HW)]
+        with self.lock:
+            self.powerDbm = max(low, min(high, int(round(dbm))))
+            self.applyPower(self.powerDbm)
+        return self.powerDbm
+
+    # only writes the PA registers that differ from the shadow, the TESTPA registers follow in setMode
+    def applyPower(self, dbm):
+        paLevel, ocp, boost = PA_SETTINGS[bool(self.isRFM69HW)][dbm]
+        if self.shadow[REG_PALEVEL] != paLevel:
+            self.writeReg(REG_PALEVEL, paLevel)
+        if self.shadow[REG_OCP] != ocp:
+            self.writeReg(REG_OCP, ocp)
+        self.paBoost = boost
+        self.powerLevel = paLevel & 0x1F
 
     def canSend(self):
-        if self.mode == RF69_MODE_STANDBY:
-            self.receiveBegin()
-            return True
-        #if signal stronger than -100dBm is detected assume channel activity
-        elif self.mode == RF69_MODE_RX and self.PAYLOADLEN == 0 and self.readRSSI() < CSMA_LIMIT:
-            self.setMode(RF69_MODE_STANDBY)
+        if self.channelClear():
+            if self.mode != RF69_MODE_LISTEN:
+                self.setMode(RF69_MODE_STANDBY)
             return True
         return False
 
-    def send(self, toAddress, buff = "", requestACK = False):
-        self.writeReg(REG_PACKETCONFIG2, (self.readReg(REG_PACKETCONFIG2) & 0xFB) | RF_PACKET2_RXRESTART)
-        now = time.time()
-        while (not self.canSend()) and time.time() - now < RF69_CSMA_LIMIT_S:
-            self.receiveDone()
-        self.sendFrame(toAddress, buff, requestACK, False)
+    # clear channel assessment, every one of csmaSamples forced RSSI readings has to be below the threshold
+    def channelClear(self):
+        # no RSSI while the chip sleeps between listen windows, startFrame takes it out of listen mode
+        if self.mode == RF69_MODE_LISTEN:
+            return True
+        if self.mode != RF69_MODE_RX:
+            self.receiveBegin()
+        threshold = self.csmaLimit()
+        for i in range(self.csmaSamples):
+            rssi = self.sampleRSSI()
+            if rssi is None:
+                return False
+            self.trackNoiseFloor(rssi)
+            if rssi >= threshold:
+                return False
+        return True
+
+    # readRSSI(True) with the done flag and the value in one burst, RSSICONFIG and RSSIVALUE are adjacent
+    # None if the reading doesn't finish within RF69_RSSI_TIMEOUT_S, csmaSend holds the lock meanwhile
+    def sampleRSSI(self):
+        self.writeReg(REG_RSSICONFIG, RF_RSSI_START)
+        deadline = time.monotonic() + RF69_RSSI_TIMEOUT_S
+        while True:
+            config, value = self.readBurst(REG_RSSICONFIG, 2)
+            if config & RF_RSSI_DONE:
+                return -value >> 1
+            if time.monotonic() > deadline:
+                self.rssiTimeouts += 1
+                return None
+
+    def csmaLimit(self):
+        if self.csmaAdaptive and self.noiseFloor is not None:
+            return self.noiseFloor + self.csmaMargin
+        return self.csmaThreshold
+
+    def trackNoiseFloor(self, rssi):
+        if self.noiseFloor is None:
+            self.noiseFloor = rssi
+        # follows quiet readings quickly and busy ones slowly, so traffic doesn't raise it much
+        elif rssi < self.noiseFloor:
+            self.noiseFloor += (rssi - self.noiseFloor) / 4
+        else:
+            self.noiseFloor += (rssi - self.noiseFloor) / 64
+
+    # seconds to back off after the attempt'th busy assessment in a row
+    def csmaBackoffTime(self, attempt):
+        window = min(self.csmaMinWindow << min(attempt - 1, 16), self.csmaMaxWindow)
+        return self.random.randint(1, window) * self.csmaSlot
+
+    def send(self, toAddress, buff = "", requestACK = False, sequence = 0, flags = 0):
+        self.csmaSend(toAddress, buff, requestACK, False, sequence, flags)
+
+    # sends once the channel is clear, or anyway after RF69_CSMA_LIMIT_S
+    # the lock is released while backing off so the interrupt handler can pick up what's on the air
+    def csmaSend(self, toAddress, buff, requestACK, sendACK, sequence = 0, flags = 0):
+        start = time.monotonic()
+        defers = 0
+        backoff = 0.0
+        while True:
+            with self.lock:
+                if defers == 0 and not sendACK:
+                    self.writeReg(REG_PACKETCONFIG2, (self.getReg(REG_PACKETCONFIG2) & 0xFB) | RF_PACKET2_RXRESTART)
+                clear = self.channelClear()
+                if clear or time.monotonic() - start >= RF69_CSMA_LIMIT_S:
+                    self.lastCsma = {"defers": defers, "backoff": backoff, "wait": time.monotonic() - start,
+                                     "threshold": self.csmaLimit(), "forced": not clear}
+                    self.csmaSends += 1
+                    self.csmaDefers += defers
+                    self.csmaBackoff += backoff
+                    if not clear:
+                        self.csmaForced += 1
+                    if self.metrics:
+                        self.metrics.observe("wait:csma", time.monotonic() - start)
+                    self.sendFrame(toAddress, buff, requestACK, sendACK, sequence, flags)
+                    return
+            defers += 1
+            if self.metrics:
+                self.metrics.count("csmaDeferrals")
+            delay = self.csmaBackoffTime(defers)
+            backoff += delay
+            time.sleep(delay)
 
 #    to increase the chance of getting a packet across, call this function instead of send
 #    and it handles all the ACK requesting/retrying for you :)
@@ -214,18 +655,105 @@ class RFM69(object):
 #    requires user action to read the received data and decide what to do with it
 #    replies usually take only 5-8ms at 50kbps
 
-    def sendWithRetry(self, toAddress, buff = "", retries = 3, retryWaitTime = 10):
-        for i in range(0, retries):
-            self.send(toAddress, buff, True)
-            sentTime = time.time()
-            while (time.time() - sentTime) * 1000 < retryWaitTime:
-                if self.ACKReceived(toAddress):
-                    return True
-                # Delay needed for code stability (no idea why)
-                # Otherwise, the ACK message is received but will not be regarded by this code
-                # This still isn't 100% stable though, occasionally received ACKs are still ignored
-                time.sleep(0.01)
-        return False
+    def sendWithRetry(self, toAddress, buff = "", retries = 3, retryWaitTime = 10, flags = 0):
+        return self.sendReliable(toAddress, buff, retries, retryWaitTime, flags).result()
+
+#    same as sendWithRetry but doesn't block, returns a concurrent.futures.Future that resolves to True
+#    when the ACK arrives or False once all retries went unanswered
+#    ACKs are matched by the interrupt handler, so sends to different peers overlap
+#    and up to maxInFlight sends per peer are outstanding (the rest wait their turn)
+
+    def sendReliable(self, toAddress, buff = "", retries = 3, retryWaitTime = 10, flags = 0):
+        # a payload that can't be sent fails here rather than on the retry thread
+        message = ReliableSend(toAddress, self.payload(buff), retries, retryWaitTime, flags)
+        with self.retryReady:
+            if self.retryThread is None:
+                self.retryThread = threading.Thread(target=self.retryLoop, daemon=True)
+                self.retryThread.start()
+            limit = self.maxInFlight if self.sequenceNumbers else 1
+            if self.inFlight.get(toAddress, 0) >= limit:
+                self.waiting.setdefault(toAddress, deque()).append(message)
+            else:
+                self.startReliable(message)
+        return message.future
+
+    # called with retryReady held
+    def startReliable(self, message):
+        peer = message.toAddress
+        if self.sequenceNumbers:
+            # 1-15, an ACK with sequence 0 comes from a peer that doesn't echo sequence numbers
+            sequence = self.nextSequence.get(peer, 0)
+            while True:
+                sequence = sequence % RF69_CTL_SEQUENCE + 1
+                if (peer, sequence) not in self.pending:
+                    break
+            self.nextSequence[peer] = sequence
+            message.sequence = sequence
+        self.pending[(peer, message.sequence)] = message
+        self.inFlight[peer] = self.inFlight.get(peer, 0) + 1
+        self.scheduleRetry(message, 0)
+
+    def scheduleRetry(self, message, delay):
+        self.retryCount += 1
+        heapq.heappush(self.retryQueue, (time.monotonic() + delay, self.retryCount, message))
+        self.retryReady.notify()
+
+    # called with retryReady held, frees the peer's slot for the next waiting send
+    def finishReliable(self, message):
+        self.pending.pop((message.toAddress, message.sequence), None)
+        peer = message.toAddress
+        self.inFlight[peer] -= 1
+        waiting = self.waiting.get(peer)
+        if waiting:
+            self.startReliable(waiting.popleft())
+
+    def retryLoop(self):
+        while True:
+            with self.retryReady:
+                while not self.retryQueue or self.retryQueue[0][0] > time.monotonic():
+                    self.retryReady.wait(self.retryQueue[0][0] - time.monotonic() if self.retryQueue else None)
+                message = heapq.heappop(self.retryQueue)[2]
+                if message.future.done():
+                    continue
+                if message.attempts == 0:
+                    self.finishReliable(message)
+                    failed = True
+                else:
+                    message.attempts -= 1
+                    failed = False
+            if failed:
+                message.future.set_result(False)
+                continue
+            if message.tries and self.powerControl is not None:
+                self.powerControl.missed(message.toAddress, self.powerControl.powerFor(message.toAddress, self.powerDbm),
+                                         *POWER_RANGE[bool(self.isRFM69HW)])
+            message.tries += 1
+            try:
+                self.send(message.toAddress, message.buff, True, message.sequence, message.flags)
+            except Exception as error:
+                # the send fails, not the thread, later sends still need it
+                with self.retryReady:
+                    self.finishReliable(message)
+                message.future.set_exception(error)
+                continue
+            with self.retryReady:
+                self.scheduleRetry(message, message.retryWaitTime / 1000.0)
+
+    # completes the reliable send this ACK belongs to, returns False if nothing was waiting for it
+    def matchACK(self, packet):
+        with self.retryReady:
+            message = self.pending.get((packet.sender, packet.sequence))
+            if message is None and packet.sequence == 0:
+                # peer doesn't echo sequence numbers, take its oldest outstanding send
+                for key in self.pending:
+                    if key[0] == packet.sender:
+                        message = self.pending[key]
+                        break
+            if message is None:
+                return False
+            self.finishReliable(message)
+        message.future.set_result(True)
+        return True
 
     def ACKReceived(self, fromNodeID):
         if self.receiveDone():
@@ -235,136 +763,611 @@ class RFM69(object):
     def ACKRequested(self):
         return self.ACK_REQUESTED and self.TARGETID != RF69_BROADCAST_ADDR
 
-    def sendACK(self, toAddress = 0, buff = ""):
+    # rssi is what the acknowledged frame arrived with, reported back with reportRssi on (the last frame's by default)
+    def sendACK(self, toAddress = 0, buff = "", sequence = None, rssi = None):
         toAddress = toAddress if toAddress > 0 else self.SENDERID
-        while not self.canSend():
-            self.receiveDone()
-        self.sendFrame(toAddress, buff, False, True)
+        # echo the sequence number of the frame we're acknowledging
+        sequence = self.SEQUENCE if sequence is None else sequence
+        buff, flags = self.ackPayload(buff, rssi)
+        self.csmaSend(toAddress, buff, False, True, sequence, flags)
+
+    # the ACK payload and control flags, with the RSSI report as the last byte if reportRssi is on
+    def ackPayload(self, buff, rssi):
+        if not self.reportRssi:
+            return buff, 0
+        if isinstance(buff, str):
+            buff = buff.encode(self.encoding)
+        rssi = self.RSSI if rssi is None else rssi
+        return bytes(buff)[:self.maxDataLen - 1] + bytes([max(-128, min(127, int(rssi))) & 0xFF]), RF69_CTL_LINKINFO
+
+    # ACKs can't be sent from the interrupt thread, it has to deliver PACKETSENT while the frame goes out
+    def resendACK(self, packet):
+        with self.ackReady:
+            if self.ackThread is None:
+                self.ackThread = threading.Thread(target=self.ackLoop, daemon=True)
+                self.ackThread.start()
+            self.ackQueue.append(packet)
+            self.ackReady.notify()
+
+    def ackLoop(self):
+        while True:
+            with self.ackReady:
+                while not self.ackQueue:
+                    self.ackReady.wait()
+                packet = self.ackQueue.popleft()
+            try:
+                self.sendACK(packet.sender, sequence=packet.sequence, rssi=packet.rssi)
+            except Exception:
+                # one failed ACK mustn't stop the ones after it
+                self.ackFailures += 1
+
+    # flags are extra control byte bits, like RF69_CTL_TRANSFER
+    def sendFrame(self, toAddress, buff, requestACK, sendACK, sequence = 0, flags = 0):
+        timeout = self.startFrame(toAddress, buff, requestACK, sendACK, sequence, flags)
+        start = time.perf_counter()
+        try:
+            if self.txStream:
+                self.streamFrame(time.monotonic() + timeout)
+            # only go back to polling the flag if the interrupt didn't arrive in time, and not for ever,
+            # the lock is held and everything else that needs the radio waits for it
+            if not self.txDone.wait(timeout):
+                deadline = time.monotonic() + timeout
+                spins = 0
+                while not self.frameSent():
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"the frame to {toAddress} wasn't sent within {2 * timeout:.3f}s")
+                    spins += 1
+                if self.metrics:
+                    self.metrics.count("txInterruptsMissed")
+                    self.metrics.waited("packetSentPoll", time.perf_counter() - start, spins)
+            if self.metrics:
+                self.metrics.observe("wait:packetSent", time.perf_counter() - start)
+        finally:
+            self.finishFrame()
+
+    # bytes, bytearray and memoryview are copied straight into the frame buffer, text is encoded first
+    def payload(self, buff):
+        if isinstance(buff, str):
+            return buff.encode(self.encoding)
+        if not isinstance(buff, (bytes, bytearray, memoryview)):
+            return bytes(buff)
+        return buff
 
-    def sendFrame(self, toAddress, buff, requestACK, sendACK):
+    # fills the FIFO and starts transmitting, returns how long to wait for PACKETSENT
+    def startFrame(self, toAddress, buff, requestACK, sendACK, sequence = 0, flags = 0):
         #turn off receiver to prevent reception while filling fifo
         self.setMode(RF69_MODE_STANDBY)
         #wait for modeReady
-        while (self.readReg(REG_IRQFLAGS1) & RF_IRQFLAGS1_MODEREADY) == 0x00:
-            pass
+        self.waitReg("modeReady", REG_IRQFLAGS1, RF_IRQFLAGS1_MODEREADY)
 
-        if (len(buff) > RF69_MAX_DATA_LEN):
-            buff = buff[0:RF69_MAX_DATA_LEN]
+        buff = self.payload(buff)
+        length = min(len(buff), self.maxDataLen)
 
-        ack = 0
+        ack = (sequence & RF69_CTL_SEQUENCE) | flags
         if sendACK:
-            ack = 0x80
+            ack |= RF69_CTL_SENDACK
         elif requestACK:
-            ack = 0x40
-        if isinstance(buff, str):
-            self.spi.xfer2([REG_FIFO | 0x80, len(buff) + 3, toAddress, self.address, ack] + [int(ord(i)) for i in list(buff)])
-        else:
-            self.spi.xfer2([REG_FIFO | 0x80, len(buff) + 3, toAddress, self.address, ack] + buff)
+            ack |= RF69_CTL_REQACK
+        frame = self.txBuffer
+        frame[1] = length + 3
+        frame[2] = toAddress
+        frame[3] = self.address
+        frame[4] = ack
+        frame[5:5 + length] = memoryview(buff).cast("B")[:length]
+
+        if self.powerControl is not None:
+            self.applyPower(self.powerControl.powerFor(toAddress, self.powerDbm))
 
         self.DATASENT = False
-        self.setMode(RF69_MODE_TX)
-        while (self.readReg(REG_IRQFLAGS2) & RF_IRQFLAGS2_PACKETSENT) == 0x00:
-            pass
-        self.setMode(RF69_MODE_RX)
+        #set DIO0 to "PACKETSENT" in transmit mode, the interrupt handler wakes us up when the frame is out
+        self.writeReg(REG_DIOMAPPING1, RF_DIOMAPPING1_DIO0_00)
+        self.txDone.clear()
+        # a long frame starts with a full FIFO, streamFrame writes the rest
+        first = min(length + 5, RF69_FIFO_SIZE + 1)
+        self.txStream = (first, length + 5) if first < length + 5 else None
+        self.fifoLevelLow.clear()
+        if self.autoModeTx:
+            # the chip switches to TX by itself once the FIFO isn't empty and back to standby right after PACKETSENT
+            self.writeReg(REG_AUTOMODES, RF_AUTOMODES_ENTER_FIFONOTEMPTY | RF_AUTOMODES_EXIT_PACKETSENT | RF_AUTOMODES_INTERMEDIATE_TRANSMITTER)
+            if self.isRFM69HW:
+                self.setHighPowerRegs(self.paBoost)
+            # before the FIFO write, PACKETSENT can come right after it and the interrupt handler goes by the mode
+            self.mode = RF69_MODE_TX
+            self.writeFifo(first)
+        else:
+            self.writeFifo(first)
+            self.setMode(RF69_MODE_TX)
+        return 2 * self.timeOnAir(length + 3) + 0.01
+
+    # writes the rest of a long frame, a chunk each time the FIFO has drained below the threshold
+    def streamFrame(self, deadline):
+        offset, end = self.txStream
+        self.txStream = None
+        chunk = RF69_FIFO_SIZE - self.fifoThreshold - 1
+        # time to send one chunk, with room for interrupt latency
+        timeout = 2 * (self.timeOnAir(chunk) - self.timeOnAir(0)) + 0.001
+        while offset < end:
+            # the flag is checked first, the edge may have come and gone while the last chunk was written
+            while self.readReg(REG_IRQFLAGS2) & RF_IRQFLAGS2_FIFOLEVEL:
+                if time.monotonic() > deadline:
+                    return
+                if not self.fifoLevelLow.wait(timeout) and self.metrics:
+                    self.metrics.count("fifoInterruptsMissed")
+                self.fifoLevelLow.clear()
+            n = min(chunk, end - offset)
+            self.spiTransactions += 1
+            self.transport.write(bytes((REG_FIFO | 0x80,)) + self.txBuffer[offset:offset + n])
+            offset += n
+
+    def frameSent(self):
+        if self.autoModeTx:
+            # PACKETSENT is cleared again as soon as the sequencer leaves TX, it's done when AUTOMODE drops
+            flags1, flags2 = self.readBurst(REG_IRQFLAGS1, 2)
+            return flags2 & RF_IRQFLAGS2_PACKETSENT or not flags1 & RF_IRQFLAGS1_AUTOMODE
+        return self.readReg(REG_IRQFLAGS2) & RF_IRQFLAGS2_PACKETSENT
+
+    def finishFrame(self):
+        if self.autoModeTx:
+            # must be off before RX, a received byte in the FIFO would otherwise start a transmission
+            self.writeReg(REG_AUTOMODES, RF_AUTOMODES_ENTER_OFF | RF_AUTOMODES_EXIT_OFF)
+        self.resumeReceive()
+        self.writeReg(REG_DIOMAPPING1, RF_DIOMAPPING1_DIO0_01)
+
+    def timeOnAir(self, length, bitrate = None):
+        # seconds to send preamble, sync word, length byte, frame of length bytes and CRC at the current (or the given) bit rate
+        if bitrate is None:
+            bitrate = RF69_FXOSC / ((self.shadow[REG_BITRATEMSB] << 8) | self.shadow[REG_BITRATELSB])
+        preamble = (self.shadow[REG_PREAMBLEMSB] << 8) | self.shadow[REG_PREAMBLELSB]
+        sync = ((self.shadow[REG_SYNCCONFIG] >> 3) & 0x07) + 1
+        return (preamble + sync + 1 + length + 2) * 8 / bitrate
 
     def interruptHandler(self, pin):
-        self.intLock = True
+        if self.metrics:
+            self.metrics.count("interrupts")
         self.DATASENT = True
-        if self.mode == RF69_MODE_RX and self.readReg(REG_IRQFLAGS2) & RF_IRQFLAGS2_PAYLOADREADY:
-            self.setMode(RF69_MODE_STANDBY)
-            self.PAYLOADLEN, self.TARGETID, self.SENDERID, CTLbyte = self.spi.xfer2([REG_FIFO & 0x7f,0,0,0,0])[1:]
-            if self.PAYLOADLEN > 66:
-                self.PAYLOADLEN = 66
-            if not (self.promiscuousMode or self.TARGETID == self.address or self.TARGETID == RF69_BROADCAST_ADDR):
-                self.PAYLOADLEN = 0
-                self.intLock = False
+        if self.mode == RF69_MODE_TX:
+            # the sender holds the lock while it waits for this
+            self.txDone.set()
+            for hook in self.txHooks:
+                hook()
+            return
+        with self.lock:
+            self.intLock = True
+            packet = self.readFrame()
+            self.intLock = False
+        if packet is None:
+            return
+        packet, reported = self.handleLinkInfo(packet)
+        # ACKs for reliable sends are consumed here, everything else goes to the receive buffer unless a handler takes it
+        if packet.ackReceived:
+            for hook in self.ackHooks:
+                hook(packet, reported)
+            if self.matchACK(packet):
+                self.forgetFrame()
+                return
+        if self.dedup is not None and packet.sequence and not packet.ackReceived and self.dedup.seen(packet):
+            self.forgetFrame()
+            if self.metrics:
+                self.metrics.count("duplicatesDropped")
+            # the sender didn't get our ACK, it needs another one but the application already has the payload
+            # (frames for other nodes, heard in promiscuous mode, are theirs to acknowledge)
+            if packet.ackRequested and packet.target == self.address:
+                self.resendACK(packet)
+            return
+        for handler in self.packetHandlers:
+            if handler(packet):
                 return
-            self.DATALEN = self.PAYLOADLEN - 3
-            self.ACK_RECEIVED = CTLbyte & 0x80
-            self.ACK_REQUESTED = CTLbyte & 0x40
+        self.queuePacket(packet)
 
-            self.DATA = self.spi.xfer2([REG_FIFO & 0x7f] + [0 for i in range(0, self.DATALEN)])[1:]
+    # takes the RSSI report off the end of a RF69_CTL_LINKINFO frame, for ACKs it (or an estimate from the ACK's RSSI)
+    # goes to powerControl. Returns the packet without it and the report or None
+    def handleLinkInfo(self, packet):
+        reported = None
+        if packet.ctl & RF69_CTL_LINKINFO and packet.data:
+            reported = packet.data[-1] - 256 if packet.data[-1] > 127 else packet.data[-1]
+            packet = packet._replace(data=packet.data[:-1])
+        control = self.powerControl
+        if control is not None and packet.ackReceived and packet.target == self.address:
+            current = control.powerFor(packet.sender, self.powerDbm)
+            low, high = POWER_RANGE[bool(self.isRFM69HW)]
+            if reported is None:
+                # same path loss both ways
+                peerDbm = self.powerDbm if control.peerDbm is None else control.peerDbm
+                control.update(packet.sender, current - (peerDbm - packet.rssi), current, low, high, estimated=True)
+            else:
+                control.update(packet.sender, reported, current, low, high)
+        return packet, reported
 
-            self.RSSI = self.readRSSI()
-            #print(f"received {self.PAYLOADLEN} raw bytes from {self.SENDERID} ack={self.ACK_RECEIVED}")
-        self.intLock = False
+    # clears the legacy receiveDone() fields, also for frames the interrupt handler consumed itself
+    def forgetFrame(self):
+        with self.lock:
+            self.DATALEN = 0
+            self.SENDERID = 0
+            self.TARGETID = 0
+            self.PAYLOADLEN = 0
+            self.ACK_REQUESTED = 0
+            self.ACK_RECEIVED = 0
+            self.SEQUENCE = 0
+            self.RSSI = 0
+
+    def readFrame(self):
+        if self.mode != RF69_MODE_RX and self.mode != RF69_MODE_LISTEN:
+            return None
+        # RSSIVALUE up to IRQFLAGS2 in one burst, so the RSSI is sampled while the receiver is still on
+        status = self.readBurst(REG_RSSIVALUE, 5)
+        if not status[4] & RF_IRQFLAGS2_PAYLOADREADY:
+            if self.metrics:
+                self.metrics.count("spuriousInterrupts")
+            return None
+        timestamp = time.monotonic()
+        # leaves listen mode too, the FIFO can only be read once the listen sequence is aborted
+        self.setMode(RF69_MODE_STANDBY)
+        # header and the largest possible payload in a single FIFO read, or the rest of a long frame
+        frame = self.readStream() if self.longFrames else self.readFifo()
+        self.PAYLOADLEN, self.TARGETID, self.SENDERID, CTLbyte = frame[1:5]
+        if self.PAYLOADLEN > 66 and not self.longFrames:
+            self.PAYLOADLEN = 66
+        foreign = self.TARGETID != self.address and self.TARGETID != RF69_BROADCAST_ADDR
+        if self.capture is not None:
+            self.capture.record(frame, (-status[0]) >> 1, timestamp, foreign, foreign and not self.promiscuousMode)
+        if foreign and not self.promiscuousMode:
+            self.PAYLOADLEN = 0
+            self.resumeReceive()
+            if self.metrics:
+                self.metrics.count("packetsAddressDropped")
+            return None
+        self.DATALEN = self.PAYLOADLEN - 3
+        self.ACK_RECEIVED = CTLbyte & RF69_CTL_SENDACK
+        self.ACK_REQUESTED = CTLbyte & RF69_CTL_REQACK
+        self.SEQUENCE = CTLbyte & RF69_CTL_SEQUENCE
+        self.DATA = frame[5:5 + self.DATALEN]
+        self.RSSI = (-status[0]) >> 1
+        #print(f"received {self.PAYLOADLEN} raw bytes from {self.SENDERID} ack={self.ACK_RECEIVED}")
+        # keep listening so packets arriving before the application gets to them aren't lost
+        self.resumeReceive()
+        if self.metrics:
+            self.metrics.count("packetsAccepted")
+        return Packet(self.DATA, self.SENDERID, self.TARGETID, CTLbyte, self.RSSI, timestamp)
+
+    # DIO1 in long frame mode, FifoLevel edges wake streamFrame during TX and drain the FIFO during RX
+    def fifoLevelHandler(self, pin):
+        if self.mode == RF69_MODE_TX:
+            self.fifoLevelLow.set()
+            return
+        with self.lock:
+            if self.mode != RF69_MODE_RX or not self.longFrames:
+                return
+            if self.rxStream and self.streamStale():
+                self.rxStream = bytearray()
+            flags = self.readReg(REG_IRQFLAGS2)
+            if flags & RF_IRQFLAGS2_FIFOOVERRUN:
+                # the frame is lost, clearing the flag clears the FIFO
+                self.writeReg(REG_IRQFLAGS2, RF_IRQFLAGS2_FIFOOVERRUN)
+                self.rxStream = bytearray()
+                if self.metrics:
+                    self.metrics.count("fifoOverruns")
+                return
+            # PAYLOADREADY leaves the rest to readFrame
+            while flags & RF_IRQFLAGS2_FIFOLEVEL and not flags & RF_IRQFLAGS2_PAYLOADREADY:
+                self.rxStream += bytes(self.readBurst(REG_FIFO, self.fifoThreshold))
+                self.rxStreamTime = time.monotonic()
+                flags = self.readReg(REG_IRQFLAGS2)
+
+    # a partial frame the chip gave up on (CRC error, restart) stops getting more bytes
+    def streamStale(self):
+        return time.monotonic() - self.rxStreamTime > 4 * (self.timeOnAir(self.fifoThreshold) - self.timeOnAir(0)) + 0.01
+
+    # like readFifo, with the bytes fifoLevelHandler already drained in front
+    def readStream(self):
+        stream = self.rxStream
+        self.rxStream = bytearray()
+        if not stream or self.streamStale():
+            return self.readFifo()
+        remaining = stream[0] + 1 - len(stream)
+        if remaining > 0:
+            stream += bytes(self.readBurst(REG_FIFO, remaining))
+        return b"\x00" + bytes(stream)
+
+    def queuePacket(self, packet):
+        with self.rxReady:
+            self.rxReceived += 1
+            if len(self.rxBuffer) >= self.rxBufferSize:
+                self.rxDropped += 1
+                if self.metrics:
+                    self.metrics.count("rxBufferOverflows")
+                if not self.dropOldest:
+                    return
+                self.rxBuffer.popleft()
+            self.rxBuffer.append(packet)
+            self.rxReady.notify()
+        for hook in self.receiveHooks:
+            hook(packet)
+
+    # next received Packet, or None if nothing arrived within timeout seconds (None waits forever)
+    def recv(self, timeout = None):
+        if self.mode != RF69_MODE_RX and self.mode != RF69_MODE_TX and self.mode != RF69_MODE_LISTEN:
+            with self.lock:
+                self.receiveBegin()
+        with self.rxReady:
+            if self.rxReady.wait_for(lambda: self.rxBuffer, timeout):
+                return self.rxBuffer.popleft()
+        return None
+
+    def __iter__(self):
+        while True:
+            yield self.recv()
 
     def receiveBegin(self):
-        while self.intLock:
-            time.sleep(.1)
-        self.DATALEN = 0
-        self.SENDERID = 0
-        self.TARGETID = 0
-        self.PAYLOADLEN = 0
-        self.ACK_REQUESTED = 0
-        self.ACK_RECEIVED = 0
-        self.RSSI = 0
-        if (self.readReg(REG_IRQFLAGS2) & RF_IRQFLAGS2_PAYLOADREADY):
-            # avoid RX deadlocks
-            self.writeReg(REG_PACKETCONFIG2, (self.readReg(REG_PACKETCONFIG2) & 0xFB) | RF_PACKET2_RXRESTART)
-        #set DIO0 to "PAYLOADREADY" in receive mode
-        self.writeReg(REG_DIOMAPPING1, RF_DIOMAPPING1_DIO0_01)
-        self.setMode(RF69_MODE_RX)
+        if self.intLock:
+            start = time.perf_counter()
+            while self.intLock:
+                time.sleep(.1)
+            if self.metrics:
+                self.metrics.observe("wait:intLock", time.perf_counter() - start)
+        with self.lock:
+            self.forgetFrame()
+            if (self.readReg(REG_IRQFLAGS2) & RF_IRQFLAGS2_PAYLOADREADY):
+                # avoid RX deadlocks
+                if self.metrics:
+                    self.metrics.count("rxRestarts")
+                self.writeReg(REG_PACKETCONFIG2, (self.getReg(REG_PACKETCONFIG2) & 0xFB) | RF_PACKET2_RXRESTART)
+            #set DIO0 to "PAYLOADREADY" in receive mode
+            self.writeReg(REG_DIOMAPPING1, RF_DIOMAPPING1_DIO0_01)
+            self.resumeReceive()
+
+    # back to RX, or to listen mode while listening
+    def resumeReceive(self):
+        if self.listening and not self.listenResume:
+            self.listening = False
+        if not self.listening:
+            self.setMode(RF69_MODE_RX)
+            return
+        if self.mode == RF69_MODE_LISTEN:
+            return
+        # ListenOn may only be set from standby
+        self.setMode(RF69_MODE_STANDBY)
+        if self.isRFM69HW:
+            self.setHighPowerRegs(False)
+        self.writeReg(REG_OPMODE, RF_OPMODE_SEQUENCER_ON | RF_OPMODE_LISTEN_ON | RF_OPMODE_STANDBY)
+        self.mode = RF69_MODE_LISTEN
 
     def receiveDone(self):
-        if (self.mode == RF69_MODE_RX or self.mode == RF69_MODE_STANDBY) and self.PAYLOADLEN > 0:
+        with self.lock:
+            return self.checkReceiveDone()
+
+    def checkReceiveDone(self):
+        if (self.mode == RF69_MODE_RX or self.mode == RF69_MODE_STANDBY or self.mode == RF69_MODE_LISTEN) and self.PAYLOADLEN > 0:
             self.setMode(RF69_MODE_STANDBY)
             return True
+        if self.mode == RF69_MODE_LISTEN:
+            # RX timeouts in listen mode are handled by the chip, it just goes back to idle
+            return False
         if self.readReg(REG_IRQFLAGS1) & RF_IRQFLAGS1_TIMEOUT:
             # https://github.com/russss/rfm69-python/blob/master/rfm69/rfm69.py#L112
             # Russss figured out that if you leave alone long enough it times out
             # tell it to stop being silly and listen for more packets
-            self.writeReg(REG_PACKETCONFIG2, (self.readReg(REG_PACKETCONFIG2) & 0xFB) | RF_PACKET2_RXRESTART)
+            if self.metrics:
+                self.metrics.count("rxTimeoutRestarts")
+            self.writeReg(REG_PACKETCONFIG2, (self.getReg(REG_PACKETCONFIG2) & 0xFB) | RF_PACKET2_RXRESTART)
         elif self.mode == RF69_MODE_RX:
             # already in RX no payload yet
             return False
         self.receiveBegin()
         return False
 
+#    Listen mode: the chip sleeps for idleUs, wakes up for an rxUs RX window and goes back to sleep
+#    unless it sees a signal above RSSITHRESH, so the host doesn't need to poll and the radio draws
+#    about rxUs / (idleUs + rxUs) of its RX current. Received packets arrive through the interrupt handler
+#    as usual, with resume the chip goes back to listening after each packet, otherwise it stays in RX.
+#    Senders have to cover a whole listen period, see listenModeSend.
+
+    def listenModeStart(self, idleUs, rxUs, resume = True):
+        (idleResolution, idleBits, _), idleCoef = listenCoefficient(idleUs)
+        (rxResolution, _, rxBits), rxCoef = listenCoefficient(rxUs)
+        resolution = idleBits | rxBits
+        timing = self.listenModeTiming(idleResolution * idleCoef, rxResolution * rxCoef)
+        # a wake up on noise must not keep the receiver on, give up once a long preamble and frame would have passed.
+        # RXTIMEOUT2 counts in 16 bit periods, a shorter timeout would cut off the sender's preamble
+        bitTime = ((self.shadow[REG_BITRATEMSB] << 8) | self.shadow[REG_BITRATELSB]) / RF69_FXOSC
+        frameTime = self.timeOnAir(RF69_MAX_DATA_LEN + 3)
+        timeout = int((timing["period"] + frameTime) / (16 * bitTime)) + 1
+        if timeout > 255:
+            raise ValueError(f"a {timing['period']:.3f}s listen period is too long for the RX timeout at this bit rate, "
+                             f"at most {255 * 16 * bitTime - frameTime:.3f}s fits")
+        self.listenTiming = timing
+        with self.lock:
+            self.setMode(RF69_MODE_STANDBY)
+            # wake on RSSI, stay in RX until PayloadReady or timeout and then go back to idle
+            self.writeBurst(REG_LISTEN1, [resolution | RF_LISTEN1_CRITERIA_RSSI | RF_LISTEN1_END_10, idleCoef, rxCoef])
+            self.writeReg(REG_RXTIMEOUT2, timeout)
+            self.writeReg(REG_DIOMAPPING1, RF_DIOMAPPING1_DIO0_01)
+            self.listening = True
+            self.listenResume = resume
+            self.resumeReceive()
+        return self.listenTiming
+
+    def listenModeEnd(self):
+        with self.lock:
+            self.listening = False
+            self.setMode(RF69_MODE_STANDBY)
+            self.writeReg(REG_RXTIMEOUT2, RF_RXTIMEOUT2_RSSITHRESH_VALUE)
+            self.receiveBegin()
+
+    # ListenOn has to be cleared together with ListenAbort, the mode bits say where the chip ends up
+    def listenModeAbort(self):
+        self.writeReg(REG_OPMODE, RF_OPMODE_SEQUENCER_ON | RF_OPMODE_LISTEN_OFF | RF_OPMODE_LISTENABORT | RF_OPMODE_STANDBY)
+        self.writeReg(REG_OPMODE, RF_OPMODE_SEQUENCER_ON | RF_OPMODE_LISTEN_OFF | RF_OPMODE_STANDBY)
+        self.mode = RF69_MODE_STANDBY
+
+    # seconds per listen cycle, fraction of time in RX and how long a sender may have to wait for the receiver to wake up
+    def listenModeTiming(self, idleUs, rxUs):
+        idle = idleUs / 1000000.0
+        rx = rxUs / 1000000.0
+        return {"idle": idle, "rx": rx, "period": idle + rx, "dutyCycle": rx / (idle + rx),
+                "maxLatency": idle + rx, "meanLatency": (idle + rx) / 2}
+
+    # send to a node in listen mode, the preamble is stretched to span a full listen period so the
+    # receiver is sure to wake up while it's on the air
+    def listenModeSend(self, toAddress, buff = "", requestACK = False, period = None):
+        period = period if period is not None else self.listenTiming["period"]
+        bitrate = RF69_FXOSC / ((self.shadow[REG_BITRATEMSB] << 8) | self.shadow[REG_BITRATELSB])
+        preamble = min(0xFFFF, int(period * bitrate / 8) + RF_PREAMBLESIZE_LSB_VALUE)
+        with self.lock:
+            previous = [self.shadow[REG_PREAMBLEMSB], self.shadow[REG_PREAMBLELSB]]
+            self.writeBurst(REG_PREAMBLEMSB, [preamble >> 8, preamble & 0xFF])
+            try:
+                self.send(toAddress, buff, requestACK)
+            finally:
+                self.writeBurst(REG_PREAMBLEMSB, previous)
+
     def readRSSI(self, forceTrigger = False):
         rssi = 0
         if forceTrigger:
             self.writeReg(REG_RSSICONFIG, RF_RSSI_START)
-            while self.readReg(REG_RSSICONFIG) & RF_RSSI_DONE == 0x00:
-                pass
+            self.waitReg("rssiDone", REG_RSSICONFIG, RF_RSSI_DONE)
         rssi = self.readReg(REG_RSSIVALUE) * -1
         rssi = rssi >> 1
         return rssi
 
     def encrypt(self, key):
         self.setMode(RF69_MODE_STANDBY)
+        if isinstance(key, str):
+            key = key.encode(self.encoding)
         if key != 0 and len(key) == 16:
-            self.spi.xfer([REG_AESKEY1 | 0x80] + [int(ord(i)) for i in list(key)])
-            self.writeReg(REG_PACKETCONFIG2,(self.readReg(REG_PACKETCONFIG2) & 0xFE) | RF_PACKET2_AES_ON)
+            if self.longFrames:
+                raise ValueError("AES only works on frames that fit in the FIFO, turn long frames off first")
+            self.writeBurst(REG_AESKEY1, list(key))
+            self.writeReg(REG_PACKETCONFIG2,(self.getReg(REG_PACKETCONFIG2) & 0xFE) | RF_PACKET2_AES_ON)
         else:
-            self.writeReg(REG_PACKETCONFIG2,(self.readReg(REG_PACKETCONFIG2) & 0xFE) | RF_PACKET2_AES_OFF)
+            self.writeReg(REG_PACKETCONFIG2,(self.getReg(REG_PACKETCONFIG2) & 0xFE) | RF_PACKET2_AES_OFF)
+
+    # frames of up to RF69_MAX_LONG_DATA_LEN bytes, streamed through the FIFO whenever it crosses threshold bytes.
+    # Needs AES off and DIO1 connected (dio1Pin), both ends need it on for frames over RF69_MAX_DATA_LEN.
+    # In listen mode the FIFO can't be drained, only frames that fit in it are received there.
+    def setLongFrames(self, onOff, threshold = 32):
+        if not 0 < threshold < RF69_FIFO_SIZE - 1:
+            raise ValueError(f"FIFO threshold must be between 1 and {RF69_FIFO_SIZE - 2}")
+        with self.lock:
+            if onOff and self.getReg(REG_PACKETCONFIG2) & RF_PACKET2_AES_ON:
+                raise ValueError("AES only works on frames that fit in the FIFO, turn encryption off first")
+            self.setMode(RF69_MODE_STANDBY)
+            if onOff:
+                # both edges, FifoLevel falling means room for more during TX
+                self.transport.attachInterrupt(self.fifoLevelHandler, dio=1, both=True)
+            else:
+                self.transport.detachInterrupt(dio=1)
+            self.longFrames = onOff
+            self.maxDataLen = RF69_MAX_LONG_DATA_LEN if onOff else RF69_MAX_DATA_LEN
+            self.fifoThreshold = threshold if onOff else RF_FIFOTHRESH_VALUE
+            self.rxStream = bytearray()
+            # PAYLOADLENGTH is the longest frame the receiver accepts
+            self.writeReg(REG_PAYLOADLENGTH, 255 if onOff else 66)
+            self.writeReg(REG_FIFOTHRESH, RF_FIFOTHRESH_TXSTART_FIFONOTEMPTY | self.fifoThreshold)
+            self.receiveBegin()
 
     def readReg(self, addr):
-        return self.spi.xfer([addr & 0x7F, 0])[1]
+        self.spiTransactions += 1
+        return self.transport.xfer([addr & 0x7F, 0])[1]
 
     def writeReg(self, addr, value):
-        self.spi.xfer([addr | 0x80, value])
+        self.spiTransactions += 1
+        self.transport.xfer([addr | 0x80, value])
+        self.shadow[addr] = value & SHADOW_MASK[addr]
+
+    # spins until the mask bits in addr are set (or cleared), timed under name when instrumented
+    def waitReg(self, name, addr, mask, clear = False):
+        start = time.perf_counter() if self.metrics else 0
+        spins = 0
+        if clear:
+            while self.readReg(addr) & mask:
+                spins += 1
+        else:
+            while self.readReg(addr) & mask == 0x00:
+                spins += 1
+        if self.metrics:
+            self.metrics.waited(name, time.perf_counter() - start, spins)
+
+    # driver counters, plus RFM69stats metrics while instrumented
+    def stats(self):
+        with self.rxReady:
+            snapshot = {"spiTransactions": self.spiTransactions, "rxReceived": self.rxReceived, "rxDropped": self.rxDropped,
+                        "rxBuffered": len(self.rxBuffer)}
+        with self.retryReady:
+            snapshot["reliablePending"] = len(self.pending)
+        snapshot["ackFailures"] = self.ackFailures
+        snapshot["shadowMismatches"] = self.shadowMismatches
+        snapshot.update(csmaSends=self.csmaSends, csmaDefers=self.csmaDefers, csmaBackoff=self.csmaBackoff, csmaForced=self.csmaForced,
+                        rssiTimeouts=self.rssiTimeouts)
+        if self.noiseFloor is not None:
+            snapshot["noiseFloor"] = self.noiseFloor
+        if self.dedup is not None:
+            snapshot.update(self.dedup.stats())
+        if self.capture is not None:
+            snapshot.update(self.capture.stats())
+        snapshot["powerDbm"] = self.powerDbm
+        if self.powerControl is not None:
+            snapshot.update(self.powerControl.stats())
+        if self.metrics:
+            snapshot["metrics"] = self.metrics.snapshot()
+        return snapshot
+
+    # register value for read-modify-write, from the shadow unless the register is volatile
+    def getReg(self, addr):
+        if addr in RF69_VOLATILE_REGS:
+            return self.readReg(addr)
+        if self.shadowCheck:
+            value = self.readReg(addr) & SHADOW_MASK[addr]
+            if value != self.shadow[addr]:
+                # runs on the interrupt thread too, so it's only recorded: (register, shadow, chip)
+                self.shadowMismatches += 1
+                self.lastShadowMismatch = (addr, self.shadow[addr], value)
+                self.shadow[addr] = value
+        return self.shadow[addr]
+
+    # burst access, the chip auto increments the address (except for the FIFO)
+    def readBurst(self, addr, length):
+        self.spiTransactions += 1
+        return self.transport.xfer([addr & 0x7F] + [0] * length)[1:]
+
+    # the whole FIFO in one transaction, index 0 is the dummy byte clocked out with the address
+    def readFifo(self):
+        self.spiTransactions += 1
+        return bytes(self.transport.xfer(self.fifoRequest))
+
+    # first length bytes of txBuffer, written without converting to a list
+    def writeFifo(self, length):
+        self.spiTransactions += 1
+        self.transport.write(memoryview(self.txBuffer)[:length])
+
+    def writeBurst(self, addr, values):
+        self.spiTransactions += 1
+        self.transport.xfer([addr | 0x80] + values)
+        if addr != REG_FIFO:
+            for i, value in enumerate(values):
+                self.shadow[addr + i] = value & SHADOW_MASK[addr + i]
 
     def promiscuous(self, onOff):
         self.promiscuousMode = onOff
 
     def setHighPower(self, onOff):
+        self.paBoost = onOff
         if onOff:
             self.writeReg(REG_OCP, RF_OCP_OFF)
             #enable P1 & P2 amplifier stages
-            self.writeReg(REG_PALEVEL, (self.readReg(REG_PALEVEL) & 0x1F) | RF_PALEVEL_PA1_ON | RF_PALEVEL_PA2_ON)
+            self.writeReg(REG_PALEVEL, (self.getReg(REG_PALEVEL) & 0x1F) | RF_PALEVEL_PA1_ON | RF_PALEVEL_PA2_ON)
         else:
             self.writeReg(REG_OCP, RF_OCP_ON)
             #enable P0 only
-            self.writeReg(REG_PALEVEL, RF_PALEVEL_PA0_ON | RF_PALEVEL_PA1_OFF | RF_PALEVEL_PA2_OFF | powerLevel)
+            self.writeReg(REG_PALEVEL, RF_PALEVEL_PA0_ON | RF_PALEVEL_PA1_OFF | RF_PALEVEL_PA2_OFF | self.powerLevel)
+        self.powerDbm = paDbm(self.shadow[REG_PALEVEL], onOff)
 
     def setHighPowerRegs(self, onOff):
-        if onOff:
-            self.writeReg(REG_TESTPA1, 0x5D)
-            self.writeReg(REG_TESTPA2, 0x7C)
-        else:
-            self.writeReg(REG_TESTPA1, 0x55)
-            self.writeReg(REG_TESTPA2, 0x70)
+        # called on every switch between TX and RX, skip the writes when the shadow already matches
+        pa1, pa2 = (0x5D, 0x7C) if onOff else (0x55, 0x70)
+        if self.shadow[REG_TESTPA1] != pa1:
+            self.writeReg(REG_TESTPA1, pa1)
+        if self.shadow[REG_TESTPA2] != pa2:
+            self.writeReg(REG_TESTPA2, pa2)
 
     def readAllRegs(self):
         results = []
@@ -375,8 +1378,7 @@ class RFM69(object):
     def readTemperature(self, calFactor):
         self.setMode(RF69_MODE_STANDBY)
         self.writeReg(REG_TEMP1, RF_TEMP1_MEAS_START)
-        while self.readReg(REG_TEMP1) & RF_TEMP1_MEAS_RUNNING:
-            pass
+        self.waitReg("temperature", REG_TEMP1, RF_TEMP1_MEAS_RUNNING, clear=True)
         # COURSE_TEMP_COEF puts reading in the ballpark, user can add additional correction
         #'complement'corrects the slope, rising temp = rising val
         return (int(~self.readReg(REG_TEMP2)) * -1) + COURSE_TEMP_COEF + calFactor
@@ -384,10 +1386,9 @@ class RFM69(object):
 
     def rcCalibration(self):
         self.writeReg(REG_OSC1, RF_OSC1_RCCAL_START)
-        while self.readReg(REG_OSC1) & RF_OSC1_RCCAL_DONE == 0x00:
-            pass
+        self.waitReg("rcCalibration", REG_OSC1, RF_OSC1_RCCAL_DONE)
 
     def shutdown(self):
         self.setHighPower(False)
         self.sleep()
-        GPIO.cleanup()
+        self.transport.close()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Every frame the radio reads, logged into a preallocated, memory mapped ring file:
+#
+#     radio.capture = RFM69capture.CaptureFile("/var/log/rfm69.cap", slots=262144)
+#
+#     python3 RFM69capture.py /var/log/rfm69.cap --follow
+#     python3 RFM69capture.py /var/log/rfm69.cap --pcap rfm69.pcap
+#
+# Frames are recorded before the address check, so frames for other nodes show up (flagged) even without
+# promiscuous mode, as do ACKs and repeated frames. Once the file is full the oldest frames are overwritten.
+# Recording is a few struct writes into the mapping on the interrupt thread, there is no file I/O until the
+# kernel writes the dirty pages back. A file is reopened where it left off if its size and layout still match.
+#
+# File layout, little endian: a HEADER_SIZE header (FILE_HEADER) and slots of SLOT_SIZE bytes, each a RECORD
+# followed by up to DATA_SIZE payload bytes. A slot with sequence number 0 is empty or being written.
+
+from RFM69registers import *
+from collections import namedtuple
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b"RFM69CAP"
+VERSION = 1
+# magic, version, slot size, slots, frames recorded so far
+FILE_HEADER = struct.Struct("<8sHHIQ")
+WRITTEN = struct.Struct("<Q")
+WRITTEN_OFFSET = 16
+HEADER_SIZE = 64
+# sequence number, time.time(), length byte, target, sender, control byte, RSSI, CAPTURE_* flags, payload bytes stored
+RECORD = struct.Struct("<QdBBBBbBB")
+SEQUENCE = struct.Struct("<Q")
+DATA_SIZE = RF69_MAX_LONG_DATA_LEN
+SLOT_SIZE = 280
+
+# addressed to neither this node nor broadcast
+CAPTURE_FOREIGN = 0x01
+# removed by the address check, the application never saw it
+CAPTURE_DROPPED = 0x02
+# the length byte promised more payload than was read
+CAPTURE_TRUNCATED = 0x04
+
+# pcap link type for the export, see exportPcap
+DLT_USER0 = 147
+PCAP_HEADER = struct.Struct("<IHHiIII")
+PCAP_RECORD = struct.Struct("<IIII")
+
+CapturedFrame = namedtuple("CapturedFrame", "data sender target ctl rssi time sequence length flags")
+
+class CaptureFile(object):
+    # keeps the newest slots frames, SLOT_SIZE bytes each
+    def __init__(self, path, slots = 65536):
+        if slots < 1:
+            raise ValueError("a capture file needs at least one slot")
+        self.path = path
+        self.slots = slots
+        size = HEADER_SIZE + slots * SLOT_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, FILE_HEADER.size, 0)
+            if (len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header)[:4] != (MAGIC, VERSION, SLOT_SIZE, slots)
+                    or os.fstat(fd).st_size != size):
+                os.ftruncate(fd, 0)
+                # every block is allocated now, so a record never waits for the file system
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except (AttributeError, OSError):
+                    os.ftruncate(fd, size)
+                os.pwrite(fd, FILE_HEADER.pack(MAGIC, VERSION, SLOT_SIZE, slots, 0), 0)
+            self.mm = mmap.mmap(fd, size, flags=mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0))
+        finally:
+            os.close(fd)
+        self.written = WRITTEN.unpack_from(self.mm, WRITTEN_OFFSET)[0]
+        self.closed = False
+
+    # runs on the interrupt thread with the radio's lock held, frame is as read from the FIFO (a dummy byte first)
+    def record(self, frame, rssi, timestamp, foreign, dropped):
+        if self.closed:
+            return
+        length = frame[1]
+        captured = max(0, min(length - 3, len(frame) - 5, DATA_SIZE))
+        flags = ((CAPTURE_FOREIGN if foreign else 0) | (CAPTURE_DROPPED if dropped else 0) |
+                 (CAPTURE_TRUNCATED if captured < length - 3 else 0))
+        sequence = self.written + 1
+        offset = HEADER_SIZE + self.written % self.slots * SLOT_SIZE
+        mm = self.mm
+        # the sequence number goes in last, a reader never takes half a record for a whole one
+        RECORD.pack_into(mm, offset, 0, time.time() - (time.monotonic() - timestamp), length, frame[2], frame[3], frame[4],
+                         max(-128, min(127, rssi)), flags, captured)
+        mm[offset + RECORD.size:offset + RECORD.size + captured] = frame[5:5 + captured]
+        SEQUENCE.pack_into(mm, offset, sequence)
+        WRITTEN.pack_into(mm, WRITTEN_OFFSET, sequence)
+        self.written = sequence
+
+    # writes the dirty pages back now instead of when the kernel gets to them, don't call it from the interrupt thread
+    def flush(self):
+        self.mm.flush()
+
+    # detach it from the radio first (radio.capture = None)
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.mm.close()
+
+    def stats(self):
+        return {"captureRecorded": self.written, "captureSlots": self.slots}
+
+# reads a capture file, also while a CaptureFile is still writing to it
+class CaptureReader(object):
+    def __init__(self, path):
+        with open(path, "rb") as capture:
+            self.mm = mmap.mmap(capture.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER_SIZE:
+            raise ValueError(f"{path} is not a capture file")
+        magic, version, slotSize, self.slots, written = FILE_HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION or slotSize != SLOT_SIZE or len(self.mm) < HEADER_SIZE + self.slots * SLOT_SIZE:
+            raise ValueError(f"{path} is not a version {VERSION} capture file")
+
+    def written(self):
+        return WRITTEN.unpack_from(self.mm, WRITTEN_OFFSET)[0]
+
+    # CapturedFrames with a sequence number above since that are still in the file, oldest first
+    def frames(self, since = 0):
+        written = self.written()
+        for sequence in range(max(since, written - self.slots) + 1, written + 1):
+            offset = HEADER_SIZE + (sequence - 1) % self.slots * SLOT_SIZE
+            stored, when, length, target, sender, ctl, rssi, flags, captured = RECORD.unpack_from(self.mm, offset)
+            data = bytes(self.mm[offset + RECORD.size:offset + RECORD.size + captured])
+            # overwritten or rewritten while we read it
+            if stored != sequence or SEQUENCE.unpack_from(self.mm, offset)[0] != sequence:
+                continue
+            yield CapturedFrame(data, sender, target, ctl, rssi, when, sequence, length, flags)
+
+    def close(self):
+        self.mm.close()
+
+# writes frames to a pcap file, each packet is rssi:1 (signed) flags:1 followed by the frame as sent over the air,
+# length:1 target:1 sender:1 ctl:1 data. Returns the number of frames written.
+def exportPcap(frames, path, linkType = DLT_USER0):
+    count = 0
+    with open(path, "wb") as output:
+        output.write(PCAP_HEADER.pack(0xA1B2C3D4, 2, 4, 0, 0, 6 + 255, linkType))
+        for frame in frames:
+            seconds = int(frame.time)
+            packet = struct.pack("<bBBBBB", frame.rssi, frame.flags, frame.length, frame.target, frame.sender, frame.ctl) + frame.data
+            output.write(PCAP_RECORD.pack(seconds, int((frame.time - seconds) * 1000000), len(packet),
+                                          6 + max(len(frame.data), frame.length - 3)))
+            output.write(packet)
+            count += 1
+    return count
+
+def describe(frame):
+    flags = "".join(name for bit, name in ((CAPTURE_FOREIGN, " foreign"), (CAPTURE_DROPPED, " dropped"),
+                                           (CAPTURE_TRUNCATED, " truncated")) if frame.flags & bit)
+    when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(frame.time)) + f"{frame.time % 1:.6f}"[1:]
+    return f"{when} #{frame.sequence} {frame.sender}->{frame.target} ctl=0x{frame.ctl:02x} rssi={frame.rssi}{flags} {frame.data.hex()}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Print or export the frames in an RFM69 capture file")
+    parser.add_argument("path")
+    parser.add_argument("--pcap", help="write the frames to this pcap file (link type DLT_USER0) instead of printing them")
+    parser.add_argument("--follow", action="store_true", help="keep printing new frames as they are recorded")
+    args = parser.parse_args()
+
+    reader = CaptureReader(args.path)
+    if args.pcap:
+        print(f"{exportPcap(reader.frames(), args.pcap)} frames written to {args.pcap}", file=sys.stderr)
+        return
+    last = 0
+    try:
+        while True:
+            for frame in reader.frames(last):
+                print(describe(frame))
+                last = frame.sequence
+            if not args.follow:
+                break
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        pass
+    reader.close()
+
+if __name__ == "__main__":
+    main()
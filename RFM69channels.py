@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Channel plans with the FRF register values worked out once, and frequency hopping on top of them:
+#
+#     radio.setChannelPlan(RFM69channels.PLANS["915"])
+#     radio.setChannel(12)
+#
+#     hopper = RFM69channels.Hopper(radio, RFM69channels.PLANS["915"], seed=networkKey, dwell=0.1)
+#     hopper.send(2, "Hello", requestACK=True)
+#
+# Hoppers with the same plan, seed and dwell time visit the same channels at the same time, as long as
+# their clocks (time.time() plus clockOffset) agree to within the guard time.
+
+from RFM69modem import FSTEP
+from RFM69registers import *
+import random
+import threading
+import time
+
+class ChannelPlan(object):
+    # frequencies in Hz, channel n is frequencies[n]
+    def __init__(self, frequencies):
+        self.frequencies = list(frequencies)
+        if not self.frequencies:
+            raise ValueError("a channel plan needs at least one channel")
+        # REG_FRFMSB, REG_FRFMID, REG_FRFLSB for each channel
+        self.frf = []
+        for freqHz in self.frequencies:
+            if not 290000000 <= freqHz <= 1020000000:
+                raise ValueError(f"{freqHz}Hz is outside the RFM69's 290-1020MHz range")
+            value = int(round(freqHz / FSTEP))
+            self.frf.append([value >> 16, (value >> 8) & 0xFF, value & 0xFF])
+
+    @classmethod
+    def uniform(cls, first, spacing, count):
+        return cls(first + spacing * n for n in range(count))
+
+    def __len__(self):
+        return len(self.frequencies)
+
+    def __repr__(self):
+        return f"ChannelPlan({len(self)} channels, {self.frequencies[0]}-{self.frequencies[-1]}Hz)"
+
+# 200kHz raster in the usual ISM bands, check the local duty cycle and dwell time rules before hopping
+PLANS = {
+    "433": ChannelPlan.uniform(433175000, 200000, 8),
+    "868": ChannelPlan.uniform(865100000, 200000, 15),
+    "915": ChannelPlan.uniform(902300000, 200000, 64),
+}
+
+# time slotted hopping, every dwell seconds the radio moves to the next channel of a pseudo random sequence.
+# With perPacket each slot carries at most one send, so consecutive packets never share a channel.
+class Hopper(object):
+    def __init__(self, radio, plan, seed = 0, dwell = 0.1, guard = 0.005, perPacket = False, clockOffset = 0.0):
+        if dwell <= 2 * guard:
+            raise ValueError("the dwell time must be longer than twice the guard time")
+        self.radio = radio
+        self.plan = plan
+        self.dwell = dwell
+        self.guard = guard
+        self.perPacket = perPacket
+        # seconds added to time.time(), for nodes without a synchronized clock
+        self.clockOffset = clockOffset
+        # every channel once per round, in an order both ends derive from the seed
+        self.sequence = list(range(len(plan)))
+        random.Random(seed).shuffle(self.sequence)
+        self.txLock = threading.Lock()
+        self.lastSlot = None
+        self.hops = 0
+        self.deferred = 0
+        self.stopped = threading.Event()
+        radio.setChannelPlan(plan)
+        self.retune()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def now(self):
+        return time.time() + self.clockOffset
+
+    def slot(self):
+        return int(self.now() // self.dwell)
+
+    def slotRemaining(self):
+        return self.dwell - self.now() % self.dwell
+
+    def channelAt(self, slot):
+        return self.sequence[slot % len(self.sequence)]
+
+    def retune(self):
+        channel = self.channelAt(self.slot())
+        with self.radio.lock:
+            if self.radio.channel != channel:
+                self.radio.setChannel(channel)
+                self.hops += 1
+
+    def run(self):
+        while not self.stopped.wait(self.slotRemaining()):
+            self.retune()
+
+    def stop(self):
+        self.stopped.set()
+
+    # sends once the frame (and its ACK) fits into what's left of the slot, retries land on later channels
+    def send(self, toAddress, buff = "", requestACK = False, retries = 3, retryWaitTime = 10):
+        radio = self.radio
+        length = min(len(buff), radio.maxDataLen) + 3
+        needed = radio.timeOnAir(length) + (radio.timeOnAir(3) if requestACK else 0) + self.guard
+        with self.txLock:
+            if self.slotRemaining() < needed or (self.perPacket and self.lastSlot == self.slot()):
+                self.deferred += 1
+                # into the next slot, clear of its guard time
+                time.sleep(self.slotRemaining() + self.guard)
+            self.lastSlot = self.slot()
+            # the hopping thread may not have caught up with the boundary yet
+            self.retune()
+            if requestACK:
+                return radio.sendWithRetry(toAddress, buff, retries, retryWaitTime)
+            radio.send(toAddress, buff)
+            return True
+
+    def stats(self):
+        return {"channel": self.radio.channel, "hops": self.hops, "deferred": self.deferred}
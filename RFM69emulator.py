@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+
+# An SX1231 in memory, for running and profiling the driver without hardware.
+# Pass it to RFM69 as the transport, radios sharing a VirtualChannel can talk to each other:
+#
+#     channel = VirtualChannel()
+#     radio1 = RFM69.RFM69(RF69_915MHZ, 1, 100, transport=EmulatedSX1231(channel))
+#     radio2 = RFM69.RFM69(RF69_915MHZ, 2, 100, transport=EmulatedSX1231(channel))
+#
+# The register file, FIFO, modes, IRQ flags, AutoModes and DIO0/DIO1 edges are modeled. The radio side is
+# reduced to frames moving between radios tuned to the same frequency, bit rate and sync word. The FIFO
+# drains while sending and fills while receiving, so frames longer than the FIFO have to be streamed.
+
+from RFM69registers import *
+from collections import deque
+import heapq
+import random
+import threading
+import time
+
+# register values after reset, the recommended defaults where the datasheet gives them
+RESET_VALUES = {
+    REG_OPMODE: RF_OPMODE_SEQUENCER_ON | RF_OPMODE_LISTEN_OFF | RF_OPMODE_STANDBY,
+    REG_BITRATEMSB: RF_BITRATEMSB_4800, REG_BITRATELSB: RF_BITRATELSB_4800,
+    REG_FDEVMSB: RF_FDEVMSB_5000, REG_FDEVLSB: RF_FDEVLSB_5000,
+    REG_FRFMSB: RF_FRFMSB_915, REG_FRFMID: RF_FRFMID_915, REG_FRFLSB: RF_FRFLSB_915,
+    REG_OSC1: RF_OSC1_RCCAL_DONE | 0x01,
+    REG_LOWBAT: 0x02,
+    REG_LISTEN1: RF_LISTEN1_RESOL_IDLE_4100 | RF_LISTEN1_RESOL_RX_64 | RF_LISTEN1_END_01,
+    REG_LISTEN2: RF_LISTEN2_COEFIDLE_VALUE, REG_LISTEN3: RF_LISTEN3_COEFRX_VALUE,
+    REG_VERSION: 0x24,
+    REG_PALEVEL: RF_PALEVEL_PA0_ON | RF_PALEVEL_OUTPUTPOWER_11111,
+    REG_PARAMP: RF_PARAMP_40,
+    REG_OCP: RF_OCP_ON | RF_OCP_TRIM_95,
+    REG_LNA: 0x88, REG_RXBW: 0x55, REG_AFCBW: 0x8B,
+    REG_OOKPEAK: 0x40, REG_OOKAVG: 0x80, REG_OOKFIX: 0x06,
+    REG_AFCFEI: 0x10,
+    REG_RSSICONFIG: RF_RSSI_DONE,
+    REG_RSSIVALUE: 0xFF,
+    REG_DIOMAPPING2: 0x07,
+    REG_RSSITHRESH: 0xE4,
+    REG_PREAMBLELSB: RF_PREAMBLESIZE_LSB_VALUE,
+    REG_SYNCCONFIG: RF_SYNC_ON | RF_SYNC_FIFOFILL_AUTO | RF_SYNC_SIZE_4 | RF_SYNC_TOL_0,
+    REG_PACKETCONFIG1: RF_PACKET1_CRC_ON,
+    REG_PAYLOADLENGTH: 0x40,
+    REG_FIFOTHRESH: RF_FIFOTHRESH_TXSTART_FIFONOTEMPTY | RF_FIFOTHRESH_VALUE,
+    REG_PACKETCONFIG2: RF_PACKET2_AUTORXRESTART_ON,
+    REG_TEMP1: RF_TEMP1_ADCLOWPOWER_ON,
+    # reads as about 25 degrees with readTemperature(0)
+    REG_TEMP2: 114,
+    REG_TESTPA1: 0x55, REG_TESTPA2: 0x70,
+    REG_TESTDAGC: RF_DAGC_IMPROVED_LOWBETA0,
+}
+for addr in range(REG_SYNCVALUE1, REG_SYNCVALUE8 + 1):
+    RESET_VALUES[addr] = 0x01
+
+# Mode bits of REG_OPMODE
+MODE_SLEEP = 0
+MODE_STANDBY = 1
+MODE_SYNTH = 2
+MODE_TX = 3
+MODE_RX = 4
+
+FIFO_SIZE = 66
+# bytes moved between the FIFO and the air at a time when time on air is simulated
+FIFO_STEP = 8
+
+# listen mode timer resolutions in microseconds by their REG_LISTEN1 field value
+LISTEN_RESOLUTION_US = (0, 64, 4100, 262000)
+
+class EmulatedSX1231(object):
+    def __init__(self, channel = None, spiLatency = 0.0):
+        self.channel = channel
+        # seconds added to every SPI transaction, to mimic the bus and the kernel driver
+        self.spiLatency = spiLatency
+        self.spiTransactions = 0
+        self.spiBytes = 0
+        self.lock = threading.RLock()
+        # chip internal timers (end of transmission), run on their own thread like the real chip
+        self.timers = []
+        self.timerCount = 0
+        self.timerReady = threading.Condition(self.lock)
+        # DIO edges are delivered on a separate thread, like the GPIO library's callback thread
+        self.callbacks = {}
+        self.edges = deque()
+        self.edgeReady = threading.Condition()
+        self.closed = False
+        self.reset()
+        threading.Thread(target=self.timerLoop, daemon=True).start()
+        threading.Thread(target=self.edgeLoop, daemon=True).start()
+        if channel is not None:
+            channel.attach(self)
+
+    def reset(self):
+        with self.lock:
+            self.regs = bytearray(0x80)
+            for addr, value in RESET_VALUES.items():
+                self.regs[addr] = value
+            self.fifo = bytearray()
+            # latched IRQFLAGS2 bits, the FIFO bits are computed when read
+            self.flags2 = 0
+            self.fifoOverrun = False
+            self.mode = MODE_STANDBY
+            # the mode AutoModes switched to, None when the sequencer is idle
+            self.intermediate = None
+            self.transmitting = False
+            self.txCount = 0
+            self.txUnderruns = 0
+            # the frame being received, bytes that haven't made it into the FIFO yet
+            self.rxPending = None
+            self.rxCount = 0
+            self.dio = {0: False, 1: False}
+            self.txDbm = self.txPower()
+
+    # transport interface used by RFM69
+
+    def xfer(self, data):
+        if self.spiLatency:
+            time.sleep(self.spiLatency)
+        data = list(data)
+        addr = data[0] & 0x7F
+        out = [0]
+        with self.lock:
+            self.spiTransactions += 1
+            self.spiBytes += len(data)
+            # the address auto increments, except on the FIFO
+            if data[0] & 0x80:
+                for i, value in enumerate(data[1:]):
+                    self.writeRegister(addr if addr == REG_FIFO else (addr + i) & 0x7F, value)
+                out += [0] * (len(data) - 1)
+            else:
+                for i in range(len(data) - 1):
+                    out.append(self.readRegister(addr if addr == REG_FIFO else (addr + i) & 0x7F))
+            self.update()
+        return out
+
+    def write(self, data):
+        self.xfer(bytes(data))
+
+    def attachInterrupt(self, callback, dio = 0, both = False):
+        self.callbacks[dio] = (callback, both)
+
+    def detachInterrupt(self, dio = 0):
+        self.callbacks.pop(dio, None)
+
+    def close(self):
+        self.closed = True
+        if self.channel is not None:
+            self.channel.detach(self)
+        with self.timerReady:
+            self.timerReady.notify()
+        with self.edgeReady:
+            self.edgeReady.notify()
+
+    # register file
+
+    def readRegister(self, addr):
+        if addr == REG_FIFO:
+            if not self.fifo:
+                return 0
+            value = self.fifo.pop(0)
+            if not self.fifo:
+                self.flags2 &= ~(RF_IRQFLAGS2_PAYLOADREADY | RF_IRQFLAGS2_CRCOK)
+            return value
+        if addr == REG_IRQFLAGS1:
+            return self.irqFlags1()
+        if addr == REG_IRQFLAGS2:
+            return self.irqFlags2()
+        if addr == REG_RSSIVALUE and self.currentMode() == MODE_RX and not self.flags2 & RF_IRQFLAGS2_PAYLOADREADY:
+            self.regs[REG_RSSIVALUE] = self.sampleRSSI()
+        return self.regs[addr]
+
+    def writeRegister(self, addr, value):
+        if addr == REG_FIFO:
+            if len(self.fifo) < FIFO_SIZE:
+                self.fifo.append(value)
+            else:
+                self.fifoOverrun = True
+        elif addr == REG_OPMODE:
+            # ListenAbort only has an effect together with ListenOn cleared and always reads back as 0
+            self.regs[addr] = value & ~RF_OPMODE_LISTENABORT & 0xFF
+        elif addr == REG_IRQFLAGS1 or addr == REG_IRQFLAGS2:
+            if addr == REG_IRQFLAGS2 and value & RF_IRQFLAGS2_FIFOOVERRUN:
+                self.fifoOverrun = False
+                self.fifo = bytearray()
+        elif addr == REG_PACKETCONFIG2:
+            if value & RF_PACKET2_RXRESTART:
+                self.restartRx()
+            self.regs[addr] = value & ~RF_PACKET2_RXRESTART & 0xFF
+        elif addr == REG_RSSICONFIG:
+            if value & RF_RSSI_START:
+                self.regs[REG_RSSIVALUE] = self.sampleRSSI()
+            self.regs[addr] = (value & RF_RSSI_FASTRX_ON) | RF_RSSI_DONE
+        elif addr == REG_OSC1:
+            self.regs[addr] = (value & ~RF_OSC1_RCCAL_START & 0xFF) | RF_OSC1_RCCAL_DONE
+        elif addr == REG_TEMP1:
+            self.regs[addr] = value & ~(RF_TEMP1_MEAS_START | RF_TEMP1_MEAS_RUNNING) & 0xFF
+        elif addr not in (REG_VERSION, REG_RSSIVALUE, REG_TEMP2):
+            self.regs[addr] = value
+
+    def irqFlags1(self):
+        mode = self.currentMode()
+        flags = RF_IRQFLAGS1_MODEREADY
+        if mode == MODE_RX:
+            flags |= RF_IRQFLAGS1_RXREADY | RF_IRQFLAGS1_PLLLOCK
+        elif mode == MODE_TX:
+            flags |= RF_IRQFLAGS1_TXREADY | RF_IRQFLAGS1_PLLLOCK
+        elif mode == MODE_SYNTH:
+            flags |= RF_IRQFLAGS1_PLLLOCK
+        if self.intermediate is not None:
+            flags |= RF_IRQFLAGS1_AUTOMODE
+        return flags
+
+    def irqFlags2(self):
+        flags = self.flags2
+        if len(self.fifo) >= FIFO_SIZE:
+            flags |= RF_IRQFLAGS2_FIFOFULL
+        if self.fifo:
+            flags |= RF_IRQFLAGS2_FIFONOTEMPTY
+        if len(self.fifo) > self.regs[REG_FIFOTHRESH] & 0x7F:
+            flags |= RF_IRQFLAGS2_FIFOLEVEL
+        if self.fifoOverrun:
+            flags |= RF_IRQFLAGS2_FIFOOVERRUN
+        return flags
+
+    # state machine
+
+    def listening(self):
+        return bool(self.regs[REG_OPMODE] & RF_OPMODE_LISTEN_ON)
+
+    def currentMode(self):
+        if self.intermediate is not None:
+            return self.intermediate
+        if self.listening():
+            # modeled as always receiving, VirtualChannel accounts for the idle part of the cycle
+            return MODE_RX
+        return (self.regs[REG_OPMODE] >> 2) & 0x07
+
+    # called with the lock held after anything that can change the chip's state
+    def update(self):
+        while True:
+            mode = self.currentMode()
+            if mode != self.mode:
+                if self.mode == MODE_TX:
+                    # PacketSent is cleared when leaving TX, an unfinished frame is lost
+                    self.flags2 &= ~RF_IRQFLAGS2_PACKETSENT
+                    self.transmitting = False
+                elif self.mode == MODE_RX:
+                    self.rxPending = None
+                self.mode = mode
+            if mode == MODE_TX and not self.transmitting and self.fifo:
+                if self.regs[REG_FIFOTHRESH] & RF_FIFOTHRESH_TXSTART_FIFONOTEMPTY or \
+                        len(self.fifo) > self.regs[REG_FIFOTHRESH] & 0x7F:
+                    self.startTx()
+            if not self.byteTime():
+                if mode == MODE_TX and self.transmitting and self.txRemaining and self.fifo:
+                    self.drainTx(len(self.fifo))
+                elif self.rxPending is not None:
+                    self.fillRx(FIFO_SIZE - len(self.fifo))
+            self.updateDio()
+            if not self.autoModes():
+                return
+
+    def dio0(self):
+        mapping = self.regs[REG_DIOMAPPING1] >> 6
+        if self.mode == MODE_TX:
+            return (mapping == 0 and bool(self.flags2 & RF_IRQFLAGS2_PACKETSENT)) or mapping == 1
+        if self.mode == MODE_RX:
+            if mapping == 0:
+                return bool(self.flags2 & RF_IRQFLAGS2_CRCOK)
+            if mapping == 1:
+                return bool(self.flags2 & RF_IRQFLAGS2_PAYLOADREADY)
+        return False
+
+    def dio1(self):
+        mapping = (self.regs[REG_DIOMAPPING1] >> 4) & 0x03
+        flags = self.irqFlags2()
+        if mapping == 0:
+            return bool(flags & RF_IRQFLAGS2_FIFOLEVEL)
+        if mapping == 1:
+            return bool(flags & RF_IRQFLAGS2_FIFOFULL)
+        if mapping == 2:
+            return bool(flags & RF_IRQFLAGS2_FIFONOTEMPTY)
+        return self.mode == MODE_TX
+
+    def updateDio(self):
+        for dio, level in ((0, self.dio0()), (1, self.dio1())):
+            callback = self.callbacks.get(dio)
+            if callback is not None and level != self.dio[dio] and (level or callback[1]):
+                with self.edgeReady:
+                    self.edges.append(dio)
+                    self.edgeReady.notify()
+            self.dio[dio] = level
+
+    # enters or leaves the intermediate mode, returns True if it changed anything
+    def autoModes(self):
+        value = self.regs[REG_AUTOMODES]
+        enter = value & 0xE0
+        exit = value & 0x1C
+        if self.intermediate is None:
+            if enter != RF_AUTOMODES_ENTER_OFF and self.enterConditions().get(enter, False):
+                self.intermediate = (MODE_SLEEP, MODE_STANDBY, MODE_RX, MODE_TX)[value & 0x03]
+                return True
+        elif enter == RF_AUTOMODES_ENTER_OFF or self.exitConditions().get(exit, False):
+            self.intermediate = None
+            return True
+        return False
+
+    def enterConditions(self):
+        flags = self.irqFlags2()
+        return {RF_AUTOMODES_ENTER_FIFONOTEMPTY: bool(flags & RF_IRQFLAGS2_FIFONOTEMPTY),
+                RF_AUTOMODES_ENTER_FIFOLEVEL: bool(flags & RF_IRQFLAGS2_FIFOLEVEL),
+                RF_AUTOMODES_ENTER_CRCOK: bool(flags & RF_IRQFLAGS2_CRCOK),
+                RF_AUTOMODES_ENTER_PAYLOADREADY: bool(flags & RF_IRQFLAGS2_PAYLOADREADY),
+                RF_AUTOMODES_ENTER_PACKETSENT: bool(flags & RF_IRQFLAGS2_PACKETSENT),
+                RF_AUTOMODES_ENTER_FIFOEMPTY: not flags & RF_IRQFLAGS2_FIFONOTEMPTY}
+
+    def exitConditions(self):
+        flags = self.irqFlags2()
+        return {RF_AUTOMODES_EXIT_FIFOEMPTY: not flags & RF_IRQFLAGS2_FIFONOTEMPTY,
+                RF_AUTOMODES_EXIT_FIFOLEVEL: bool(flags & RF_IRQFLAGS2_FIFOLEVEL),
+                RF_AUTOMODES_EXIT_CRCOK: bool(flags & RF_IRQFLAGS2_CRCOK),
+                RF_AUTOMODES_EXIT_PAYLOADREADY: bool(flags & RF_IRQFLAGS2_PAYLOADREADY),
+                RF_AUTOMODES_EXIT_PACKETSENT: bool(flags & RF_IRQFLAGS2_PACKETSENT)}
+
+    def restartRx(self):
+        self.fifo = bytearray()
+        self.rxPending = None
+        self.flags2 &= ~(RF_IRQFLAGS2_PAYLOADREADY | RF_IRQFLAGS2_CRCOK)
+
+    # radio
+
+    def bitrate(self):
+        return RF69_FXOSC / ((self.regs[REG_BITRATEMSB] << 8) | self.regs[REG_BITRATELSB])
+
+    # seconds per byte on air, 0 when frames move instantly
+    def byteTime(self):
+        timeScale = self.channel.timeScale if self.channel is not None else 0
+        return 8 / self.bitrate() * timeScale if timeScale else 0
+
+    def preambleTime(self):
+        return ((self.regs[REG_PREAMBLEMSB] << 8) | self.regs[REG_PREAMBLELSB]) * 8 / self.bitrate()
+
+    def syncWord(self):
+        config = self.regs[REG_SYNCCONFIG]
+        if not config & RF_SYNC_ON:
+            return None
+        size = ((config >> 3) & 0x07) + 1
+        return bytes(self.regs[REG_SYNCVALUE1:REG_SYNCVALUE1 + size])
+
+    # what has to match between sender and receiver for a frame to get through
+    def link(self):
+        aes = self.regs[REG_PACKETCONFIG2] & RF_PACKET2_AES_ON
+        return (bytes(self.regs[REG_FRFMSB:REG_FRFLSB + 1]), bytes(self.regs[REG_BITRATEMSB:REG_BITRATELSB + 1]),
+                self.syncWord(), self.regs[REG_PACKETCONFIG1] & RF_PACKET1_FORMAT_VARIABLE,
+                bytes(self.regs[REG_AESKEY1:REG_AESKEY16 + 1]) if aes else None)
+
+    def frequency(self):
+        return bytes(self.regs[REG_FRFMSB:REG_FRFLSB + 1])
+
+    # the listen cycle in seconds, (idle, rx)
+    def listenCycle(self):
+        value = self.regs[REG_LISTEN1]
+        idle = LISTEN_RESOLUTION_US[value >> 6] * self.regs[REG_LISTEN2] / 1000000.0
+        rx = LISTEN_RESOLUTION_US[(value >> 4) & 0x03] * self.regs[REG_LISTEN3] / 1000000.0
+        return idle, rx
+
+    # output power in dBm set by the PA registers
+    def txPower(self):
+        paLevel = self.regs[REG_PALEVEL]
+        if paLevel & RF_PALEVEL_PA2_ON:
+            boost = self.regs[REG_TESTPA1] == 0x5D and self.regs[REG_TESTPA2] == 0x7C
+            return (paLevel & 0x1F) - (11 if boost else 14)
+        return (paLevel & 0x1F) - 18
+
+    def sampleRSSI(self):
+        rssi = self.channel.rssiAt(self) if self.channel is not None else -127.5
+        return min(255, max(0, int(-rssi * 2)))
+
+    def startTx(self):
+        if self.regs[REG_PACKETCONFIG1] & RF_PACKET1_FORMAT_VARIABLE:
+            self.txRemaining = self.fifo[0] + 1
+        else:
+            self.txRemaining = self.regs[REG_PAYLOADLENGTH]
+        self.txFrame = bytearray()
+        self.txUnderrun = False
+        self.txDbm = self.txPower()
+        self.transmitting = True
+        self.txCount += 1
+        count = self.txCount
+        airTime = self.channel.airTime(self, self.txRemaining) if self.channel is not None else 0
+        if self.channel is not None:
+            self.channel.startTx(self, airTime)
+        if self.byteTime():
+            # nothing leaves the FIFO before the preamble and sync word are out
+            self.schedule(airTime - (self.txRemaining + 2) * self.byteTime(), lambda: self.stepTx(count))
+        else:
+            self.drainTx(len(self.fifo))
+
+    # moves up to limit bytes of the frame from the FIFO onto the air
+    def drainTx(self, limit):
+        n = min(self.txRemaining, limit)
+        if len(self.fifo) < n:
+            # the chip sends whatever is there, the receivers will see a CRC error
+            self.txUnderrun = True
+        self.txFrame += self.fifo[:n]
+        del self.fifo[:n]
+        self.txRemaining -= n
+        if not self.txRemaining:
+            count, frame, underrun = self.txCount, bytes(self.txFrame), self.txUnderrun
+            self.schedule(2 * self.byteTime(), lambda: self.finishTx(count, frame, underrun))
+
+    # runs on the timer thread while sending at a simulated bit rate
+    def stepTx(self, count):
+        with self.lock:
+            if not self.transmitting or count != self.txCount:
+                return
+            self.drainTx(FIFO_STEP)
+            if self.txRemaining:
+                self.schedule(FIFO_STEP * self.byteTime(), lambda: self.stepTx(count))
+            self.update()
+
+    # runs on the timer thread
+    def finishTx(self, count, frame, underrun):
+        with self.lock:
+            if not self.transmitting or count != self.txCount:
+                return
+            self.transmitting = False
+            self.flags2 |= RF_IRQFLAGS2_PACKETSENT
+            if underrun:
+                self.txUnderruns += 1
+            link = self.link()
+            preambleTime = self.preambleTime()
+            self.update()
+        # outside the lock, delivering locks the receivers
+        if self.channel is not None and not underrun:
+            self.channel.deliver(self, frame, link, preambleTime)
+
+    # a frame from the channel, returns True if it ended up in the FIFO
+    def receive(self, frame, rssi):
+        with self.lock:
+            if self.currentMode() != MODE_RX or self.flags2 & RF_IRQFLAGS2_PAYLOADREADY or self.rxPending is not None:
+                return False
+            config = self.regs[REG_PACKETCONFIG1]
+            variable = config & RF_PACKET1_FORMAT_VARIABLE
+            if variable and frame[0] > self.regs[REG_PAYLOADLENGTH]:
+                return False
+            filtering = config & 0x06
+            if filtering:
+                target = frame[1] if variable else frame[0]
+                if target != self.regs[REG_NODEADRS] and not \
+                        (filtering == RF_PACKET1_ADRSFILTERING_NODEBROADCAST and target == self.regs[REG_BROADCASTADRS]):
+                    return False
+            self.fifo = bytearray()
+            self.rxPending = bytearray(frame)
+            self.rxCount += 1
+            count = self.rxCount
+            self.regs[REG_RSSIVALUE] = min(255, max(0, int(-rssi * 2)))
+            # delivery happens once the sender is done, what fits into the FIFO has arrived by then
+            self.fillRx(FIFO_SIZE)
+            if self.rxPending is not None and self.byteTime():
+                # the rest of a long frame follows at the bit rate, late but paced like the real thing
+                self.schedule(FIFO_STEP * self.byteTime(), lambda: self.stepRx(count))
+            self.update()
+            return True
+
+    # moves up to limit bytes of the frame being received into the FIFO
+    def fillRx(self, limit):
+        n = min(len(self.rxPending), limit)
+        if len(self.fifo) + n > FIFO_SIZE:
+            # not drained in time, the frame is lost
+            self.fifoOverrun = True
+            self.fifo = bytearray()
+            self.rxPending = None
+            return
+        self.fifo += self.rxPending[:n]
+        del self.rxPending[:n]
+        if not self.rxPending:
+            self.rxPending = None
+            self.flags2 |= RF_IRQFLAGS2_PAYLOADREADY | RF_IRQFLAGS2_CRCOK
+
+    # runs on the timer thread while receiving at a simulated bit rate
+    def stepRx(self, count):
+        with self.lock:
+            if self.rxPending is None or count != self.rxCount:
+                return
+            self.fillRx(FIFO_STEP)
+            if self.rxPending is not None:
+                self.schedule(FIFO_STEP * self.byteTime(), lambda: self.stepRx(count))
+            self.update()
+
+    # threads
+
+    def schedule(self, delay, action):
+        with self.timerReady:
+            self.timerCount += 1
+            heapq.heappush(self.timers, (time.monotonic() + delay, self.timerCount, action))
+            self.timerReady.notify()
+
+    def timerLoop(self):
+        while not self.closed:
+            with self.timerReady:
+                while not self.closed and (not self.timers or self.timers[0][0] > time.monotonic()):
+                    self.timerReady.wait(self.timers[0][0] - time.monotonic() if self.timers else None)
+                if self.closed:
+                    return
+                action = heapq.heappop(self.timers)[2]
+            action()
+
+    def edgeLoop(self):
+        while not self.closed:
+            with self.edgeReady:
+                while not self.closed and not self.edges:
+                    self.edgeReady.wait()
+                if self.closed:
+                    return
+                dio = self.edges.popleft()
+            callback = self.callbacks.get(dio)
+            if callback is not None:
+                callback[0](dio)
+
+# Radios attached to the same channel hear each other when their frequency, bit rate, sync word,
+# packet format and AES key match. rssi and loss are numbers or functions of (sender, receiver),
+# with pathLoss (in dB, also a number or function) the RSSI is the sender's output power minus the path loss instead.
+# timeScale stretches time on air (0 delivers frames immediately, 1 is real time)
+class VirtualChannel(object):
+    def __init__(self, rssi = -50, loss = 0.0, noiseFloor = -100, timeScale = 0.0, seed = None, pathLoss = None):
+        self.rssi = rssi
+        self.pathLoss = pathLoss
+        self.loss = loss
+        self.noiseFloor = noiseFloor
+        self.timeScale = timeScale
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.radios = []
+        # frequency -> [(sender, end time)] for carrier sense
+        self.onAir = {}
+        self.sent = 0
+        self.delivered = 0
+        self.lost = 0
+
+    def attach(self, radio):
+        with self.lock:
+            self.radios.append(radio)
+
+    def detach(self, radio):
+        with self.lock:
+            if radio in self.radios:
+                self.radios.remove(radio)
+
+    def value(self, setting, sender, receiver):
+        return setting(sender, receiver) if callable(setting) else setting
+
+    def rssiFrom(self, sender, receiver):
+        if self.pathLoss is None:
+            return self.value(self.rssi, sender, receiver)
+        return sender.txDbm - self.value(self.pathLoss, sender, receiver)
+
+    def airTime(self, radio, length):
+        # preamble, sync word, frame and CRC
+        sync = radio.syncWord()
+        bits = (((radio.regs[REG_PREAMBLEMSB] << 8) | radio.regs[REG_PREAMBLELSB]) + len(sync or b"") + length + 2) * 8
+        return bits / radio.bitrate() * self.timeScale
+
+    def startTx(self, radio, airTime):
+        with self.lock:
+            self.onAir.setdefault(radio.frequency(), []).append((radio, time.monotonic() + airTime))
+
+    def rssiAt(self, radio):
+        now = time.monotonic()
+        rssi = self.noiseFloor
+        with self.lock:
+            active = [entry for entry in self.onAir.get(radio.frequency(), []) if entry[1] > now]
+            self.onAir[radio.frequency()] = active
+        for sender, end in active:
+            if sender is not radio:
+                rssi = max(rssi, self.rssiFrom(sender, radio))
+        return rssi
+
+    def deliver(self, sender, frame, link, preambleTime):
+        with self.lock:
+            self.sent += 1
+            receivers = [radio for radio in self.radios if radio is not sender]
+        for radio in receivers:
+            with radio.lock:
+                if radio.link() != link:
+                    continue
+                listening = radio.listening() and radio.intermediate is None
+                cycle = radio.listenCycle()
+            if self.random.random() < self.value(self.loss, sender, radio):
+                self.lost += 1
+                continue
+            if listening:
+                # the receiver only wakes up in time if the preamble overlaps one of its RX windows
+                idle, rx = cycle
+                if self.random.random() >= min(1.0, (preambleTime + rx) / (idle + rx)):
+                    self.lost += 1
+                    continue
+            if radio.receive(frame, self.rssiFrom(sender, radio)):
+                self.delivered += 1
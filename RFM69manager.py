@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+# Several RFM69 modules driven from one process, on different chip selects or buses and on different
+# frequencies or networks:
+#
+#     manager = RFM69manager.RadioManager()
+#     manager.add(RF69_868MHZ, 1, 100, intPin=18, rstPin=22, spiDevice=0)
+#     manager.add(RF69_868MHZ, 1, 101, intPin=16, rstPin=22, spiDevice=1)
+#     manager.send(2, "Hello", networkID=100).result()
+#     received = manager.recv()
+#     print(received.radio.networkID, received.packet)
+#     manager.shutdown()
+#
+# The manager sets up GPIO once, pulses each reset pin once (modules may share one), runs the interrupt
+# callbacks of all radios on a single dispatch thread and only cleans up GPIO after the last radio is shut down.
+# Outbound frames go to the radio with the least queued time on air and channel access delay among those
+# that can reach the destination. Every radio sends from its own worker thread, so the modules transmit in parallel.
+
+from RFM69 import RFM69
+from RFM69registers import *
+from RFM69transport import SpiDevTransport
+from collections import deque, namedtuple
+from concurrent.futures import Future
+import threading
+import time
+
+# a packet from RadioManager.recv() and the radio it came in on, ACKs and replies go out through that radio
+Received = namedtuple("Received", "radio packet")
+
+# the radio's transport, except that interrupts go through the manager's dispatch thread
+class DispatchTransport(object):
+    def __init__(self, transport, manager, slot):
+        self.transport = transport
+        self.manager = manager
+        self.slot = slot
+        # the SPI path is called directly
+        self.xfer = transport.xfer
+        self.write = transport.write
+
+    def attachInterrupt(self, callback, dio = 0, both = False):
+        self.transport.attachInterrupt(lambda pin: self.manager.dispatch(callback, pin, self.slot), dio, both)
+
+    def reset(self):
+        self.manager.reset(self.transport)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+# a managed radio with its transmit queue
+class RadioSlot(object):
+    def __init__(self):
+        # set once the radio is created, it attaches its interrupts before that
+        self.radio = None
+        self.queue = deque()
+        self.ready = threading.Condition()
+        # time on air of everything queued or waiting for an ACK
+        self.queuedAirTime = 0.0
+        # smoothed seconds a send spent beyond its time on air, mostly waiting for a clear channel
+        self.accessDelay = 0.0
+        self.sent = 0
+        # interrupt callbacks of this radio that raised
+        self.interruptFailures = 0
+
+    def load(self):
+        return self.queuedAirTime + self.accessDelay
+
+    def release(self, airTime):
+        with self.ready:
+            self.queuedAirTime -= airTime
+
+class RadioManager(object):
+    # gpio and board as for RFM69transport.SpiDevTransport, only needed once a radio without transport is added
+    def __init__(self, gpio = None, board = None, rxBufferSize = 64, dropOldest = True):
+        self.gpio = gpio
+        self.board = board
+        self.gpioReady = False
+        self.resetPins = set()
+        self.slots = []
+        self.closed = False
+        self.lock = threading.Lock()
+        # interrupt callbacks of all radios, run in order on one thread
+        self.interrupts = deque()
+        self.interruptReady = threading.Condition()
+        self.interruptCount = 0
+        # packets from every radio
+        self.rxBuffer = deque()
+        self.rxBufferSize = rxBufferSize
+        self.dropOldest = dropOldest
+        self.rxReady = threading.Condition()
+        self.rxReceived = 0
+        self.rxDropped = 0
+        threading.Thread(target=self.dispatchLoop, daemon=True).start()
+
+    # creates and starts a radio, the arguments are RFM69's, transport (e.g. RFM69emulator) replaces the SPI and GPIO setup
+    def add(self, freqBand, nodeID, networkID, isRFM69HW = False, intPin = 18, rstPin = 22, spiBus = 0, spiDevice = 0,
+            dio1Pin = None, transport = None, **kwargs):
+        if transport is None:
+            self.setupGpio()
+            transport = SpiDevTransport(intPin, rstPin, spiBus, spiDevice, gpio=self.gpio, dio1Pin=dio1Pin, shared=True)
+        slot = RadioSlot()
+        radio = slot.radio = RFM69(freqBand, nodeID, networkID, isRFM69HW, intPin, rstPin, spiBus, spiDevice,
+                                   transport=DispatchTransport(transport, self, slot), dio1Pin=dio1Pin, **kwargs)
+        radio.packetHandlers.append(lambda packet: self.queuePacket(radio, packet))
+        with self.lock:
+            self.slots.append(slot)
+        threading.Thread(target=self.txLoop, args=(slot,), daemon=True).start()
+        radio.receiveBegin()
+        return radio
+
+    @property
+    def radios(self):
+        with self.lock:
+            return [slot.radio for slot in self.slots]
+
+    def setupGpio(self):
+        with self.lock:
+            if self.gpioReady:
+                return
+            if self.gpio is None:
+                import RPi.GPIO
+                self.gpio = RPi.GPIO
+            if self.board is not None:
+                self.gpio.setboard(self.board)
+            self.gpio.setmode(self.gpio.BOARD)
+            self.gpioReady = True
+
+    # a shared reset pin is only pulsed for the first radio, later ones would wipe the configuration of the others
+    def reset(self, transport):
+        pin = getattr(transport, "rstPin", None)
+        with self.lock:
+            if pin is not None and pin in self.resetPins:
+                return
+            self.resetPins.add(pin)
+        transport.reset()
+
+    # runs on the GPIO library's thread
+    def dispatch(self, callback, pin, slot):
+        with self.interruptReady:
+            self.interrupts.append((callback, pin, slot))
+            self.interruptReady.notify()
+
+    def dispatchLoop(self):
+        while True:
+            with self.interruptReady:
+                while not self.closed and not self.interrupts:
+                    self.interruptReady.wait()
+                if self.closed:
+                    return
+                callback, pin, slot = self.interrupts.popleft()
+                self.interruptCount += 1
+            try:
+                callback(pin)
+            except Exception:
+                # one radio's failure mustn't stop the interrupts of the others
+                with slot.ready:
+                    slot.interruptFailures += 1
+
+    # runs on the dispatch thread, takes every packet that no other handler wanted
+    def queuePacket(self, radio, packet):
+        with self.rxReady:
+            self.rxReceived += 1
+            if len(self.rxBuffer) >= self.rxBufferSize:
+                self.rxDropped += 1
+                if not self.dropOldest:
+                    return True
+                self.rxBuffer.popleft()
+            self.rxBuffer.append(Received(radio, packet))
+            self.rxReady.notify()
+        return True
+
+    # next Received from any radio, or None if nothing arrived within timeout seconds (None waits forever)
+    def recv(self, timeout = None):
+        with self.rxReady:
+            if self.rxReady.wait_for(lambda: self.rxBuffer, timeout):
+                return self.rxBuffer.popleft()
+        return None
+
+    # queues a frame on the least loaded radio in networkID (any radio if None), or on radio if given
+    # returns a concurrent.futures.Future, True once sent, or with requestACK whether the ACK arrived
+    def send(self, toAddress, buff = "", requestACK = False, networkID = None, radio = None, retries = 3, retryWaitTime = 10):
+        with self.lock:
+            candidates = [slot for slot in self.slots if (radio is None or slot.radio is radio) and
+                          (networkID is None or slot.radio.networkID == networkID)]
+        if not candidates:
+            raise ValueError(f"no radio for network {networkID}")
+        slot = min(candidates, key=lambda slot: (slot.load(), slot.sent))
+        future = Future()
+        airTime = slot.radio.timeOnAir(min(len(buff), slot.radio.maxDataLen) + 3)
+        with slot.ready:
+            slot.queuedAirTime += airTime
+            slot.queue.append((toAddress, buff, requestACK, retries, retryWaitTime, airTime, future))
+            slot.ready.notify()
+        return future
+
+    def txLoop(self, slot):
+        radio = slot.radio
+        while True:
+            with slot.ready:
+                while not self.closed and not slot.queue:
+                    slot.ready.wait()
+                if self.closed:
+                    return
+                toAddress, buff, requestACK, retries, retryWaitTime, airTime, future = slot.queue.popleft()
+            start = time.monotonic()
+            try:
+                if requestACK:
+                    # the radio's retry thread takes it from here, other frames can go out while this one waits for its ACK
+                    reliable = radio.sendReliable(toAddress, buff, retries, retryWaitTime)
+                    reliable.add_done_callback(lambda done, airTime=airTime, future=future: self.finishReliable(slot, airTime, done, future))
+                else:
+                    radio.send(toAddress, buff)
+                    slot.release(airTime)
+                    future.set_result(True)
+            except Exception as error:
+                slot.release(airTime)
+                future.set_exception(error)
+            with slot.ready:
+                slot.sent += 1
+                if not requestACK:
+                    slot.accessDelay += (max(0.0, time.monotonic() - start - airTime) - slot.accessDelay) / 8
+
+    def finishReliable(self, slot, airTime, done, future):
+        slot.release(airTime)
+        if done.exception() is not None:
+            future.set_exception(done.exception())
+        else:
+            future.set_result(done.result())
+
+    def stats(self):
+        with self.lock:
+            slots = list(self.slots)
+        radios = []
+        for slot in slots:
+            with slot.ready:
+                radios.append({"nodeID": slot.radio.address, "networkID": slot.radio.networkID, "queued": len(slot.queue),
+                               "queuedAirTime": slot.queuedAirTime, "accessDelay": slot.accessDelay, "sent": slot.sent,
+                               "interruptFailures": slot.interruptFailures})
+        with self.rxReady:
+            return {"radios": radios, "rxReceived": self.rxReceived, "rxDropped": self.rxDropped,
+                    "rxBuffered": len(self.rxBuffer), "interrupts": self.interruptCount}
+
+    # shuts down every radio, then releases GPIO
+    def shutdown(self):
+        with self.lock:
+            slots = list(self.slots)
+            self.slots = []
+        for slot in slots:
+            with slot.ready:
+                self.closed = True
+                for item in slot.queue:
+                    item[-1].cancel()
+                slot.queue.clear()
+                slot.ready.notify()
+        with self.interruptReady:
+            self.closed = True
+            self.interruptReady.notify()
+        for slot in slots:
+            slot.radio.shutdown()
+        if self.gpioReady:
+            self.gpio.cleanup()
+            self.gpioReady = False
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# FSK modem settings derived from a bit rate and modulation index, so the registers that depend on each
+# other (bit rate, deviation, RX and AFC bandwidth, RX restart delay, AFC low beta and DAGC) always agree:
+#
+#     radio.setModemProfile(ModemProfile(100000, 1.0))
+#     radio.setModemProfile("300000")
+#
+# Both ends of a link need the same profile.
+
+from RFM69registers import *
+import math
+
+FSTEP = RF69_FXOSC / 2.0 ** 19
+
+# PARAMP register value to PA ramp time in seconds
+PA_RAMP = (0.0034, 0.002, 0.001, 0.0005, 0.00025, 0.000125, 0.0001, 0.000062,
+           0.00005, 0.00004, 0.000031, 0.000025, 0.00002, 0.000015, 0.000012, 0.00001)
+
+# single side FSK receiver bandwidths in Hz with their (mantissa, exponent) register bits, narrowest first
+BANDWIDTHS = sorted((RF69_FXOSC / (mantissa * 2 ** (exponent + 2)), bits << 3 | exponent)
+                    for exponent in range(8) for mantissa, bits in ((16, 0), (20, 1), (24, 2)))
+
+def bandwidth(required):
+    for hz, bits in BANDWIDTHS:
+        if hz >= required:
+            return hz, bits
+    raise ValueError(f"no receiver bandwidth covers {required:.0f}Hz, the widest is {BANDWIDTHS[-1][0]:.0f}Hz")
+
+class ModemProfile(object):
+    # modulationIndex is 2 * FDEV / bit rate, frequencyError is the carrier offset between the two crystals
+    # the AFC has to pull in, paRamp the transmitter's PA ramp time in seconds
+    def __init__(self, bitrate, modulationIndex = 2.0, frequencyError = 10000, paRamp = PA_RAMP[RF_PARAMP_40],
+                 shaping = RF_DATAMODUL_MODULATIONSHAPING_00):
+        if not 1200 <= bitrate <= 300000:
+            raise ValueError(f"FSK bit rate must be between 1200 and 300000 bps, not {bitrate}")
+        if not 0.5 <= modulationIndex <= 10:
+            raise ValueError(f"modulation index must be between 0.5 and 10, not {modulationIndex}")
+
+        self.bitrateValue = int(round(RF69_FXOSC / bitrate))
+        self.bitrate = RF69_FXOSC / self.bitrateValue
+        self.fdevValue = int(round(modulationIndex * self.bitrate / 2 / FSTEP))
+        self.fdev = self.fdevValue * FSTEP
+        self.modulationIndex = 2 * self.fdev / self.bitrate
+        if self.fdev < 600 or self.fdevValue > 0x3FFF:
+            raise ValueError(f"frequency deviation of {self.fdev:.0f}Hz is outside 600Hz to {0x3FFF * FSTEP:.0f}Hz")
+        # FDEV + BitRate/2 <= 500kHz
+        if self.fdev + self.bitrate / 2 > 500000:
+            raise ValueError(f"FDEV + bit rate / 2 is {self.fdev + self.bitrate / 2:.0f}Hz, more than 500kHz")
+
+        # the receiver has to pass the whole signal, FDEV + BitRate/2 (which also gives BitRate < 2 * RxBw)
+        self.rxBw, rxBits = bandwidth(self.fdev + self.bitrate / 2)
+        # AFC runs before the offset is corrected, so it also has to cover the frequency error
+        self.afcBw, afcBits = bandwidth(self.fdev + self.bitrate / 2 + frequencyError)
+        self.rxBwValue = RF_RXBW_DCCFREQ_010 | rxBits
+        self.afcBwValue = RF_AFCBW_DCCFREQAFC_100 | afcBits
+
+        # the datasheet recommends the low beta AFC below modulation index 2, DAGC has a setting for each
+        self.lowBeta = modulationIndex < 2
+        self.afcCtrlValue = RF_AFCCTRL_LOWBETA_ON if self.lowBeta else RF_AFCCTRL_LOWBETA_OFF
+        self.dagcValue = RF_DAGC_IMPROVED_LOWBETA1 if self.lowBeta else RF_DAGC_IMPROVED_LOWBETA0
+
+        # the receiver must not restart before the transmitter's PA has ramped down, in powers of 2 bits
+        bits = paRamp * self.bitrate
+        self.restartDelay = max(0, int(math.ceil(math.log2(bits)))) if bits > 1 else 0
+        if self.restartDelay > 11:
+            raise ValueError(f"PA ramp of {paRamp}s is longer than the maximum RX restart delay")
+        self.restartDelayValue = self.restartDelay << 4
+
+        self.dataModulValue = RF_DATAMODUL_DATAMODE_PACKET | RF_DATAMODUL_MODULATIONTYPE_FSK | shaping
+
+    # register -> value for everything the profile sets
+    def registers(self):
+        return {REG_DATAMODUL: self.dataModulValue,
+                REG_BITRATEMSB: self.bitrateValue >> 8, REG_BITRATELSB: self.bitrateValue & 0xFF,
+                REG_FDEVMSB: self.fdevValue >> 8, REG_FDEVLSB: self.fdevValue & 0xFF,
+                REG_AFCCTRL: self.afcCtrlValue,
+                REG_RXBW: self.rxBwValue, REG_AFCBW: self.afcBwValue,
+                REG_TESTDAGC: self.dagcValue}
+
+    def __repr__(self):
+        return (f"ModemProfile(bitrate={self.bitrate:.0f}, fdev={self.fdev:.0f}, modulationIndex={self.modulationIndex:.2f}, "
+                f"rxBw={self.rxBw:.0f}, afcBw={self.afcBw:.0f}, lowBeta={self.lowBeta}, restartDelay={2 ** self.restartDelay}bits)")
+
+# ready made profiles by bit rate, narrow deviation at low rates for sensitivity, index 1 above 100kbps to fit 500kHz
+PROFILES = {
+    "1200": ModemProfile(1200, 8.0),
+    "2400": ModemProfile(2400, 4.0),
+    "4800": ModemProfile(4800, 2.0),
+    "9600": ModemProfile(9600, 2.0),
+    "19200": ModemProfile(19200, 2.0),
+    "38400": ModemProfile(38400, 2.0),
+    "57600": ModemProfile(57600, 2.0),
+    "76800": ModemProfile(76800, 2.0),
+    "100000": ModemProfile(100000, 1.0),
+    "115200": ModemProfile(115200, 1.0),
+    "153600": ModemProfile(153600, 1.0),
+    "200000": ModemProfile(200000, 1.0),
+    "250000": ModemProfile(250000, 1.0),
+    "300000": ModemProfile(300000, 1.0),
+}
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+# Per-link adaptive data rate. Each node listens at one modem profile, and a sender switches to the profile its
+# peer listens at for the exchange (frame and ACK) and back to its own afterwards:
+#
+#     adapter = RFM69rate.RateAdapter(radio, base="4800")
+#     adapter.send(2, "Hello")
+#     print(adapter.stats()["peers"][2]["savedFraction"])
+#
+#     RFM69rate.RateAdapter(radio, base="4800", accept=False)     # on the gateway, it keeps listening at base
+#
+# Every node starts out listening at base. From the RSSI a peer reports in its ACKs (radio.reportRssi on the peer,
+# otherwise the RSSI of the ACKs themselves) and the share of exchanges that get an ACK, the adapter picks the
+# fastest profile that leaves margin dB above its sensitivity and proposes it in a frame with RF69_CTL_LINKINFO.
+# The peer answers in the ACK and moves its receiver to the new rate, then the sender confirms at the new rate.
+# Without the confirmation the peer goes back to base after confirmTimeout seconds, and it does so too when no
+# frame from the sender arrived at the new rate for lease seconds. The sender only counts on the faster rate for
+# half the lease after its last acknowledged exchange, and falls back to base as soon as one goes unanswered.
+#
+# A single demodulator listens at one rate at a time: a node listening faster than base misses broadcasts and
+# frames from everyone but its peer, so this suits leaf nodes talking to one gateway. Send through the adapter,
+# frames sent with radio.send() during an exchange go out at the peer's rate.
+
+from RFM69modem import PROFILES as MODEM_PROFILES
+from RFM69registers import *
+from collections import deque
+import math
+import struct
+import threading
+import time
+
+OP_PROPOSE = 0x01
+OP_ACCEPT = 0x02
+OP_REJECT = 0x03
+OP_CONFIRM = 0x04
+# op, nominal bit rate (the RFM69modem.PROFILES name), then the RSSI report RF69_CTL_LINKINFO frames end in
+MESSAGE = struct.Struct(">BI")
+
+# rough FSK sensitivity in dBm, -118dBm at 1200bps getting worse with the receiver bandwidth
+def sensitivity(bitrate):
+    return -118 + 10 * math.log10(bitrate / 1200.0)
+
+def rssiReport(rssi):
+    return bytes([max(-128, min(127, int(rssi))) & 0xFF]) if rssi is not None else b"\x80"
+
+# what we know about the link to one peer
+class Link(object):
+    def __init__(self, base):
+        # the profile the peer listens at
+        self.rate = base
+        # time.monotonic() of the last acknowledged exchange, which renewed the peer's lease
+        self.renewed = 0.0
+        # smoothed RSSI the peer receives us with, and the share of exchanges that got an ACK
+        self.rssi = None
+        self.ackRssi = None
+        self.samples = 0
+        self.ackRatio = 1.0
+        self.lastProposal = -math.inf
+        # [bit rate, answer] while a proposal waits for its ACK
+        self.proposal = None
+        self.exchanges = 0
+        self.failures = 0
+        # seconds on air of the acknowledged exchanges, and what they would have taken at base
+        self.airTime = 0.0
+        self.baseAirTime = 0.0
+        self.proposals = 0
+        self.switches = 0
+        self.fallbacks = 0
+
+class RateAdapter(object):
+    # rates are the PROFILES names the adapter may use (all of them by default), margin the dB above sensitivity a
+    # rate needs, hysteresis the extra dB before moving up or the shortfall before moving down, minSamples the RSSI
+    # samples before the first proposal, holdoff the seconds between proposals to a peer, minAckRatio the share of
+    # acknowledged exchanges below which the link steps down. With accept False proposals from peers are rejected.
+    def __init__(self, radio, base = "4800", rates = None, margin = 10, hysteresis = 3, minSamples = 4, holdoff = 30.0,
+                 minAckRatio = 0.5, lease = 10.0, confirmTimeout = 2.0, accept = True):
+        self.rates = sorted(rates or MODEM_PROFILES, key=lambda name: MODEM_PROFILES[name].bitrate)
+        if base not in self.rates:
+            raise ValueError(f"the base rate {base} isn't one of the adapter's rates")
+        self.radio = radio
+        self.base = base
+        self.margin = margin
+        self.hysteresis = hysteresis
+        self.minSamples = minSamples
+        self.holdoff = holdoff
+        self.minAckRatio = minAckRatio
+        self.lease = lease
+        self.confirmTimeout = confirmTimeout
+        self.accept = accept
+        self.lock = threading.Lock()
+        # held while the radio runs at anything but our own rate, and while our own rate changes
+        self.exchangeLock = threading.Lock()
+        self.links = {}
+        # the profile we listen at, the peer that asked for it and until when it holds
+        self.home = base
+        self.homePeer = None
+        self.homeUntil = 0.0
+        self.confirmed = True
+        self.homeChanges = 0
+        self.homeExpired = 0
+        # proposals waiting for their answer
+        self.proposals = deque()
+        self.ready = threading.Condition(self.lock)
+        self.stopped = False
+        radio.setModemProfile(base)
+        # link control frames never reach the receive buffer
+        radio.packetHandlers.insert(0, self.handlePacket)
+        radio.ackHooks.append(self.handleAck)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.ready:
+            self.stopped = True
+            self.ready.notify()
+        self.radio.packetHandlers.remove(self.handlePacket)
+        self.radio.ackHooks.remove(self.handleAck)
+
+    def link(self, peer):
+        with self.lock:
+            link = self.links.get(peer)
+            if link is None:
+                link = self.links[peer] = Link(self.base)
+            return link
+
+    def switch(self, name):
+        profile = MODEM_PROFILES[name]
+        if self.radio.modemProfile is not profile:
+            self.radio.setModemProfile(profile)
+
+    # the fastest rate the RSSI supports with margin to spare, base if none does
+    def rateForRssi(self, rssi, extra = 0):
+        best = self.base
+        for name in self.rates:
+            if sensitivity(MODEM_PROFILES[name].bitrate) + self.margin + extra <= rssi:
+                best = name
+        return best
+
+    # the rate the peer listens at, as far as we can count on it, call with the lock held
+    def currentRate(self, link):
+        if link.rate != self.base and time.monotonic() - link.renewed > self.lease / 2:
+            link.rate = self.base
+        return link.rate
+
+    # runs on the interrupt thread, only frames that arrive at our own rate renew the lease
+    def heard(self, sender):
+        with self.lock:
+            if sender == self.homePeer and self.confirmed and self.radio.modemProfile is MODEM_PROFILES[self.home]:
+                self.homeUntil = time.monotonic() + self.lease
+
+    def handlePacket(self, packet):
+        self.heard(packet.sender)
+        if not packet.ctl & RF69_CTL_LINKINFO or len(packet.data) < MESSAGE.size:
+            return False
+        op, bitrate = MESSAGE.unpack_from(packet.data)
+        if op == OP_PROPOSE:
+            # answered from our thread, the ACK can't go out from the interrupt thread
+            with self.ready:
+                self.proposals.append(packet)
+                self.ready.notify()
+        elif op == OP_CONFIRM:
+            with self.lock:
+                if packet.sender == self.homePeer and self.home == str(bitrate):
+                    self.confirmed = True
+                    self.homeUntil = time.monotonic() + self.lease
+            if packet.ackRequested:
+                self.radio.resendACK(packet)
+        return True
+
+    def handleAck(self, packet, reported):
+        with self.lock:
+            link = self.links.get(packet.sender)
+            if link is None or packet.target != self.radio.address:
+                return
+            # same path loss both ways without a report
+            sample = packet.rssi if reported is None else reported
+            link.rssi = sample if link.rssi is None else link.rssi + (sample - link.rssi) / 4
+            link.ackRssi = packet.rssi
+            link.samples += 1
+            if link.proposal is not None and packet.ctl & RF69_CTL_LINKINFO and len(packet.data) >= MESSAGE.size:
+                op, bitrate = MESSAGE.unpack_from(packet.data)
+                if op in (OP_ACCEPT, OP_REJECT) and bitrate == link.proposal[0]:
+                    link.proposal[1] = op
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.stopped and not self.proposals and not (self.homePeer is not None and
+                                                                       time.monotonic() >= self.homeUntil):
+                    self.ready.wait(None if self.homePeer is None else max(0.0, self.homeUntil - time.monotonic()))
+                if self.stopped:
+                    return
+                packet = self.proposals.popleft() if self.proposals else None
+            if packet is None:
+                self.expire()
+            else:
+                self.answer(packet)
+
+    def answer(self, packet):
+        op, bitrate = MESSAGE.unpack_from(packet.data)
+        name = str(bitrate)
+        with self.lock:
+            ok = (self.accept and name in self.rates and packet.rssi >= sensitivity(bitrate) + self.margin and
+                  self.homePeer in (None, packet.sender))
+        with self.exchangeLock:
+            # the ACK goes out at the rate the proposal came in at, then we move over
+            self.radio.csmaSend(packet.sender, MESSAGE.pack(OP_ACCEPT if ok else OP_REJECT, bitrate) + rssiReport(packet.rssi),
+                                False, True, packet.sequence, RF69_CTL_LINKINFO)
+            if not ok:
+                return
+            with self.lock:
+                self.home = name
+                self.homeChanges += 1
+                if name == self.base:
+                    self.homePeer = None
+                    self.confirmed = True
+                else:
+                    self.homePeer = packet.sender
+                    self.confirmed = False
+                    self.homeUntil = time.monotonic() + self.confirmTimeout
+                    self.ready.notify()
+            self.switch(name)
+
+    # back to base once the peer we listen faster for went quiet (or never confirmed)
+    def expire(self):
+        with self.exchangeLock:
+            with self.lock:
+                if self.homePeer is None or time.monotonic() < self.homeUntil:
+                    return
+                self.home = self.base
+                self.homePeer = None
+                self.confirmed = True
+                self.homeExpired += 1
+            self.switch(self.base)
+
+    # one reliable send at the rate the peer listens at, returns whether it was acknowledged
+    def exchange(self, peer, buff, retries, retryWaitTime, flags = 0):
+        radio = self.radio
+        link = self.link(peer)
+        with self.lock:
+            name = self.currentRate(link)
+        bitrate = MODEM_PROFILES[name].bitrate
+        # the ACK takes longer than retryWaitTime allows for at low rates
+        ackTime = radio.timeOnAir(4, bitrate)
+        self.switch(name)
+        try:
+            acked = radio.sendWithRetry(peer, buff, retries, retryWaitTime + int(math.ceil(ackTime * 1000)), flags)
+        finally:
+            self.switch(self.home)
+        length = min(len(buff), radio.maxDataLen) + 3
+        with self.lock:
+            link.exchanges += 1
+            link.ackRatio += ((1.0 if acked else 0.0) - link.ackRatio) / 8
+            if acked:
+                link.renewed = time.monotonic()
+                link.airTime += radio.timeOnAir(length, bitrate) + ackTime
+                baseBitrate = MODEM_PROFILES[self.base].bitrate
+                link.baseAirTime += radio.timeOnAir(length, baseBitrate) + radio.timeOnAir(4, baseBitrate)
+            else:
+                link.failures += 1
+                if name != self.base:
+                    # the peer goes back to base by itself once its lease runs out
+                    link.rate = self.base
+                    link.fallbacks += 1
+                if peer == self.homePeer:
+                    # and so do we, the peer may have given up on our rate already
+                    self.homeUntil = 0.0
+                    self.ready.notify()
+        return acked
+
+    # proposes a new rate if the link stats call for one
+    def adapt(self, peer):
+        link = self.link(peer)
+        now = time.monotonic()
+        with self.lock:
+            if link.samples < self.minSamples or now - link.lastProposal < self.holdoff:
+                return
+            current = self.currentRate(link)
+            index = self.rates.index(current)
+            # missing ACKs only say something about the faster rates, at base they're the link's own business
+            if link.ackRatio < self.minAckRatio and index > self.rates.index(self.base):
+                target = self.rates[index - 1]
+            elif link.rssi < sensitivity(MODEM_PROFILES[current].bitrate) + self.margin - self.hysteresis:
+                target = self.rateForRssi(link.rssi)
+            elif link.ackRatio >= 0.9:
+                target = self.rateForRssi(link.rssi, self.hysteresis)
+                if self.rates.index(target) <= index:
+                    return
+            else:
+                return
+            if target == current:
+                return
+            link.lastProposal = now
+            link.proposals += 1
+        self.propose(peer, link, target)
+
+    def propose(self, peer, link, name):
+        with self.lock:
+            link.proposal = [int(name), None]
+            report = rssiReport(link.ackRssi)
+        acked = self.exchange(peer, MESSAGE.pack(OP_PROPOSE, int(name)) + report, 2, 10, RF69_CTL_LINKINFO)
+        with self.lock:
+            answer = link.proposal[1]
+            link.proposal = None
+            if not acked or answer != OP_ACCEPT:
+                return False
+            # the peer listens at the new rate now, the confirmation has to get through at it
+            link.rate = name
+            link.renewed = time.monotonic()
+        # if it doesn't get through, exchange() falls back to base and so does the peer without its confirmation
+        if not self.exchange(peer, MESSAGE.pack(OP_CONFIRM, int(name)) + report, 3, 10, RF69_CTL_LINKINFO):
+            return False
+        with self.lock:
+            link.switches += 1
+        return True
+
+    # a reliable send to toAddress that may renegotiate the link's rate first, broadcasts go out at base without ACK
+    def send(self, toAddress, buff = "", retries = 3, retryWaitTime = 10):
+        with self.exchangeLock:
+            if toAddress == RF69_BROADCAST_ADDR:
+                self.switch(self.base)
+                try:
+                    self.radio.send(toAddress, buff)
+                finally:
+                    self.switch(self.home)
+                return True
+            self.adapt(toAddress)
+            return self.exchange(toAddress, buff, retries, retryWaitTime)
+
+    def stats(self):
+        with self.lock:
+            peers = {}
+            for peer, link in self.links.items():
+                saved = link.baseAirTime - link.airTime
+                peers[peer] = {"rate": int(self.currentRate(link)), "rssi": link.rssi, "ackRatio": link.ackRatio,
+                               "exchanges": link.exchanges, "failures": link.failures, "airTime": link.airTime,
+                               "baseAirTime": link.baseAirTime, "saved": saved,
+                               "savedFraction": saved / link.baseAirTime if link.baseAirTime else 0.0,
+                               "proposals": link.proposals, "switches": link.switches, "fallbacks": link.fallbacks}
+            return {"home": int(self.home), "homePeer": self.homePeer, "homeChanges": self.homeChanges,
+                    "homeExpired": self.homeExpired, "peers": peers}
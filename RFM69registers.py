@@ -421,6 +421,12 @@ RF_FRFLSB_928 = 0x00
 RF_OSC1_RCCAL_START = 0x80
 RF_OSC1_RCCAL_DONE = 0x40
 
+
+# RegAfcCtrl
+RF_AFCCTRL_LOWBETA_OFF = 0x00  # Default
+RF_AFCCTRL_LOWBETA_ON = 0x20
+
+
 # RegLowBat
 RF_LOWBAT_MONITOR = 0x10
 RF_LOWBAT_ON = 0x08
@@ -441,6 +447,14 @@ RF_LISTEN1_RESOL_64 = 0x50
 RF_LISTEN1_RESOL_4100 = 0xA0  # Default
 RF_LISTEN1_RESOL_262000 = 0xF0
 
+RF_LISTEN1_RESOL_IDLE_64 = 0x40
+RF_LISTEN1_RESOL_IDLE_4100 = 0x80  # Default
+RF_LISTEN1_RESOL_IDLE_262000 = 0xC0
+
+RF_LISTEN1_RESOL_RX_64 = 0x10
+RF_LISTEN1_RESOL_RX_4100 = 0x20  # Default
+RF_LISTEN1_RESOL_RX_262000 = 0x30
+
 RF_LISTEN1_CRITERIA_RSSI = 0x00  # Default
 RF_LISTEN1_CRITERIA_RSSIANDSYNC = 0x08
 
@@ -1077,6 +1091,8 @@ RF69_868MHZ = 86
 RF69_915MHZ = 91
 
 RF69_MAX_DATA_LEN = 61 # to take advantage of the built in AES/CRC we want to limit the frame size to the internal FIFO size (66 bytes - 3 bytes overhead)
+RF69_MAX_LONG_DATA_LEN = 252 # with RFM69.setLongFrames, 255 byte frames streamed through the FIFO (AES off)
+RF69_FIFO_SIZE = 66
 
 CSMA_LIMIT = -90 # upper RX signal sensitivity threshold in dBm for carrier sense access
 RF69_MODE_SLEEP = 0 # XTAL OFF
@@ -1084,10 +1100,24 @@ RF69_MODE_STANDBY = 1 # XTAL ON
 RF69_MODE_SYNTH	= 2 # PLL ON
 RF69_MODE_RX = 3 # RX MODE
 RF69_MODE_TX = 4 # TX MODE
+RF69_MODE_LISTEN = 5 # LISTEN MODE, cycling between idle and RX on the chip's own timer
 
+RF69_FXOSC = 32000000 # crystal frequency, bit rate and RX bandwidth are derived from it
 COURSE_TEMP_COEF = -90 # puts the temperature reading in the ballpark, user can fine tune the returned value
 RF69_BROADCAST_ADDR = 255
+
+# frame control byte
+RF69_CTL_SENDACK = 0x80
+RF69_CTL_REQACK = 0x40
+RF69_CTL_LINKINFO = 0x20 # the last payload byte is an RSSI report, in an ACK the RSSI the acknowledged frame arrived with
+RF69_CTL_TRANSFER = 0x10 # fragment or selective ACK of a large message, see RFM69transfer.py
+RF69_CTL_SEQUENCE = 0x0F # sequence number, echoed back in the ACK
 RF69_CSMA_LIMIT_MS = 1000
 RF69_CSMA_LIMIT_S = 1
+RF69_RSSI_TIMEOUT_S = 0.05 # a forced RSSI reading takes a few bit times, give up on a chip that never sets RSSIDONE
+
+# registers the chip changes on its own, these are never served from the register shadow
+RF69_VOLATILE_REGS = frozenset([REG_FIFO, REG_OSC1, REG_AFCFEI, REG_AFCMSB, REG_AFCLSB, REG_FEIMSB, REG_FEILSB,
+                                REG_RSSICONFIG, REG_RSSIVALUE, REG_IRQFLAGS1, REG_IRQFLAGS2, REG_TEMP1, REG_TEMP2])
 
 powerLevel = 31
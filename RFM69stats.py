@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# Counters and latency histograms for the driver, off unless instrument() is called on a radio:
+#
+#     stats = RFM69stats.instrument(radio)
+#     ...
+#     print(radio.stats())
+#     print(RFM69stats.prometheus(radio.stats()))
+#
+# Covered are SPI transactions per register and per public method, the time spent in each wait loop,
+# interrupts, packets accepted or dropped by the address check, receiver restarts and CSMA deferrals.
+# Without instrumentation the driver only pays for an attribute check at each of these points.
+
+from bisect import bisect_left
+from collections import Counter
+import threading
+import time
+
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# entry points whose SPI transactions and duration are recorded
+PUBLIC_METHODS = ("send", "sendWithRetry", "sendReliable", "sendACK", "receiveBegin", "receiveDone", "recv", "interruptHandler",
+                  "readRSSI", "encrypt", "setFrequency", "setChannel", "setPowerLevel", "setPowerDbm", "setHighPower", "readTemperature", "rcCalibration",
+                  "listenModeStart", "listenModeEnd", "listenModeSend", "sleep")
+
+class Histogram(object):
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.sum, "buckets": list(zip(BUCKETS + (float("inf"),), self.counts))}
+
+class RadioStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.registerReads = Counter()
+        self.registerWrites = Counter()
+        self.methodCalls = Counter()
+        self.methodSpi = Counter()
+        self.spiBytes = 0
+        # wait loop name -> number of register polls
+        self.spins = Counter()
+        self.histograms = {}
+        # public methods currently running on each thread, the outermost one gets the SPI transactions
+        self.calls = threading.local()
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def waited(self, name, seconds, spins):
+        with self.lock:
+            self.spins[name] += spins
+        self.observe("wait:" + name, seconds)
+
+    def transaction(self, addr, length, seconds):
+        method = getattr(self.calls, "stack", None)
+        with self.lock:
+            if addr & 0x80:
+                self.registerWrites[addr & 0x7F] += 1
+            else:
+                self.registerReads[addr & 0x7F] += 1
+            self.spiBytes += length
+            self.methodSpi[method[0] if method else None] += 1
+        self.observe("spi", seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return {"counters": dict(self.counters),
+                    "registerReads": {hex(addr): n for addr, n in sorted(self.registerReads.items())},
+                    "registerWrites": {hex(addr): n for addr, n in sorted(self.registerWrites.items())},
+                    "methodCalls": dict(self.methodCalls),
+                    "methodSpiTransactions": {str(name): n for name, n in self.methodSpi.items()},
+                    "spiBytes": self.spiBytes,
+                    "waitSpins": dict(self.spins),
+                    "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()}}
+
+# times every transaction and books it to its register and the public method it was made from
+class InstrumentedTransport(object):
+    def __init__(self, transport, stats):
+        self.transport = transport
+        self.stats = stats
+
+    def xfer(self, data):
+        start = time.perf_counter()
+        result = self.transport.xfer(data)
+        self.stats.transaction(data[0], len(data), time.perf_counter() - start)
+        return result
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.transport.write(data)
+        self.stats.transaction(data[0], len(data), time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+def wrapMethod(stats, name, method):
+    def wrapper(*args, **kwargs):
+        stack = getattr(stats.calls, "stack", None)
+        if stack is None:
+            stack = stats.calls.stack = []
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stack.pop()
+            with stats.lock:
+                stats.methodCalls[name] += 1
+            stats.observe("method:" + name, time.perf_counter() - start)
+    wrapper.wrapped = method
+    return wrapper
+
+def instrument(radio):
+    if radio.metrics is not None:
+        return radio.metrics
+    stats = RadioStats()
+    with radio.lock:
+        radio.transport = InstrumentedTransport(radio.transport, stats)
+        for name in PUBLIC_METHODS:
+            setattr(radio, name, wrapMethod(stats, name, getattr(radio, name)))
+        # the interrupt callback was registered before the wrapper existed
+        radio.transport.attachInterrupt(radio.interruptHandler)
+        radio.metrics = stats
+    return stats
+
+def uninstrument(radio):
+    if radio.metrics is None:
+        return
+    with radio.lock:
+        for name in PUBLIC_METHODS:
+            del radio.__dict__[name]
+        radio.transport = radio.transport.transport
+        radio.transport.attachInterrupt(radio.interruptHandler)
+        radio.metrics = None
+
+# rxDropped -> rfm69_rx_dropped
+def metricName(prefix, name):
+    return prefix + "_" + "".join("_" + c.lower() if c.isupper() else c if c.isalnum() else "_" for c in name)
+
+# Prometheus text exposition format of a radio.stats() snapshot
+def prometheus(snapshot, prefix = "rfm69", labels = None):
+    labelText = ",".join(f'{key}="{value}"' for key, value in sorted((labels or {}).items()))
+    def sample(name, value, extra = ""):
+        allLabels = ",".join(part for part in (labelText, extra) if part)
+        return f"{name}{{{allLabels}}} {value}" if allLabels else f"{name} {value}"
+
+    lines = []
+    for name, value in snapshot.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"# TYPE {metricName(prefix, name)} gauge")
+            lines.append(sample(metricName(prefix, name), value))
+    metrics = snapshot.get("metrics")
+    if metrics is None:
+        return "\n".join(lines) + "\n"
+
+    for name, value in sorted(metrics["counters"].items()):
+        lines.append(f"# TYPE {metricName(prefix, name)}_total counter")
+        lines.append(sample(metricName(prefix, name) + "_total", value))
+    for family, label in (("registerReads", "register"), ("registerWrites", "register"),
+                          ("methodCalls", "method"), ("methodSpiTransactions", "method"), ("waitSpins", "loop")):
+        name = metricName(prefix, family) + "_total"
+        lines.append(f"# TYPE {name} counter")
+        for key, value in sorted(metrics[family].items()):
+            lines.append(sample(name, value, f'{label}="{key}"'))
+    lines.append(f"# TYPE {prefix}_spi_bytes_total counter")
+    lines.append(sample(f"{prefix}_spi_bytes_total", metrics["spiBytes"]))
+    # the samples of every label set of a family go together, under a single TYPE line
+    families = {}
+    for name, histogram in sorted(metrics["histograms"].items()):
+        kind, _, what = name.rpartition(":")
+        family = metricName(prefix, (kind or name) + "_seconds")
+        extra = f'{"loop" if kind == "wait" else "method"}="{what}"' if kind else ""
+        samples = families.setdefault(family, [])
+        total = 0
+        for bound, count in histogram["buckets"]:
+            total += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            samples.append(sample(family + "_bucket", total, ",".join(part for part in (extra, f'le="{le}"') if part)))
+        samples.append(sample(family + "_sum", histogram["sum"], extra))
+        samples.append(sample(family + "_count", histogram["count"], extra))
+    for family, samples in families.items():
+        lines.append(f"# TYPE {family} histogram")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+# Messages larger than RF69_MAX_DATA_LEN, split into fragments that go out a window at a time.
+# After each window the receiver answers with a selective ACK listing what it has, and only the
+# missing fragments are sent again:
+#
+#     transfer = RFM69transfer.Transfer(radio)
+#     report = transfer.send(2, firmware)
+#     print(report["completed"], report["goodput"], report["efficiency"])
+#
+#     message = transfer.recv()        # on the other node
+#
+# Fragments and selective ACKs carry RF69_CTL_TRANSFER in the control byte and never show up in radio.recv().
+
+from RFM69registers import *
+from collections import OrderedDict, deque, namedtuple
+import random
+import struct
+import threading
+import time
+
+# frame types, TYPE_SACKREQ marks the last fragment of a window
+TYPE_DATA = 0x00
+TYPE_SACK = 0x01
+TYPE_ABORT = 0x02
+TYPE_SACKREQ = 0x80
+
+# type, transfer id, fragment index, fragment count
+DATA_HEADER = struct.Struct(">BBHH")
+# type, transfer id, first missing fragment, bitmap of the 32 fragments after it
+SACK_FORMAT = struct.Struct(">BBHI")
+FRAGMENT_SIZE = RF69_MAX_DATA_LEN - DATA_HEADER.size
+SACK_BITS = 32
+
+# a reassembled message, timestamp is time.monotonic() when its last fragment arrived
+Message = namedtuple("Message", "data sender timestamp")
+
+# a message being received, memory for all of it is reserved up front
+class Reassembly(object):
+    __slots__ = ("sender", "transferId", "count", "data", "have", "missing", "length", "updated")
+
+    def __init__(self, sender, transferId, count):
+        self.sender = sender
+        self.transferId = transferId
+        self.count = count
+        self.data = bytearray(count * FRAGMENT_SIZE)
+        self.have = bytearray(count)
+        self.missing = count
+        self.length = 0
+        self.updated = time.monotonic()
+
+    def add(self, index, chunk):
+        if not self.have[index]:
+            self.have[index] = 1
+            self.missing -= 1
+            self.data[index * FRAGMENT_SIZE:index * FRAGMENT_SIZE + len(chunk)] = chunk
+            if index == self.count - 1:
+                self.length = index * FRAGMENT_SIZE + len(chunk)
+        self.updated = time.monotonic()
+
+    def sack(self):
+        first = self.have.find(0) if self.missing else self.count
+        bitmap = 0
+        for bit in range(SACK_BITS):
+            if first + 1 + bit < self.count and self.have[first + 1 + bit]:
+                bitmap |= 1 << bit
+        return SACK_FORMAT.pack(TYPE_SACK, self.transferId, first, bitmap)
+
+# a message being sent, the interrupt thread records its selective ACKs here
+class Outgoing(object):
+    def __init__(self, count):
+        self.acked = bytearray(count)
+        self.sackReceived = threading.Event()
+        self.aborted = False
+
+class Transfer(object):
+    # window is the number of fragments sent before waiting for a selective ACK, at most SACK_BITS
+    # messages over maxMessageSize and more than maxReassemblies at once are refused, and a
+    # reassembly that doesn't get a fragment for reassemblyTimeout seconds is dropped. A finished
+    # transfer is remembered for as long, to answer late duplicates of its fragments
+    def __init__(self, radio, window = 8, retries = 5, sackTimeout = None, maxMessageSize = 65536,
+                 maxReassemblies = 4, reassemblyTimeout = 10, messageBufferSize = 8):
+        if not 1 <= window <= SACK_BITS:
+            raise ValueError(f"window must be between 1 and {SACK_BITS} fragments")
+        self.radio = radio
+        self.window = window
+        self.retries = retries
+        self.sackTimeout = sackTimeout
+        self.maxMessageSize = maxMessageSize
+        self.maxReassemblies = maxReassemblies
+        self.reassemblyTimeout = reassemblyTimeout
+        self.lock = threading.Lock()
+        # (peer, transfer id) -> Outgoing
+        self.outgoing = {}
+        # transfer ids start at random, so a restarted sender doesn't reuse the ids of its last run
+        self.nextId = {}
+        # (sender, transfer id) -> Reassembly, oldest first
+        self.reassemblies = OrderedDict()
+        # recently finished (sender, transfer id, fragment count) -> (final selective ACK, time.monotonic()),
+        # so late duplicates get a final ACK instead of a new reassembly
+        self.finished = OrderedDict()
+        self.messages = deque()
+        self.messageBufferSize = messageBufferSize
+        self.messageReady = threading.Condition(self.lock)
+        # replies are sent from a worker thread, the interrupt thread must not wait for a transmission
+        self.replies = deque()
+        self.replyReady = threading.Condition(self.lock)
+        self.fragmentsReceived = 0
+        self.messagesDropped = 0
+        # selective ACKs and aborts the radio failed to send, the sender asks again
+        self.replyFailures = 0
+        threading.Thread(target=self.replyLoop, daemon=True).start()
+        radio.packetHandlers.append(self.handlePacket)
+
+    def close(self):
+        self.radio.packetHandlers.remove(self.handlePacket)
+
+    # sends data to toAddress, returns a report with "completed" and the goodput against the raw bit rate
+    def send(self, toAddress, data, timeout = None):
+        data = bytes(data.encode(self.radio.encoding) if isinstance(data, str) else data)
+        count = max(1, (len(data) + FRAGMENT_SIZE - 1) // FRAGMENT_SIZE)
+        if count > 0xFFFF:
+            raise ValueError(f"message of {len(data)} bytes needs more than 65535 fragments")
+        with self.lock:
+            transferId = self.nextId.get(toAddress)
+            if transferId is None:
+                transferId = random.randrange(0x100)
+            self.nextId[toAddress] = (transferId + 1) & 0xFF
+            outgoing = self.outgoing[(toAddress, transferId)] = Outgoing(count)
+        # long enough for the receiver to turn around and send a full frame back
+        sackTimeout = self.sackTimeout or max(0.05, 4 * self.radio.timeOnAir(RF69_MAX_DATA_LEN + 3))
+        start = time.monotonic()
+        sent = 0
+        failures = 0
+        try:
+            while not outgoing.aborted and 0 in outgoing.acked:
+                if timeout is not None and time.monotonic() - start > timeout:
+                    break
+                # the next window of fragments that haven't been acknowledged
+                base = outgoing.acked.index(0)
+                burst = [index for index in range(base, min(count, base + SACK_BITS)) if not outgoing.acked[index]][:self.window]
+                outgoing.sackReceived.clear()
+                for i, index in enumerate(burst):
+                    kind = TYPE_DATA | (TYPE_SACKREQ if i == len(burst) - 1 else 0)
+                    frame = DATA_HEADER.pack(kind, transferId, index, count) + data[index * FRAGMENT_SIZE:(index + 1) * FRAGMENT_SIZE]
+                    self.radio.send(toAddress, frame, flags=RF69_CTL_TRANSFER)
+                    sent += 1
+                if outgoing.sackReceived.wait(sackTimeout):
+                    failures = 0
+                else:
+                    failures += 1
+                    if failures > self.retries:
+                        break
+        finally:
+            with self.lock:
+                del self.outgoing[(toAddress, transferId)]
+        elapsed = time.monotonic() - start
+        bitrate = RF69_FXOSC / ((self.radio.shadow[REG_BITRATEMSB] << 8) | self.radio.shadow[REG_BITRATELSB])
+        completed = not outgoing.aborted and 0 not in outgoing.acked
+        goodput = len(data) * 8 / elapsed if completed and elapsed > 0 else 0.0
+        return {"completed": completed, "aborted": outgoing.aborted, "bytes": len(data), "seconds": elapsed,
+                "fragments": count, "fragmentsSent": sent, "retransmissions": sent - count if sent > count else 0,
+                "goodput": goodput, "bitrate": bitrate, "efficiency": goodput / bitrate}
+
+    # next reassembled Message, or None if none arrived within timeout seconds (None waits forever)
+    def recv(self, timeout = None):
+        with self.messageReady:
+            if self.messageReady.wait_for(lambda: self.messages, timeout):
+                return self.messages.popleft()
+        return None
+
+    # runs on the interrupt thread
+    def handlePacket(self, packet):
+        if not packet.ctl & RF69_CTL_TRANSFER or not packet.data:
+            return False
+        kind = packet.data[0] & ~TYPE_SACKREQ
+        if kind == TYPE_DATA and len(packet.data) >= DATA_HEADER.size:
+            self.handleFragment(packet)
+        elif kind == TYPE_SACK and len(packet.data) >= SACK_FORMAT.size:
+            self.handleSack(packet)
+        elif kind == TYPE_ABORT and len(packet.data) >= 2:
+            with self.lock:
+                outgoing = self.outgoing.get((packet.sender, packet.data[1]))
+            if outgoing is not None:
+                outgoing.aborted = True
+                outgoing.sackReceived.set()
+        return True
+
+    def handleSack(self, packet):
+        kind, transferId, first, bitmap = SACK_FORMAT.unpack_from(packet.data)
+        with self.lock:
+            outgoing = self.outgoing.get((packet.sender, transferId))
+        if outgoing is None:
+            return
+        count = len(outgoing.acked)
+        outgoing.acked[:min(first, count)] = b"\x01" * min(first, count)
+        for bit in range(SACK_BITS):
+            if bitmap & (1 << bit) and first + 1 + bit < count:
+                outgoing.acked[first + 1 + bit] = 1
+        outgoing.sackReceived.set()
+
+    def handleFragment(self, packet):
+        kind, transferId, index, count = DATA_HEADER.unpack_from(packet.data)
+        key = (packet.sender, transferId)
+        with self.lock:
+            self.fragmentsReceived += 1
+            self.expire()
+            reassembly = self.reassemblies.get(key)
+            if reassembly is None or reassembly.count != count:
+                done = self.finished.get((packet.sender, transferId, count))
+                if done is not None:
+                    # the sender missed our last ACK
+                    if kind & TYPE_SACKREQ:
+                        self.reply(packet.sender, done[0])
+                    return
+                if count * FRAGMENT_SIZE > self.maxMessageSize or len(self.reassemblies) >= self.maxReassemblies:
+                    self.reply(packet.sender, bytes([TYPE_ABORT, transferId]))
+                    return
+                reassembly = self.reassemblies[key] = Reassembly(packet.sender, transferId, count)
+            if index < count:
+                reassembly.add(index, packet.data[DATA_HEADER.size:])
+            if not reassembly.missing:
+                del self.reassemblies[key]
+                sack = reassembly.sack()
+                self.finished[(packet.sender, transferId, count)] = (sack, time.monotonic())
+                if len(self.finished) > 16:
+                    self.finished.popitem(last=False)
+                self.reply(packet.sender, sack)
+                if len(self.messages) >= self.messageBufferSize:
+                    self.messages.popleft()
+                    self.messagesDropped += 1
+                self.messages.append(Message(bytes(reassembly.data[:reassembly.length]), packet.sender, packet.timestamp))
+                self.messageReady.notify_all()
+            elif kind & TYPE_SACKREQ:
+                self.reply(packet.sender, reassembly.sack())
+
+    # called with the lock held
+    def expire(self):
+        now = time.monotonic()
+        while self.reassemblies:
+            key, reassembly = next(iter(self.reassemblies.items()))
+            if now - reassembly.updated < self.reassemblyTimeout:
+                break
+            del self.reassemblies[key]
+            self.messagesDropped += 1
+        while self.finished:
+            key, (sack, finished) = next(iter(self.finished.items()))
+            if now - finished < self.reassemblyTimeout:
+                break
+            del self.finished[key]
+
+    # called with the lock held
+    def reply(self, toAddress, frame):
+        self.replies.append((toAddress, frame))
+        self.replyReady.notify()
+
+    def replyLoop(self):
+        while True:
+            with self.replyReady:
+                while not self.replies:
+                    # wake up now and then to drop stale reassemblies even when nothing arrives
+                    if not self.replyReady.wait(self.reassemblyTimeout):
+                        self.expire()
+                toAddress, frame = self.replies.popleft()
+            try:
+                self.radio.send(toAddress, frame, flags=RF69_CTL_TRANSFER)
+            except Exception:
+                with self.lock:
+                    self.replyFailures += 1
+
+    def stats(self):
+        with self.lock:
+            return {"fragmentsReceived": self.fragmentsReceived, "messagesDropped": self.messagesDropped,
+                    "replyFailures": self.replyFailures, "reassemblies": len(self.reassemblies),
+                    "messagesBuffered": len(self.messages)}
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Hardware access for the RFM69 driver: SPI transfers, the reset pin and DIO interrupt edges.
+# Anything with the same methods can be passed to RFM69 as transport, see RFM69emulator.py.
+#
+# Preconfigured for Raspberry Pi
+# For Orange Pi, pass:
+# - gpio = OPi.GPIO (pip install OrangePi.GPIO)
+# - spiBus = 1
+# - board = the correct board type, e.g. OPi.GPIO.ZERO
+#   see https://pypi.org/project/OrangePi.GPIO/
+
+import time
+
+class SpiDevTransport(object):
+    # dio1Pin is only needed for RFM69.setLongFrames
+    # shared leaves the GPIO numbering mode and the final cleanup to whoever set it up (RFM69manager)
+    def __init__(self, intPin = 18, rstPin = 22, spiBus = 0, spiDevice = 0, speed = 4000000, gpio = None, board = None, dio1Pin = None,
+                 shared = False):
+        # imported here so the driver can be loaded on machines without them
+        import spidev
+        if gpio is None:
+            import RPi.GPIO as gpio
+        self.gpio = gpio
+        # DIO number to header pin
+        self.pins = {0: intPin}
+        if dio1Pin is not None:
+            self.pins[1] = dio1Pin
+        self.rstPin = rstPin
+        self.shared = shared
+
+        if not shared:
+            if board is not None:
+                gpio.setboard(board)
+            gpio.setmode(gpio.BOARD)
+        gpio.setup(intPin, gpio.IN)
+        if dio1Pin is not None:
+            gpio.setup(dio1Pin, gpio.IN)
+        gpio.setup(rstPin, gpio.OUT)
+
+        self.spi = spidev.SpiDev()
+        self.spi.open(spiBus, spiDevice)
+        self.spi.max_speed_hz = speed
+
+    # one chip select cycle, returns the bytes clocked in (the first one is a dummy)
+    def xfer(self, data):
+        return self.spi.xfer2(data)
+
+    # one chip select cycle that doesn't read anything back, data can be any buffer
+    def write(self, data):
+        self.spi.writebytes2(data)
+
+    def reset(self):
+        self.gpio.output(self.rstPin, self.gpio.HIGH)
+        time.sleep(0.1)
+        self.gpio.output(self.rstPin, self.gpio.LOW)
+        time.sleep(0.1)
+
+    # callback(pin) runs on the GPIO library's thread for every rising edge of the DIO, or every edge with both
+    def attachInterrupt(self, callback, dio = 0, both = False):
+        if dio not in self.pins:
+            raise ValueError(f"no pin connected to DIO{dio}")
+        pin = self.pins[dio]
+        self.gpio.remove_event_detect(pin)
+        self.gpio.add_event_detect(pin, self.gpio.BOTH if both else self.gpio.RISING, callback=callback)
+
+    def detachInterrupt(self, dio = 0):
+        if dio in self.pins:
+            self.gpio.remove_event_detect(self.pins[dio])
+
+    def close(self):
+        self.spi.close()
+        if self.shared:
+            for pin in self.pins.values():
+                self.gpio.remove_event_detect(pin)
+        else:
+            self.gpio.cleanup()
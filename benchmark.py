@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Throughput and latency of the driver's hot paths, run against two emulated radios (see RFM69emulator.py)
+# so the numbers only depend on the Python side and can be compared between versions:
+#
+#     python3 benchmark.py > before.json
+#     python3 benchmark.py --payloads 0,61 --bitrates 4800,300000 --count 500
+#     python3 benchmark.py --long-frames --payloads 61,128,252
+#
+# For every bit rate, payload size and with and without autoModeTx it measures
+# - tx: radio.send() to a listening node
+# - rx: from send() until the receiver's recv() returns the packet
+# - ack: sendWithRetry() round trips against a node that sends the ACKs from its recv() loop
+# reporting packets/s, SPI transactions and bytes per packet, CPU time per packet and p50/p99 turnaround.
+# CPU time is the calling thread's, which includes the emulator's share of each SPI transaction.
+
+import RFM69
+import RFM69registers
+from RFM69registers import *
+from RFM69emulator import EmulatedSX1231, VirtualChannel
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+
+# the predefined RF_BITRATEMSB_*/RF_BITRATELSB_* pairs by name
+BITRATES = {name[len("RF_BITRATEMSB_"):]: (getattr(RFM69registers, name), getattr(RFM69registers, "RF_BITRATELSB_" + name[len("RF_BITRATEMSB_"):]))
+            for name in sorted(dir(RFM69registers)) if name.startswith("RF_BITRATEMSB_")}
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))] if values else None
+
+def summary(latencies, elapsed, cpu, spiTransactions, spiBytes, count):
+    return {"packets": count,
+            "packetsPerSecond": count / elapsed if elapsed else None,
+            "spiTransactionsPerPacket": spiTransactions / count,
+            "spiBytesPerPacket": spiBytes / count,
+            "cpuPerPacket": cpu / count,
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99)}
+
+class Bench(object):
+    def __init__(self, spiLatency, timeScale, seed):
+        self.channel = VirtualChannel(timeScale=timeScale, seed=seed)
+        self.sender = RFM69.RFM69(RF69_915MHZ, 1, 100, transport=EmulatedSX1231(self.channel, spiLatency))
+        self.receiver = RFM69.RFM69(RF69_915MHZ, 2, 100, transport=EmulatedSX1231(self.channel, spiLatency))
+        self.acking = False
+        threading.Thread(target=self.responder, daemon=True).start()
+
+    # the receiving node, ACKs when asked to and otherwise leaves packets for recv() in the rx test
+    def responder(self):
+        while True:
+            if not self.acking:
+                time.sleep(0.01)
+                continue
+            packet = self.receiver.recv(0.1)
+            if packet is not None and packet.ackRequested:
+                self.receiver.sendACK(packet.sender, sequence=packet.sequence)
+
+    def setBitrate(self, msb, lsb):
+        for radio in (self.sender, self.receiver):
+            with radio.lock:
+                radio.setMode(RF69_MODE_STANDBY)
+                radio.writeBurst(REG_BITRATEMSB, [msb, lsb])
+                radio.receiveBegin()
+
+    def counters(self):
+        return self.sender.spiTransactions, self.sender.transport.spiBytes, time.perf_counter(), time.thread_time()
+
+    def measure(self, count, run):
+        latencies = []
+        transactions, spiBytes, start, cpu = self.counters()
+        for i in range(count):
+            t = time.perf_counter()
+            run()
+            latencies.append(time.perf_counter() - t)
+        end = self.counters()
+        return summary(latencies, end[2] - start, end[3] - cpu, end[0] - transactions, end[1] - spiBytes, count)
+
+    def tx(self, count, payload):
+        return self.measure(count, lambda: self.sender.send(2, payload))
+
+    def rx(self, count, payload):
+        received = [0]
+        def run():
+            self.sender.send(2, payload)
+            if self.receiver.recv(1) is not None:
+                received[0] += 1
+        before = self.receiver.spiTransactions
+        result = self.measure(count, run)
+        result["delivered"] = received[0] / count
+        # the interrupt handler, recv() and re-arming the receiver
+        result["receiverSpiTransactionsPerPacket"] = (self.receiver.spiTransactions - before) / count
+        return result
+
+    def ack(self, count, payload, retryWaitTime):
+        acked = [0]
+        def run():
+            if self.sender.sendWithRetry(2, payload, 3, retryWaitTime):
+                acked[0] += 1
+        self.acking = True
+        time.sleep(0.02)
+        try:
+            result = self.measure(count, run)
+        finally:
+            self.acking = False
+            time.sleep(0.15)
+        result["acked"] = acked[0] / count
+        return result
+
+    # the legacy polling path with nothing received
+    def receiveDone(self, count):
+        self.receiver.receiveBegin()
+        return self.measureOn(self.receiver, count, self.receiver.receiveDone)
+
+    def measureOn(self, radio, count, run):
+        transactions, cpu, start = radio.spiTransactions, time.thread_time(), time.perf_counter()
+        for i in range(count):
+            run()
+        elapsed = time.perf_counter() - start
+        return {"callsPerSecond": count / elapsed, "spiTransactionsPerCall": (radio.spiTransactions - transactions) / count,
+                "cpuPerCall": (time.thread_time() - cpu) / count}
+
+def main():
+    parser = argparse.ArgumentParser(description="RFM69 driver benchmark against emulated radios, prints JSON")
+    parser.add_argument("--payloads", default="0,1,16,32,61", help="comma separated payload sizes or 'all' for every size up to the maximum")
+    parser.add_argument("--bitrates", default="all", help="comma separated RF_BITRATE* names (e.g. 4800,300000) or 'all'")
+    parser.add_argument("--count", type=int, default=200, help="packets per measurement")
+    parser.add_argument("--spi-latency", type=float, default=0.0, help="seconds added to every SPI transaction")
+    parser.add_argument("--time-scale", type=float, default=0.0, help="fraction of the real time on air to spend")
+    parser.add_argument("--retry-wait", type=int, default=20, help="sendWithRetry retryWaitTime in ms")
+    parser.add_argument("--long-frames", action="store_true", help="stream frames of up to 252 bytes through the FIFO")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    bitrates = sorted(BITRATES) if args.bitrates == "all" else args.bitrates.split(",")
+    bench = Bench(args.spi_latency, args.time_scale, args.seed)
+    if args.long_frames:
+        bench.sender.setLongFrames(True)
+        bench.receiver.setLongFrames(True)
+    payloads = range(bench.sender.maxDataLen + 1) if args.payloads == "all" else [int(size) for size in args.payloads.split(",")]
+
+    results = []
+    for name in bitrates:
+        bench.setBitrate(*BITRATES[name])
+        for size in payloads:
+            payload = bytes(range(size))
+            for autoModeTx in (False, True):
+                bench.sender.autoModeTx = autoModeTx
+                results.append({"bitrate": name, "payload": size, "autoModeTx": autoModeTx,
+                                "tx": bench.tx(args.count, payload),
+                                "rx": bench.rx(args.count, payload),
+                                "ack": bench.ack(args.count, payload, args.retry_wait)})
+            print(f"{name} {size}", file=sys.stderr)
+
+    report = {"python": platform.python_version(), "platform": platform.platform(), "settings": vars(args),
+              "receiveDone": bench.receiveDone(args.count * 10), "results": results}
+    bench.sender.shutdown()
+    bench.receiver.shutdown()
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+
+# Owns one radio and shares it with any number of local processes over a UNIX stream socket or UDP:
+#
+#     python3 gateway.py --band 868 --node 1 --network 100 --socket /tmp/rfm69.sock
+#     python3 gateway.py --udp 127.0.0.1:5069
+#
+# Every received packet goes to every client as soon as it's read from the FIFO, clients send frames back
+# through the same socket. Messages are length prefixed and written in batches, a batch is flushed at most
+# batchDelay seconds after its first message. All integers are big endian:
+#
+#     length:2, then one of
+#     MSG_PACKET  type:1 sender:1 target:1 ctl:1 rssi:1 (signed) time:8 (double, time.time()) data
+#     MSG_SEND    type:1 id:2 to:1 flags:1 (SEND_ACK) retries:1 retryWaitTime:2 (ms) data
+#     MSG_RESULT  type:1 id:2 status:1 (STATUS_*)
+#     MSG_HELLO   type:1, UDP clients send it (or anything else) to subscribe and then at least every udpTimeout seconds
+#
+# GatewayClient below speaks this over the UNIX socket.
+
+import RFM69
+import RFM69capture
+from RFM69registers import *
+from collections import deque, namedtuple
+import argparse
+import os
+import queue
+import selectors
+import signal
+import socket
+import struct
+import threading
+import time
+
+LENGTH = struct.Struct(">H")
+MSG_PACKET = 0x01
+MSG_SEND = 0x02
+MSG_RESULT = 0x03
+MSG_HELLO = 0x04
+PACKET_HEADER = struct.Struct(">BBBBbd")
+SEND_HEADER = struct.Struct(">BHBBBH")
+RESULT_FORMAT = struct.Struct(">BHB")
+SEND_ACK = 0x01
+STATUS_SENT = 0
+STATUS_ACKED = 1
+STATUS_NO_ACK = 2
+STATUS_ERROR = 3
+# largest UDP datagram a batch is split into
+DATAGRAM_SIZE = 8192
+
+GatewayPacket = namedtuple("GatewayPacket", "data sender target ctl rssi time")
+SendResult = namedtuple("SendResult", "requestId status")
+
+def frame(body):
+    return LENGTH.pack(len(body)) + body
+
+# complete messages at the start of buffer, and how many bytes they took
+def parse(buffer):
+    messages = []
+    offset = 0
+    while len(buffer) - offset >= LENGTH.size:
+        length, = LENGTH.unpack_from(buffer, offset)
+        if len(buffer) - offset - LENGTH.size < length:
+            break
+        messages.append(bytes(buffer[offset + LENGTH.size:offset + LENGTH.size + length]))
+        offset += LENGTH.size + length
+    return messages, offset
+
+def decode(body):
+    if body[0] == MSG_PACKET and len(body) >= PACKET_HEADER.size:
+        kind, sender, target, ctl, rssi, when = PACKET_HEADER.unpack_from(body)
+        return GatewayPacket(body[PACKET_HEADER.size:], sender, target, ctl, rssi, when)
+    if body[0] == MSG_RESULT and len(body) >= RESULT_FORMAT.size:
+        return SendResult(*RESULT_FORMAT.unpack_from(body)[1:])
+    return None
+
+class Client(object):
+    def __init__(self, sock = None, address = None):
+        self.sock = sock
+        self.address = address
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.lastSeen = time.monotonic()
+        self.closed = False
+
+class Gateway(object):
+    # address is a UNIX socket path or a (host, port) tuple for UDP
+    # a stream client more than maxBuffered bytes behind is disconnected, autoAck answers ACK requests for the clients
+    def __init__(self, radio, address, batchDelay = 0.001, maxBuffered = 262144, autoAck = True, udpTimeout = 60):
+        self.radio = radio
+        self.address = address
+        self.batchDelay = batchDelay
+        self.maxBuffered = maxBuffered
+        self.autoAck = autoAck
+        self.udpTimeout = udpTimeout
+        self.udp = isinstance(address, tuple)
+        self.selector = selectors.DefaultSelector()
+        if self.udp:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.listener.bind(address)
+        else:
+            if os.path.exists(address):
+                os.unlink(address)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(address)
+            self.listener.listen(16)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        # the interrupt thread and the TX worker wake the loop through this pair
+        self.wakeRead, self.wakeWrite = socket.socketpair()
+        self.wakeRead.setblocking(False)
+        self.selector.register(self.wakeRead, selectors.EVENT_READ)
+        self.lock = threading.Lock()
+        self.woken = False
+        # framed messages for every client and when the oldest was queued
+        self.outgoing = []
+        self.outgoingSince = None
+        # (client, framed message) answers to TX requests
+        self.replies = deque()
+        # socket or UDP address -> Client
+        self.clients = {}
+        self.running = False
+        self.packets = 0
+        self.batches = 0
+        self.clientsDropped = 0
+        self.txRequests = 0
+        # sends that raised, answered with STATUS_ERROR
+        self.txFailures = 0
+        self.txQueue = queue.Queue()
+        threading.Thread(target=self.txLoop, daemon=True).start()
+        radio.packetHandlers.append(self.handlePacket)
+
+    # runs on the interrupt thread
+    def handlePacket(self, packet):
+        # frames for other nodes (promiscuous mode) are theirs to acknowledge
+        if self.autoAck and packet.ackRequested and packet.target == self.radio.address:
+            # answered from the radio's ACK thread, the interrupt thread can't transmit
+            self.radio.resendACK(packet)
+        when = time.time() - (time.monotonic() - packet.timestamp)
+        message = frame(PACKET_HEADER.pack(MSG_PACKET, packet.sender, packet.target, packet.ctl,
+                                           max(-128, min(127, packet.rssi)), when) + packet.data)
+        with self.lock:
+            self.packets += 1
+            if not self.outgoing:
+                self.outgoingSince = time.monotonic()
+            self.outgoing.append(message)
+        self.wake()
+        return True
+
+    def wake(self):
+        with self.lock:
+            if self.woken:
+                return
+            self.woken = True
+        try:
+            self.wakeWrite.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def reply(self, client, requestId, status):
+        with self.lock:
+            self.replies.append((client, frame(RESULT_FORMAT.pack(MSG_RESULT, requestId, status))))
+        self.wake()
+
+    def txLoop(self):
+        while True:
+            request = self.txQueue.get()
+            if request is None:
+                return
+            client, requestId, toAddress, flags, retries, retryWaitTime, data = request
+            try:
+                if flags & SEND_ACK:
+                    future = self.radio.sendReliable(toAddress, data, retries, retryWaitTime)
+                    future.add_done_callback(lambda done, client=client, requestId=requestId: self.sendDone(
+                        client, requestId, done))
+                else:
+                    self.radio.send(toAddress, data)
+                    self.reply(client, requestId, STATUS_SENT)
+            except Exception:
+                self.sendFailed(client, requestId)
+
+    def sendFailed(self, client, requestId):
+        with self.lock:
+            self.txFailures += 1
+        self.reply(client, requestId, STATUS_ERROR)
+
+    # the retry thread fails the future when the frame couldn't be sent at all
+    def sendDone(self, client, requestId, done):
+        if done.cancelled() or done.exception() is not None:
+            self.sendFailed(client, requestId)
+        else:
+            self.reply(client, requestId, STATUS_ACKED if done.result() else STATUS_NO_ACK)
+
+    def serve(self):
+        self.running = True
+        self.radio.receiveBegin()
+        while self.running:
+            timeout = None
+            with self.lock:
+                if self.outgoingSince is not None:
+                    timeout = max(0.0, self.outgoingSince + self.batchDelay - time.monotonic())
+            if self.udp:
+                timeout = min(timeout, self.udpTimeout) if timeout is not None else self.udpTimeout
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self.wakeRead:
+                    try:
+                        self.wakeRead.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    with self.lock:
+                        self.woken = False
+                elif key.fileobj is self.listener:
+                    if self.udp:
+                        self.readDatagrams()
+                    else:
+                        self.accept()
+                else:
+                    client = key.data
+                    if events & selectors.EVENT_READ:
+                        self.readStream(client)
+                    if events & selectors.EVENT_WRITE and not client.closed:
+                        self.writeStream(client)
+            self.flush()
+            if self.udp:
+                self.expireClients()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+
+    def close(self):
+        self.txQueue.put(None)
+        for client in list(self.clients.values()):
+            if client.sock is not None:
+                self.disconnect(client)
+        self.selector.close()
+        self.listener.close()
+        self.wakeRead.close()
+        self.wakeWrite.close()
+        if not self.udp and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        client = Client(sock)
+        self.clients[sock] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def disconnect(self, client):
+        client.closed = True
+        self.clients.pop(client.sock, None)
+        self.selector.unregister(client.sock)
+        client.sock.close()
+
+    def readStream(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.disconnect(client)
+            return
+        client.inbuf += data
+        messages, used = parse(client.inbuf)
+        del client.inbuf[:used]
+        for body in messages:
+            self.handleMessage(client, body)
+
+    def readDatagrams(self):
+        while True:
+            try:
+                data, address = self.listener.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            client = self.clients.get(address)
+            if client is None:
+                client = self.clients[address] = Client(address=address)
+            client.lastSeen = time.monotonic()
+            for body in parse(data)[0]:
+                self.handleMessage(client, body)
+
+    def handleMessage(self, client, body):
+        if body[0] == MSG_SEND and len(body) >= SEND_HEADER.size:
+            kind, requestId, toAddress, flags, retries, retryWaitTime = SEND_HEADER.unpack_from(body)
+            self.txRequests += 1
+            self.txQueue.put((client, requestId, toAddress, flags, retries, retryWaitTime, body[SEND_HEADER.size:]))
+
+    def expireClients(self):
+        now = time.monotonic()
+        for address, client in list(self.clients.items()):
+            if now - client.lastSeen > self.udpTimeout:
+                del self.clients[address]
+
+    # everything queued since the last flush goes out as one write per client
+    def flush(self):
+        with self.lock:
+            if self.outgoingSince is not None and time.monotonic() - self.outgoingSince < self.batchDelay:
+                batch = b""
+            else:
+                batch = b"".join(self.outgoing)
+                self.outgoing = []
+                self.outgoingSince = None
+            replies = list(self.replies)
+            self.replies.clear()
+        if not batch and not replies:
+            return
+        self.batches += 1
+        for client, message in replies:
+            if not client.closed:
+                self.queue(client, message)
+        if batch:
+            for client in list(self.clients.values()):
+                self.queue(client, batch)
+        for client in list(self.clients.values()):
+            if not client.outbuf:
+                continue
+            if self.udp:
+                self.writeDatagrams(client)
+            else:
+                self.writeStream(client)
+
+    def queue(self, client, data):
+        client.outbuf += data
+        if client.sock is not None and len(client.outbuf) > self.maxBuffered:
+            # a client that doesn't keep up mustn't hold up the others
+            self.clientsDropped += 1
+            self.disconnect(client)
+
+    def writeStream(self, client):
+        if client.closed:
+            return
+        try:
+            sent = client.sock.send(client.outbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.disconnect(client)
+            return
+        del client.outbuf[:sent]
+        self.selector.modify(client.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0), client)
+
+    # whole messages per datagram, a client that isn't there anymore just misses them
+    def writeDatagrams(self, client):
+        while client.outbuf:
+            end = 0
+            while end < len(client.outbuf):
+                length, = LENGTH.unpack_from(client.outbuf, end)
+                if end and end + LENGTH.size + length > DATAGRAM_SIZE:
+                    break
+                end += LENGTH.size + length
+            try:
+                self.listener.sendto(client.outbuf[:end], client.address)
+            except OSError:
+                pass
+            del client.outbuf[:end]
+
+    def stats(self):
+        with self.lock:
+            return {"clients": len(self.clients), "packets": self.packets, "batches": self.batches,
+                    "clientsDropped": self.clientsDropped, "txRequests": self.txRequests,
+                    "txFailures": self.txFailures}
+
+# a local process on the other end of the gateway's UNIX socket
+class GatewayClient(object):
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.buffer = bytearray()
+        self.messages = deque()
+        self.nextId = 0
+
+    # returns the request id that comes back in the SendResult
+    def send(self, toAddress, data, requestACK = False, retries = 3, retryWaitTime = 10):
+        self.nextId = (self.nextId + 1) & 0xFFFF
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+        self.sock.sendall(frame(SEND_HEADER.pack(MSG_SEND, self.nextId, toAddress, SEND_ACK if requestACK else 0,
+                                                 retries, retryWaitTime) + bytes(data)))
+        return self.nextId
+
+    # next GatewayPacket or SendResult, None if nothing arrived within timeout seconds (None waits forever)
+    def recv(self, timeout = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.messages:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                return None
+            if not data:
+                raise ConnectionError("gateway closed the connection")
+            self.buffer += data
+            messages, used = parse(self.buffer)
+            del self.buffer[:used]
+            self.messages.extend(message for message in map(decode, messages) if message is not None)
+        return self.messages.popleft()
+
+    def close(self):
+        self.sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="share an RFM69 with local processes over a UNIX or UDP socket")
+    parser.add_argument("--socket", default="/tmp/rfm69.sock", help="UNIX socket path")
+    parser.add_argument("--udp", help="host:port to serve UDP clients on instead of the UNIX socket")
+    parser.add_argument("--band", type=int, choices=(315, 433, 868, 915), default=915)
+    parser.add_argument("--node", type=int, default=1)
+    parser.add_argument("--network", type=int, default=100)
+    parser.add_argument("--high-power", action="store_true", help="RFM69HW/HCW module")
+    parser.add_argument("--int-pin", type=int, default=18)
+    parser.add_argument("--rst-pin", type=int, default=22)
+    parser.add_argument("--spi-bus", type=int, default=0)
+    parser.add_argument("--spi-device", type=int, default=0)
+    parser.add_argument("--frequency", type=int, help="in Hz, instead of the band's default")
+    parser.add_argument("--profile", help="RFM69modem.PROFILES name, e.g. 57600")
+    parser.add_argument("--key", help="16 character AES key")
+    parser.add_argument("--promiscuous", action="store_true", help="pass on frames for other nodes too")
+    parser.add_argument("--no-ack", action="store_true", help="leave ACK requests unanswered")
+    parser.add_argument("--batch-delay", type=float, default=0.001, help="seconds a packet may wait for others to share its write")
+    parser.add_argument("--capture", help="log every frame the radio reads to this RFM69capture ring file")
+    parser.add_argument("--capture-slots", type=int, default=65536, help="frames the capture file keeps")
+    args = parser.parse_args()
+
+    bands = {315: RF69_315MHZ, 433: RF69_433MHZ, 868: RF69_868MHZ, 915: RF69_915MHZ}
+    radio = RFM69.RFM69(bands[args.band], args.node, args.network, args.high_power, args.int_pin, args.rst_pin,
+                        args.spi_bus, args.spi_device)
+    if args.high_power:
+        radio.setHighPower(True)
+    if args.frequency:
+        radio.setFrequency(args.frequency)
+    if args.profile:
+        radio.setModemProfile(args.profile)
+    if args.key:
+        radio.encrypt(args.key)
+    radio.promiscuous(args.promiscuous)
+    # the dedup cache takes care of ACKs the sender missed
+    radio.dedup = RFM69.DedupCache()
+    capture = None
+    if args.capture:
+        capture = radio.capture = RFM69capture.CaptureFile(args.capture, args.capture_slots)
+
+    if args.udp:
+        host, _, port = args.udp.rpartition(":")
+        address = (host or "127.0.0.1", int(port))
+    else:
+        address = args.socket
+    gateway = Gateway(radio, address, args.batch_delay, autoAck=not args.no_ack)
+    signal.signal(signal.SIGTERM, lambda signum, stack: gateway.stop())
+    print(f"serving on {address}")
+    try:
+        gateway.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if gateway.txFailures:
+            print(f"{gateway.txFailures} sends failed")
+        gateway.close()
+        radio.shutdown()
+        if capture is not None:
+            radio.capture = None
+            capture.close()
+
+if __name__ == "__main__":
+    main()
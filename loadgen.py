@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+# Load test for a gateway: frames from many nodes are injected into an emulated radio (see RFM69emulator.py),
+# so they go through the driver's interrupt handler and FIFO reads like frames off the air, at rising rates
+# until frames get dropped or ACKs miss their deadline:
+#
+#     python3 loadgen.py --nodes 200 --rates 10,20,50,100,200,400 --ack-fraction 0.5
+#     python3 loadgen.py --target gateway --work 0.002 --rates 50,100,200
+#     python3 loadgen.py --trace capture.cap --speeds 1,2,5,10
+#
+# Synthetic load is Poisson arrivals spread over --nodes senders, a trace is an RFM69capture file or JSON lines
+# with time, sender, target, ctl, data (hex) and rssi, replayed --speeds times faster than recorded.
+# Time on air is simulated, frames overlapping on the air are counted as collisions and not injected, and
+# the gateway's ACKs are seen by a listener on the virtual channel and timed from the end of the frame they answer.
+# The target is a radio whose application thread calls recv() and sends the ACKs, or gateway.py with a client.
+#
+# For each step it reports frames offered, collided, lost because the receiver was busy (not back in RX yet),
+# dropped from the receive buffer and delivered to the application, ACKs on time, late and missing, and the
+# first step where drops or missed ACKs go above the limits (the knee), printing JSON like benchmark.py.
+
+import RFM69
+import RFM69capture
+from RFM69registers import *
+from RFM69emulator import EmulatedSX1231, VirtualChannel
+from collections import deque
+import argparse
+import gateway
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))] if values else None
+
+# synthetic (start offset, sender, target, ctl, payload, rssi) tuples, sorted by start
+def synthetic(rate, duration, nodes, target, ackFraction, sizes, rssi, rng):
+    events = []
+    senders = [address for address in range(1, RF69_BROADCAST_ADDR) if address != target][:nodes]
+    sequences = {}
+    start = 0.0
+    while True:
+        start += rng.expovariate(rate)
+        if start >= duration:
+            return events
+        sender = rng.choice(senders)
+        # every node numbers its frames 1-15 like sendReliable, so dedup and ACK matching work as on a real network
+        sequence = sequences[sender] = sequences.get(sender, 0) % RF69_CTL_SEQUENCE + 1
+        ctl = sequence | (RF69_CTL_REQACK if rng.random() < ackFraction else 0)
+        payload = bytes(rng.getrandbits(8) for i in range(rng.randint(*sizes)))
+        events.append((start, sender, target, ctl, payload, rng.uniform(*rssi)))
+
+# a recorded trace as (start offset, sender, target, ctl, payload, rssi), from an RFM69capture file or JSON lines
+def loadTrace(path):
+    with open(path, "rb") as trace:
+        magic = trace.read(len(RFM69capture.MAGIC))
+    if magic == RFM69capture.MAGIC:
+        reader = RFM69capture.CaptureReader(path)
+        records = [(frame.time, frame.sender, frame.target, frame.ctl, frame.data, frame.rssi) for frame in reader.frames()]
+        reader.close()
+    else:
+        with open(path) as trace:
+            records = [(float(entry["time"]), int(entry["sender"]), int(entry["target"]), int(entry.get("ctl", 0)),
+                        bytes.fromhex(entry.get("data", "")), float(entry.get("rssi", -60)))
+                       for entry in map(json.loads, filter(str.strip, trace))]
+    records.sort(key=lambda record: record[0])
+    if not records:
+        raise ValueError(f"{path} has no frames")
+    return [(record[0] - records[0][0],) + record[1:] for record in records]
+
+# listens on the virtual channel next to the gateway, for the ACKs it sends back to the nodes
+class AckListener(object):
+    def __init__(self, chip):
+        self.chip = chip
+        self.lock = threading.RLock()
+        # (node, sequence) -> deque of end times of frames waiting for their ACK
+        self.waiting = {}
+        self.latencies = []
+
+    # the channel's receiver interface, see VirtualChannel.deliver
+    def link(self):
+        return self.chip.link()
+
+    def listening(self):
+        return False
+
+    def listenCycle(self):
+        return 0, 0
+
+    def frequency(self):
+        return self.chip.frequency()
+
+    def expect(self, node, sequence, end):
+        with self.lock:
+            self.waiting.setdefault((node, sequence), deque()).append(end)
+
+    def forget(self, node, sequence):
+        with self.lock:
+            self.waiting[(node, sequence)].pop()
+
+    def receive(self, frame, rssi):
+        now = time.monotonic()
+        if len(frame) >= 4 and frame[3] & RF69_CTL_SENDACK:
+            with self.lock:
+                ends = self.waiting.get((frame[1], frame[3] & RF69_CTL_SEQUENCE))
+                if ends:
+                    self.latencies.append(now - ends.popleft())
+        return True
+
+    # latencies of the ACKs seen so far and the number of ACKs that never came
+    def collect(self):
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            missing = sum(len(ends) for ends in self.waiting.values())
+            self.waiting = {}
+        return latencies, missing
+
+# the radio under test and whatever reads its packets
+class Target(object):
+    def __init__(self, kind, channel, profile, work, dedup):
+        self.kind = kind
+        self.work = work
+        self.chip = EmulatedSX1231(channel)
+        self.radio = RFM69.RFM69(RF69_915MHZ, 1, 100, transport=self.chip)
+        if profile:
+            self.radio.setModemProfile(profile)
+        if dedup:
+            self.radio.dedup = RFM69.DedupCache()
+        self.delivered = 0
+        self.server = None
+        if kind == "gateway":
+            self.path = os.path.join(tempfile.mkdtemp(), "loadgen.sock")
+            self.server = gateway.Gateway(self.radio, self.path)
+            threading.Thread(target=self.server.serve, daemon=True).start()
+            time.sleep(0.05)
+            self.client = gateway.GatewayClient(self.path)
+            threading.Thread(target=self.clientLoop, daemon=True).start()
+        else:
+            self.radio.receiveBegin()
+            threading.Thread(target=self.recvLoop, daemon=True).start()
+
+    # an application that ACKs from its own receive loop, like radio2.py
+    def recvLoop(self):
+        while True:
+            packet = self.radio.recv()
+            if packet.ackRequested:
+                self.radio.sendACK(packet.sender, sequence=packet.sequence)
+            self.delivered += 1
+            if self.work:
+                time.sleep(self.work)
+
+    def clientLoop(self):
+        while True:
+            try:
+                message = self.client.recv()
+            except OSError:
+                return
+            if isinstance(message, gateway.GatewayPacket):
+                self.delivered += 1
+                if self.work:
+                    time.sleep(self.work)
+
+    def counters(self):
+        stats = self.radio.stats()
+        counters = {"delivered": self.delivered, "bufferDropped": stats["rxDropped"], "duplicates": stats.get("dedupDuplicates", 0)}
+        if self.server is not None:
+            counters["clientsDropped"] = self.server.stats()["clientsDropped"]
+        return counters
+
+    def close(self):
+        if self.server is not None:
+            self.client.close()
+            self.server.stop()
+            time.sleep(0.05)
+            self.server.close()
+        self.radio.shutdown()
+
+class LoadGenerator(object):
+    def __init__(self, target, channel, ackDeadline):
+        self.target = target
+        self.channel = channel
+        self.ackDeadline = ackDeadline
+        self.listener = AckListener(target.chip)
+        channel.attach(self.listener)
+
+    # injects the events at their times, returns what happened to them
+    def run(self, events, speed = 1.0):
+        chip = self.target.chip
+        before = self.target.counters()
+        self.listener.collect()
+        offered = collided = busy = injected = acksExpected = 0
+        lags = []
+        airEnd = 0.0
+        base = time.monotonic() + 0.01
+        for start, sender, target, ctl, payload, rssi in events:
+            frame = bytes([len(payload) + 3, target, sender, ctl]) + payload
+            airTime = self.channel.airTime(chip, len(frame))
+            start = base + start / speed
+            offered += 1
+            # the later of two overlapping frames never makes it, the receiver is locked onto the first one
+            if start < airEnd:
+                collided += 1
+                continue
+            delay = start - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            lags.append(max(0.0, -delay))
+            airEnd = time.monotonic() + airTime
+            # on the air for the gateway's carrier sense, then into the FIFO once the last bit is in
+            self.channel.startTx(self.listener, airTime)
+            if airTime:
+                time.sleep(airTime)
+            # expected before the frame is in, the ACK may be quicker than this thread
+            ackRequested = ctl & RF69_CTL_REQACK and not ctl & RF69_CTL_SENDACK and target == self.target.radio.address
+            if ackRequested:
+                self.listener.expect(sender, ctl & RF69_CTL_SEQUENCE, time.monotonic())
+            if not chip.receive(frame, rssi):
+                busy += 1
+                if ackRequested:
+                    self.listener.forget(sender, ctl & RF69_CTL_SEQUENCE)
+                continue
+            injected += 1
+            acksExpected += 1 if ackRequested else 0
+        duration = time.monotonic() - base
+        # let the gateway catch up before counting
+        time.sleep(max(0.5, 20 * self.ackDeadline))
+        after = self.target.counters()
+        latencies, missing = self.listener.collect()
+        counts = {name: after[name] - before[name] for name in after}
+        onTime = sum(1 for latency in latencies if latency <= self.ackDeadline)
+        dropped = busy + counts["bufferDropped"] + counts.get("clientsDropped", 0)
+        return {"offered": offered, "offeredRate": offered / duration if duration > 0 else None,
+                "collided": collided, "injected": injected, "receiverBusy": busy, **counts,
+                "dropFraction": dropped / max(1, offered - collided),
+                "acksExpected": acksExpected, "acksOnTime": onTime, "acksLate": len(latencies) - onTime, "acksMissing": missing,
+                "ackMissFraction": (acksExpected - onTime) / acksExpected if acksExpected else 0.0,
+                "ackP50": percentile(latencies, 0.5), "ackP99": percentile(latencies, 0.99),
+                "injectLagP99": percentile(lags, 0.99)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway load test against an emulated radio, prints JSON")
+    parser.add_argument("--target", choices=("radio", "gateway"), default="radio", help="a recv() loop or gateway.py with one client")
+    parser.add_argument("--trace", help="replay this RFM69capture file or JSON lines trace instead of synthetic load")
+    parser.add_argument("--speeds", default="1,2,5,10", help="comma separated trace replay speed ups")
+    parser.add_argument("--rates", default="10,20,50,100,200,400", help="comma separated synthetic frames/s")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of synthetic load per rate")
+    parser.add_argument("--nodes", type=int, default=200)
+    parser.add_argument("--ack-fraction", type=float, default=0.5, help="fraction of synthetic frames requesting an ACK")
+    parser.add_argument("--sizes", default="4,32", help="min,max synthetic payload bytes")
+    parser.add_argument("--ack-deadline", type=float, help="seconds from the end of a frame until its ACK is in, "
+                        "by default the ACK's time on air plus sendWithRetry's 10ms")
+    parser.add_argument("--max-drop", type=float, default=0.01, help="drop fraction that marks the knee")
+    parser.add_argument("--max-ack-miss", type=float, default=0.01, help="fraction of late or missing ACKs that marks the knee")
+    parser.add_argument("--work", type=float, default=0.0, help="seconds the application spends on each packet")
+    parser.add_argument("--profile", help="RFM69modem.PROFILES name, the default is the driver's 4800bps")
+    parser.add_argument("--dedup", action="store_true", help="give the radio a DedupCache (gateway.py always has one)")
+    parser.add_argument("--keep-going", action="store_true", help="run the remaining steps after the knee")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    channel = VirtualChannel(timeScale=1.0, seed=args.seed)
+    target = Target(args.target, channel, args.profile, args.work, args.dedup or args.target == "gateway")
+    ackDeadline = args.ack_deadline if args.ack_deadline is not None else target.radio.timeOnAir(3) + 0.01
+    generator = LoadGenerator(target, channel, ackDeadline)
+    if args.trace:
+        trace = loadTrace(args.trace)
+        steps = [("speed", float(speed), trace) for speed in args.speeds.split(",")]
+    else:
+        sizes = tuple(min(int(size), target.radio.maxDataLen) for size in args.sizes.split(","))
+        steps = [("rate", float(rate), synthetic(float(rate), args.duration, args.nodes, target.radio.address,
+                                                 args.ack_fraction, sizes, (-90, -40), rng))
+                 for rate in args.rates.split(",")]
+
+    results = []
+    knee = None
+    for kind, value, events in steps:
+        result = generator.run(events, value if kind == "speed" else 1.0)
+        result[kind] = value
+        results.append(result)
+        print(f"{kind} {value}: {result['offeredRate']:.1f} frames/s, dropped {result['dropFraction']:.1%}, "
+              f"ACKs missed {result['ackMissFraction']:.1%}", file=sys.stderr)
+        if knee is None and (result["dropFraction"] > args.max_drop or result["ackMissFraction"] > args.max_ack_miss):
+            knee = result
+            if not args.keep_going:
+                break
+    target.close()
+
+    good = [result for result in results if result is not knee and (knee is None or result["offeredRate"] < knee["offeredRate"])]
+    report = {"settings": vars(args), "ackDeadline": ackDeadline, "results": results,
+              "knee": {"offeredRate": knee["offeredRate"], "dropFraction": knee["dropFraction"],
+                       "ackMissFraction": knee["ackMissFraction"]} if knee else None,
+              "capacity": max(result["offeredRate"] for result in good) if good else None}
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -35,11 +35,8 @@ radio.encrypt(KEY)
 
 radio.setFrequency(433500000)
 
-radio.writeReg(REG_BITRATEMSB, RF_BITRATEMSB_1200)
-radio.writeReg(REG_BITRATELSB, RF_BITRATELSB_1200)
-
-radio.writeReg(REG_FDEVMSB, RF_FDEVMSB_5000)
-radio.writeReg(REG_FDEVLSB, RF_FDEVLSB_5000)
+# 1200 bps with about 5 kHz deviation, see RFM69modem.py for the other profiles
+radio.setModemProfile("1200")
 
 print("starting loop...")
 sequence = 0